@@ -9,6 +9,7 @@
 #include <errno.h>
 #include <stdint.h>
 #include <stdio.h>
+#include <string.h>
 
 
 /* CRegFile: Regular file class
@@ -119,6 +120,80 @@ static size_t CRegFile_read(struct IRegFile *self, void* buf, size_t size, size_
 }
 
 
+/* CMemRegFile: Regular file class backed by a memory block
+*/
+
+struct CMemRegFile
+{
+    struct IRegFile iface;
+    char const      *data;
+    size_t          size;
+};
+
+
+static void CMemRegFile_close(struct IRegFile *self);
+static int CMemRegFile_fstat(struct IRegFile *self, struct stat *statbuf);
+static size_t CMemRegFile_read(struct IRegFile *self, void* buf, size_t size, size_t offset);
+
+static struct IRegFile_vtbl const CMemRegFile_vtbl = {
+    .close = CMemRegFile_close,
+    .fstat = CMemRegFile_fstat,
+    .read =  CMemRegFile_read,
+};
+
+
+struct IRegFile* regfile_from_memory(void const* data, size_t size)
+{
+    NEW_PTR(selfc, struct CMemRegFile);
+    if(!selfc){
+        errno = ENOMEM;
+        return NULL;
+    }
+
+    selfc->iface.vtbl = &CMemRegFile_vtbl;
+    selfc->data = (char const*)data;
+    selfc->size = size;
+
+    return (struct IRegFile*)selfc;
+}
+
+
+static void CMemRegFile_close(struct IRegFile *self)
+{
+    /* The memory block is owned by the caller */
+    free(self);
+}
+
+
+static int CMemRegFile_fstat(struct IRegFile *self, struct stat *statbuf)
+{
+    struct CMemRegFile* selfc = (struct CMemRegFile*)self;
+
+    memset(statbuf, 0, sizeof(*statbuf));
+    statbuf->st_mode = S_IFREG | 0444;
+    statbuf->st_nlink = 1;
+    statbuf->st_size = (off_t)selfc->size;
+
+    return 0;
+}
+
+
+static size_t CMemRegFile_read(struct IRegFile *self, void* buf, size_t size, size_t offset)
+{
+    struct CMemRegFile* selfc = (struct CMemRegFile*)self;
+
+    if(offset >= selfc->size){
+        return 0;
+    }
+    if(size > selfc->size - offset){
+        size = selfc->size - offset;
+    }
+
+    memcpy(buf, selfc->data + offset, size);
+    return size;
+}
+
+
 /* CDirectory: Directory class
 */
 
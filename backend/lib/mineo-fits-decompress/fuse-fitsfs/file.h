@@ -117,6 +117,26 @@ struct IDirectory;
 struct IRegFile* regfile_open(char const* path, struct IDirectory *directory);
 
 
+/** Wraps a memory block as a regular file.
+
+    The memory is not copied. It must be kept alive and unchanged
+    until the returned file is closed.
+
+    Parameters
+    ----------
+    data
+        Pointer to the contents of the file.
+    size
+        Size of `data` in bytes.
+
+    Returns
+    -------
+    regfile
+        Regular file.
+*/
+struct IRegFile* regfile_from_memory(void const* data, size_t size);
+
+
 /** Directory interface, inheriting IFile.
 */
 struct IDirectory_vtbl;
@@ -3,71 +3,202 @@
 #include <stdio.h>
 #include "fitsfile.h"
 
-static PyObject *decompressed_fits(PyObject *self, PyObject *args)
+// 圧縮されたfitsファイルの読み込み元
+// pathかbufのどちらか一方が使われる
+struct Source
 {
-  const char *filepath;
-  int num_threads;
+  const char *path;
+  Py_buffer view;
+};
 
-  // Python引数の解析
-  if (!PyArg_ParseTuple(args, "si", &filepath, &num_threads))
+// srcはstr（パス）か、bytes, memoryview, mmap, SharedMemory.bufなどのbytes-likeなオブジェクト
+static int parse_source(PyObject *src, struct Source *source)
+{
+  source->path = NULL;
+  source->view.obj = NULL;
+  if (PyUnicode_Check(src))
   {
-    return NULL;
+    source->path = PyUnicode_AsUTF8(src);
+    return source->path == NULL ? -1 : 0;
   }
+  return PyObject_GetBuffer(src, &source->view, PyBUF_SIMPLE);
+}
+
+static void release_source(struct Source *source)
+{
+  if (source->view.obj)
+  {
+    PyBuffer_Release(&source->view);
+  }
+}
 
+// GILを持たずに呼べる
+static struct IRegFile *open_source(struct Source *source, int num_threads)
+{
   struct FitsFileOpenOptions options = {.num_threads = num_threads};
+  if (source->path)
+  {
+    return fitsfile_open(source->path, NULL, &options);
+  }
+  struct IRegFile *file = regfile_from_memory(source->view.buf, source->view.len);
+  return file ? fitsfile_open_regfile(file, &options) : NULL;
+}
+
+// ファイルを開いて展開後のサイズを得る
+// 失敗した場合はRuntimeErrorを設定してNULLを返す
+static struct IRegFile *open_and_stat(struct Source *source, int num_threads, struct stat *fileStat)
+{
+  struct IRegFile *file;
+  int stat_error = 0;
+
+  Py_BEGIN_ALLOW_THREADS;
+  file = open_source(source, num_threads);
+  if (file)
+  {
+    stat_error = file->vtbl->fstat(file, fileStat);
+  }
+  Py_END_ALLOW_THREADS;
+
+  if (file == NULL)
+  {
+    PyErr_SetString(PyExc_RuntimeError, "Failed to open the file.");
+    return NULL;
+  }
+  if (stat_error != 0)
+  {
+    file->vtbl->close(file);
+    PyErr_SetString(PyExc_RuntimeError, "Failed to get the file stat.");
+    return NULL;
+  }
+  return file;
+}
+
+// 展開はGILを解放して行うので、他のスレッドは並行して動ける
+// fileはこの関数の中で閉じられる
+static int read_all(struct IRegFile *file, char *buf, size_t size)
+{
+  size_t read_bytes;
+
+  Py_BEGIN_ALLOW_THREADS;
+  read_bytes = file->vtbl->read(file, buf, size, 0);
+  file->vtbl->close(file);
+  Py_END_ALLOW_THREADS;
+
+  if (read_bytes < size)
+  {
+    PyErr_SetString(PyExc_RuntimeError, "Failed to read the entire file.");
+    return -1;
+  }
+  return 0;
+}
+
+// 展開したファイル全体をbytesとして返す
+static PyObject *decompressed_fits(PyObject *self, PyObject *args)
+{
+  PyObject *src;
+  int num_threads;
+  struct Source source;
   struct stat fileStat;
-  struct IRegFile *file = NULL;
-  const char *error_message = NULL;
   PyObject *result = NULL;
 
-  file = fitsfile_open(filepath, NULL, &options);
-  if (file == NULL)
+  if (!PyArg_ParseTuple(args, "Oi", &src, &num_threads) || parse_source(src, &source) != 0)
   {
-    error_message = "Failed to open the file.";
-    goto end;
+    return NULL;
   }
 
-  if (file->vtbl->fstat(file, &fileStat) != 0)
+  struct IRegFile *file = open_and_stat(&source, num_threads, &fileStat);
+  if (file == NULL)
   {
-    error_message = "Failed to get the file stat.";
     goto end;
   }
 
   result = PyBytes_FromStringAndSize(NULL, fileStat.st_size);
   if (result == NULL)
   {
-    error_message = "Failed to allocate memory for the result.";
+    file->vtbl->close(file);
     goto end;
   }
 
-  char *buf = PyBytes_AS_STRING(result);
-  const size_t read_bytes = file->vtbl->read(file, buf, fileStat.st_size, 0);
-  if (read_bytes < fileStat.st_size)
+  if (read_all(file, PyBytes_AS_STRING(result), fileStat.st_size) != 0)
   {
-    error_message = "Failed to read the entire file.";
-    goto end;
+    Py_CLEAR(result);
   }
 
 end:
+  release_source(&source);
+  return result;
+}
+
+// 展開後のサイズを返す（タイルの展開は行わない）
+static PyObject *decompressed_fits_size(PyObject *self, PyObject *args)
+{
+  PyObject *src;
+  struct Source source;
+  struct stat fileStat;
+
+  if (!PyArg_ParseTuple(args, "O", &src) || parse_source(src, &source) != 0)
+  {
+    return NULL;
+  }
+
+  struct IRegFile *file = open_and_stat(&source, 0, &fileStat);
   if (file)
   {
     file->vtbl->close(file);
   }
-  if (error_message != NULL)
+  release_source(&source);
+  return file ? PyLong_FromLongLong(fileStat.st_size) : NULL;
+}
+
+// 呼び出し側が用意した書き込み可能なbufferに展開して、書き込んだバイト数を返す
+static PyObject *decompressed_fits_into(PyObject *self, PyObject *args)
+{
+  PyObject *src;
+  Py_buffer out;
+  int num_threads;
+  struct Source source;
+  struct stat fileStat;
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTuple(args, "Ow*i", &src, &out, &num_threads))
+  {
+    return NULL;
+  }
+  if (parse_source(src, &source) != 0)
   {
-    if (result)
-    {
-      Py_DECREF(result);
-    }
-    PyErr_SetString(PyExc_RuntimeError, error_message);
+    PyBuffer_Release(&out);
     return NULL;
   }
+
+  struct IRegFile *file = open_and_stat(&source, num_threads, &fileStat);
+  if (file == NULL)
+  {
+    goto end;
+  }
+
+  if (fileStat.st_size > out.len)
+  {
+    file->vtbl->close(file);
+    PyErr_Format(PyExc_ValueError, "The buffer is too small: %zd < %lld", out.len, (long long)fileStat.st_size);
+    goto end;
+  }
+
+  if (read_all(file, out.buf, fileStat.st_size) == 0)
+  {
+    result = PyLong_FromLongLong(fileStat.st_size);
+  }
+
+end:
+  release_source(&source);
+  PyBuffer_Release(&out);
   return result;
 }
 
 // モジュール内で定義される関数リスト
 static PyMethodDef FitsMethods[] = {
     {"decompressed_fits", decompressed_fits, METH_VARARGS, "Decompress a fits file."},
+    {"decompressed_fits_size", decompressed_fits_size, METH_VARARGS, "Size of a decompressed fits file."},
+    {"decompressed_fits_into", decompressed_fits_into, METH_VARARGS, "Decompress a fits file into a writable buffer."},
     {NULL, NULL, 0, NULL} // 終端
 };
 
@@ -84,4 +215,4 @@ static struct PyModuleDef FitsModule = {
 PyMODINIT_FUNC PyInit_mineo_fits_decompress_c(void)
 {
   return PyModule_Create(&FitsModule);
-}
\ No newline at end of file
+}
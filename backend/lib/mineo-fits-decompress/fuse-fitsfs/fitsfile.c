@@ -2024,20 +2024,30 @@ struct IRegFile* fitsfile_open(
     char const                          *path,
     struct IDirectory                   *directory,
     struct FitsFileOpenOptions const    *options
+){
+    struct IRegFile* file = regfile_open(path, directory);
+    if(!file){
+        if(!errno) errno = ENOENT;
+        return NULL;
+    }
+
+    return fitsfile_open_regfile(file, options);
+}
+
+
+struct IRegFile* fitsfile_open_regfile(
+    struct IRegFile                     *file,
+    struct FitsFileOpenOptions const    *options
 ){
     NEW_PTR(selfc, struct CFitsFile);
     if(!selfc){
+        file->vtbl->close(file);
         errno = ENOMEM;
         return NULL;
     }
 
     selfc->iface.vtbl = &CFitsFile_vtbl;
-    selfc->file = regfile_open(path, directory);
-    if(!selfc->file){
-        free(selfc);
-        if(!errno) errno = ENOENT;
-        return NULL;
-    }
+    selfc->file = file;
 
     selfc->hdu = NULL;
     selfc->hdu_is_filled = 0;
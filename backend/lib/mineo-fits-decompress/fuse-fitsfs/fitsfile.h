@@ -41,6 +41,27 @@ struct IRegFile* fitsfile_open(
     struct FitsFileOpenOptions const    *options
 );
 
+/** Opens a FITS file from a regular file that is already opened.
+
+    Parameters
+    ----------
+    file
+        Regular file (e.g. one returned by `regfile_from_memory`).
+        The returned FITS file takes the ownership of it,
+        and it is closed even if this function fails.
+    options
+        Options.
+
+    Returns
+    -------
+    fitsfile
+        FITS file.
+*/
+struct IRegFile* fitsfile_open_regfile(
+    struct IRegFile                     *file,
+    struct FitsFileOpenOptions const    *options
+);
+
 /** Pseudo-posix stat() and fstatat() for FITS file.
     `stat::st_size` field is set to its uncompressed size.
 
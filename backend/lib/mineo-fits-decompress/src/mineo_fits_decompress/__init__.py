@@ -1,3 +1,7 @@
+'''
+The decompression runs without the GIL, so the functions below can be called from multiple threads in parallel.
+'''
+
 from pathlib import Path
 from typing import Union
 import mineo_fits_decompress_c # type: ignore
@@ -8,3 +12,45 @@ def decompressed_bytes(filename: Union[str,Path],  n_threads:int = 8) -> bytes:
         return mineo_fits_decompress_c.decompressed_fits(str(filename), n_threads)
     except RuntimeError as e:
         raise RuntimeError(f'Error in decompressed_bytes: {e}, file={filename}, n_threads={n_threads}')
+
+
+def decompressed_bytes_from_buffer(data, n_threads:int = 8) -> bytes:
+    '''
+    Same as `decompressed_bytes` but reads the compressed file from a bytes-like object
+    (bytes, memoryview, mmap, SharedMemory.buf, ...) without copying it.
+    '''
+    try:
+        return mineo_fits_decompress_c.decompressed_fits(_source(data), n_threads)
+    except RuntimeError as e:
+        raise RuntimeError(f'Error in decompressed_bytes_from_buffer: {e}, size={len(memoryview(data))}, n_threads={n_threads}')
+
+
+def decompressed_size(src) -> int:
+    '''
+    Size of the decompressed file. `src` is a path or a bytes-like object.
+    Only the headers are read.
+    '''
+    try:
+        return mineo_fits_decompress_c.decompressed_fits_size(_source(src))
+    except RuntimeError as e:
+        raise RuntimeError(f'Error in decompressed_size: {e}, src={_describe(src)}')
+
+
+def decompress_into(src, out, n_threads:int = 8) -> int:
+    '''
+    Decompresses `src` (a path or a bytes-like object) into the writable buffer `out`
+    (bytearray, numpy array, SharedMemory.buf, ...) and returns the number of bytes written.
+    Raises ValueError if `out` is smaller than `decompressed_size(src)`.
+    '''
+    try:
+        return mineo_fits_decompress_c.decompressed_fits_into(_source(src), out, n_threads)
+    except RuntimeError as e:
+        raise RuntimeError(f'Error in decompress_into: {e}, src={_describe(src)}, n_threads={n_threads}')
+
+
+def _source(src):
+    return str(src) if isinstance(src, Path) else src
+
+
+def _describe(src):
+    return src if isinstance(src, (str, Path)) else f'<{len(memoryview(src))} bytes>'
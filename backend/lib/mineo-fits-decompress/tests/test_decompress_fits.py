@@ -45,3 +45,70 @@ def timeit(label: str, f: Callable, times:int=5):
         records.append(end - start)
     median = sorted(records)[len(records) // 2]
     print(f'{label}: {median}')
+
+
+def make_compressed_fits(path: Path):
+    import numpy
+    data = numpy.random.default_rng(0).integers(0, 1 << 16, (300, 500)).astype(numpy.int32)
+    hdul = pyfits.HDUList([
+        pyfits.PrimaryHDU(),
+        pyfits.CompImageHDU(data, compression_type='GZIP_2'),
+        pyfits.CompImageHDU(data[::-1], compression_type='GZIP_2'),
+    ])
+    hdul.writeto(path)
+    return data
+
+
+def test_decompressed_bytes_from_buffer(tmp_path: Path):
+    import mmap
+    import numpy
+    path = tmp_path / 'compressed.fits'
+    data = make_compressed_fits(path)
+    expected = mineo_fits_decompress.decompressed_bytes(path, n_threads)
+    compressed = path.read_bytes()
+    assert mineo_fits_decompress.decompressed_bytes_from_buffer(compressed, n_threads) == expected
+    assert mineo_fits_decompress.decompressed_bytes_from_buffer(memoryview(compressed)[:], 0) == expected
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        assert mineo_fits_decompress.decompressed_bytes_from_buffer(mm, n_threads) == expected
+    hdul = pyfits.HDUList.fromstring(expected)
+    numpy.testing.assert_array_equal(hdul[1].data, data)
+    numpy.testing.assert_array_equal(hdul[2].data, data[::-1])
+
+
+def test_decompressed_bytes_from_broken_buffer():
+    import pytest
+    with pytest.raises(RuntimeError):
+        mineo_fits_decompress.decompressed_bytes_from_buffer(b'not a fits file' * 100, n_threads)
+
+
+def test_decompress_into(tmp_path: Path):
+    import numpy
+    import pytest
+    path = tmp_path / 'compressed.fits'
+    make_compressed_fits(path)
+    expected = mineo_fits_decompress.decompressed_bytes(path, n_threads)
+    compressed = path.read_bytes()
+    size = mineo_fits_decompress.decompressed_size(compressed)
+    assert size == len(expected) == mineo_fits_decompress.decompressed_size(path)
+    # 同じbufferを使い回せる
+    out = numpy.zeros(size + 100, dtype=numpy.uint8)
+    for src in [path, compressed]:
+        out[:] = 0
+        assert mineo_fits_decompress.decompress_into(src, out, n_threads) == size
+        assert out[:size].tobytes() == expected
+    with pytest.raises(ValueError):
+        mineo_fits_decompress.decompress_into(compressed, bytearray(size - 1), n_threads)
+    with pytest.raises(TypeError):
+        mineo_fits_decompress.decompress_into(compressed, compressed, n_threads)
+
+
+def test_decompress_in_threads(tmp_path: Path):
+    from concurrent.futures import ThreadPoolExecutor
+    path = tmp_path / 'compressed.fits'
+    make_compressed_fits(path)
+    compressed = path.read_bytes()
+    expected = mineo_fits_decompress.decompressed_bytes(path, 1)
+    # GILを解放している間に他のスレッドが同時に展開する
+    with ThreadPoolExecutor(4) as executor:
+        results = [*executor.map(lambda _: mineo_fits_decompress.decompressed_bytes_from_buffer(compressed, 1), range(32))]
+    assert all(r == expected for r in results)
@@ -17,6 +17,7 @@ os.environ['http_proxy'] = ''
 class Config(BaseSettings):
     environment: Literal['production', 'test'] = 'production'
     frontend_port: int = 9500
+    frontend_workers: int = 1
     generator_port: int = 9502
     coordinator_base_url: str = 'http://localhost:9501'
 
@@ -55,15 +56,31 @@ class Config(BaseSettings):
     tile_ccd_processing_parallel: int = 32
     tile_compression_level: int = 9
     tile_merge_parallel: int = 8
+    tile_accumulate_min_level: int | None = 3  # このlevel以上のタイルはgeneratorのCCDの和を1つだけ持つ。Noneなら全てCCDごと。0にすると焦点面全体で約19GBのsparse fileになる
+    tile_single_ccd_fast_path: bool = True  # 1つのCCDだけが重なるタイルはmergeを通さずにgenerateで圧縮してmerged storageに書き込む
+    generator_supervisor: bool = True  # generatorのタスクを常駐プロセスで、予め起動したworker poolを使って実行する
     tile_pack: int = 2  # tile_packed**2個のタイルがまとまってobject storageに保存される
 
+    storage_io_parallel: int = 16  # frontendでobject storageの読み込みに使うスレッド数
+    tile_cache_dir: str = '/dev/shm/quicklook/tile_cache'  # used in frontend. 同じpodのworkerで共有される
+    tile_cache_max_bytes: int = 256 * 1024 * 1024  # used in frontend
+
     tile_tmpdir: str = '/dev/shm/quicklook/tile_tmp'  # used in generator
     tile_merged_dir: str = '/tmp/quicklook/merged'  # used in generator
     fits_header_tmpdir: str = '/dev/shm/quicklook/fits_header'  # used in generator
+    raw_cache_dir: str = '/tmp/quicklook/raw_cache'  # used in generator. ダウンロードしたFITSファイルをローカルディスクにキャッシュする
+    raw_cache_max_bytes: int = 0  # used in generator. 0ならキャッシュしない
 
-    fitsio_tmpdir: str = '/dev/shm/quicklook/fitsio'  # used in generator
     fitsio_decompress_parallel: int = 4
-
+    image_stat_method: Literal['exact', 'sample'] = 'sample'  # CCDのmedian/MADの求め方。表示のスケールにしか使わないのでsampleで十分
+
+    job_scheduling: Literal['barrier', 'dataflow'] = 'barrier'  # dataflowではCCDの処理が終わったタイルから順にmerge/transferする
+    ccd_partitioner: Literal['index', 'hilbert'] = 'hilbert'  # CCDをgeneratorに割り当てる方法。hilbertでは焦点面上で近いCCDが同じgeneratorに割り当てられる
+    generate_ccd_assignment: Literal['static', 'pull'] = 'static'  # pullではgeneratorが空いた分だけcoordinatorからCCDを受け取る
+    generate_pull_prefetch: int = 2  # pullのとき、処理中のCCDの他に先に受け取っておくCCDの数
+    generate_download_parallel_min: int = 1  # CCDのダウンロードの並列数は、スループットを見てこの範囲で調整される
+    generate_download_parallel_max: int = 8  # tile_ccd_processing_parallel + generate_pull_prefetch より小さいこと
+    job_coarse_min_level: int | None = None  # dataflowのときのみ有効。このlevel以上のタイルを先に作り、公開する
     job_max_ram_limit_stage: int = 4
     job_max_disk_limit_stage: int = 50
     max_storage_entries: int = 40
@@ -88,6 +105,10 @@ class Config(BaseSettings):
 
     heartbeat_interval: float = 10
 
+    http_pool_limit: int = 100  # pod間通信でプロセスごとに保持する接続の上限
+    http_pool_limit_per_host: int = 32
+    ready_visits_refresh_interval: float = 60  # frontendがreadyなvisitの一覧をDBと同期する間隔
+
     @cached_property
     def coordinator_port(self) -> int:
         return int(self.coordinator_base_url.split(':')[-1])
@@ -4,6 +4,7 @@ from fastapi import FastAPI
 
 from quicklook.config import config
 from quicklook.coordinator.housekeep import clear_imcomplete_quicklooks
+from quicklook.utils.http_request import activate_client_session
 
 from .generators import activate_context
 from .generators import router as context_router
@@ -15,7 +16,7 @@ from .quicklooks import router as quicklooks_router
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await clear_imcomplete_quicklooks()
-    async with activate_context():
+    async with activate_client_session(), activate_context():
         yield
 
 
@@ -12,6 +12,7 @@ from pydantic import BaseModel
 from quicklook.config import config
 from quicklook.types import GeneratorPod
 from quicklook.utils.asynctask import cancel_at_exit
+from quicklook.utils.http_request import client_session
 
 logger = logging.getLogger('uvicorn')
 
@@ -36,7 +37,7 @@ class CoordinatorContext:
     # generatorsの状態を確認
     async def _check_generators(self):
         async def check_generator(generator: GeneratorPod):  # pragma: no cover
-            async with aiohttp.ClientSession() as session:
+            async with client_session() as session:
                 try:
                     async with session.get(
                         f'http://{generator.host}:{generator.port}/healthz',
@@ -6,6 +6,7 @@ from pydantic import BaseModel
 
 from quicklook.coordinator.api.generators import ctx
 from quicklook.types import GeneratorPod
+from quicklook.utils.http_request import client_session
 from quicklook.utils.timeit import timeit
 
 
@@ -26,7 +27,7 @@ async def healthz():
 async def ready():
     async def generator_health(g: GeneratorPod) -> GeneratorHealth:
         with timeit(f'ready {g.host}:{g.port}'):
-            async with aiohttp.ClientSession() as session:
+            async with client_session() as session:
                 try:
                     async with session.get(
                         f'http://{g.host}:{g.port}/ready',
@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from quicklook.coordinator.api.generators import ctx
 from quicklook.mutableconfig import update_mutable_config
 from quicklook.types import GeneratorPod
+from quicklook.utils.http_request import client_session
 from quicklook.utils.timeit import timeit
 
 router = APIRouter()
@@ -21,7 +22,7 @@ async def update_mutable_config_route(params: MutableConfigUpdate):
     update_mutable_config(params.new)
 
     async def update_generator_mutable_config(g: GeneratorPod):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.post(
                 f'http://{g.host}:{g.port}/mutable-config',
                 raise_for_status=True,
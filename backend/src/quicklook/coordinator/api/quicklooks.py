@@ -10,6 +10,7 @@ from sqlalchemy import delete
 
 from quicklook import storage
 from quicklook.coordinator.api.generators import ctx
+from quicklook.coordinator.quicklookjob.ccdworkqueue import ccd_work_queue
 from quicklook.coordinator.quicklookjob.job import QuicklookJobReport
 from quicklook.db import db_context
 from quicklook.models import QuicklookRecord
@@ -33,6 +34,20 @@ async def create_quicklook(params: QuicklookCreate, background_tasks: Background
     background_tasks.add_task(job_runner.enqueue, visit)
 
 
+class CcdAssignmentRequest(BaseModel):
+    generator: GeneratorPod
+    n: int = 1
+
+
+@router.post("/quicklooks/{id}/ccd-assignments", response_model=list[str])
+async def assign_ccds(id: str, params: CcdAssignmentRequest):
+    # generate_ccd_assignment == 'pull' のときにgeneratorが処理するCCDを取りに来る
+    q = ccd_work_queue(Visit.from_id(id))
+    if q is None:
+        return []
+    return q.take(params.generator, params.n)
+
+
 @router.get("/quicklooks", response_model=list[QuicklookJobReport])
 async def list_quicklooks():
     return [*job_runner.entries()]
@@ -3,7 +3,6 @@ import logging
 from datetime import datetime, timedelta
 from typing import Iterable
 
-import aiohttp
 from sqlalchemy import delete, select, update
 
 from quicklook import storage
@@ -12,6 +11,7 @@ from quicklook.coordinator.quicklookjob.job import QuicklookJob
 from quicklook.db import db_context
 from quicklook.models import QuicklookRecord
 from quicklook.types import GeneratorPod, Visit
+from quicklook.utils.http_request import client_session
 from quicklook.utils.timeit import timeit
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
@@ -106,7 +106,7 @@ async def cleanup_job(
     db_entry: bool = False,
 ):
     async def run_1_task(g: GeneratorPod):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.delete(
                 f'http://{g.host}:{g.port}/quicklooks/{job.visit.id}',
                 json={'tmp_tile': tmp_tile, 'merged_tile': merged_tile},
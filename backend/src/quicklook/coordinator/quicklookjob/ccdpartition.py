@@ -0,0 +1,92 @@
+'''
+Assignment of CCDs to generators.
+
+A tile covered by CCDs of two or more generators has to be gathered from all of them in the merge phase,
+so the CCDs of a generator should form a compact region of the focal plane.
+'''
+
+from collections import defaultdict
+from functools import cache
+from typing import Literal, TypeVar
+
+from quicklook.generator.iteratetiles import tile_ranges
+from quicklook.tileinfo import ccd_list, ccds_by_name
+
+G = TypeVar('G')
+
+CcdPartitioner = Literal['index', 'hilbert']
+
+
+def partition_ccds(ccd_names: list[str], n: int, *, method: CcdPartitioner) -> list[list[str]]:
+    '''
+    Splits `ccd_names` into `n` lists of almost the same size.
+
+    - index: contiguous slices of `ccd_names` as given.
+    - hilbert: contiguous slices of `ccd_names` sorted along a Hilbert curve over the focal plane.
+      CCDs that are not in ccd-info.json are put at the end.
+    '''
+    if method == 'hilbert':
+        ccd_names = sorted(ccd_names, key=_hilbert_key)
+    nc = len(ccd_names)
+    return [ccd_names[i * nc // n : (i + 1) * nc // n] for i in range(n)]
+
+
+def count_cross_generator_tiles(ccd_generator_map: dict[str, G]) -> int:
+    '''
+    Number of tiles (of all levels) covered by CCDs of two or more generators.
+    '''
+    owners: dict[tuple[int, int, int], set[G]] = defaultdict(set)
+    for ccd_name, g in ccd_generator_map.items():
+        ccd = ccds_by_name().get(ccd_name)
+        if ccd is None:  # pragma: no cover
+            continue
+        b = ccd.bbox
+        for level, ri, rj in tile_ranges(int(b.miny), int(b.maxy) + 1, int(b.minx), int(b.maxx) + 1):
+            for i in ri:
+                for j in rj:
+                    owners[level, i, j].add(g)
+    return sum(1 for gs in owners.values() if len(gs) > 1)
+
+
+_hilbert_order = 10  # 焦点面を 2^10 x 2^10 の格子に分けて曲線上の位置を決める
+
+
+def _hilbert_key(ccd_name: str) -> tuple[int, int, str]:
+    ccd = ccds_by_name().get(ccd_name)
+    if ccd is None:
+        return (1, 0, ccd_name)
+    x0, y0, x1, y1 = _focal_plane_extent()
+    cells = 1 << _hilbert_order
+    cx = (ccd.bbox.minx + ccd.bbox.maxx) / 2
+    cy = (ccd.bbox.miny + ccd.bbox.maxy) / 2
+    x = min(cells - 1, int((cx - x0) / (x1 - x0) * cells))
+    y = min(cells - 1, int((cy - y0) / (y1 - y0) * cells))
+    return (0, _hilbert_index(_hilbert_order, x, y), ccd_name)
+
+
+@cache
+def _focal_plane_extent() -> tuple[float, float, float, float]:
+    ccds = ccd_list()
+    return (
+        min(c.bbox.minx for c in ccds),
+        min(c.bbox.miny for c in ccds),
+        max(c.bbox.maxx for c in ccds),
+        max(c.bbox.maxy for c in ccds),
+    )
+
+
+def _hilbert_index(order: int, x: int, y: int) -> int:
+    # https://en.wikipedia.org/wiki/Hilbert_curve の xy2d
+    d = 0
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
@@ -0,0 +1,71 @@
+'''
+CCD assignment on demand (config.generate_ccd_assignment == 'pull').
+
+Each generator owns a partition of the CCDs as in the static assignment and takes its own CCDs first.
+When its partition is empty, it steals from the tail of the partition that has the most CCDs left,
+so that the generate phase finishes at the pace of the aggregate capacity rather than the slowest generator.
+'''
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator
+
+from quicklook.types import GeneratorPod, Visit
+
+
+class CcdWorkQueue:
+    def __init__(self, partitions: dict[GeneratorPod, list[str]], ccd_generator_map: dict[str, GeneratorPod]) -> None:
+        self._partitions = {g: deque(ccd_names) for g, ccd_names in partitions.items()}
+        self._ccd_generator_map = ccd_generator_map  # 割り当てたCCDはここに書き込まれる
+        self._assigned: dict[GeneratorPod, list[str]] = {g: [] for g in partitions}
+
+    def take(self, generator: GeneratorPod, n: int = 1) -> list[str]:
+        '''
+        Assigns at most `n` CCDs to `generator`. An empty list means that there is no more work.
+        '''
+        taken: list[str] = []
+        own = self._partitions.get(generator)
+        while len(taken) < n:
+            if own:
+                taken.append(own.popleft())
+                continue
+            victim = max(self._partitions.values(), key=len, default=None)
+            if not victim:
+                break
+            taken.append(victim.pop())
+        for ccd_name in taken:
+            self._ccd_generator_map[ccd_name] = generator
+        self._assigned.setdefault(generator, []).extend(taken)
+        return taken
+
+    def requeue(self, generator: GeneratorPod) -> None:
+        '''
+        Puts back the CCDs assigned to `generator`. Used when its task is retried.
+        The retried task makes the tiles of the visit again, so the CCDs it has already processed are put back too.
+        '''
+        assigned = self._assigned.get(generator, [])
+        own = self._partitions.setdefault(generator, deque())
+        own.extendleft(reversed(assigned))
+        for ccd_name in assigned:
+            self._ccd_generator_map.pop(ccd_name, None)
+        self._assigned[generator] = []
+
+    @property
+    def num_remaining(self) -> int:
+        return sum(len(p) for p in self._partitions.values())
+
+
+_queues: dict[Visit, CcdWorkQueue] = {}
+
+
+@contextmanager
+def open_ccd_work_queue(visit: Visit, q: CcdWorkQueue) -> Iterator[CcdWorkQueue]:
+    _queues[visit] = q
+    try:
+        yield q
+    finally:
+        del _queues[visit]
+
+
+def ccd_work_queue(visit: Visit) -> CcdWorkQueue | None:
+    return _queues.get(visit)
@@ -28,11 +28,19 @@ class QuicklookJob(BaseModel):
     merge_progress: dict[str, MergeProgress] | None = None
     transfer_progress: dict[str, TransferProgress] | None = None
 
+    ccd_names: list[str] | None = None
+    # generateするCCD
+    # pullモードではccd_generator_mapはCCDがgeneratorに渡されるたびに埋まっていく
+
     ccd_generator_map: dict[str, GeneratorPod] | None = None
     # ccd_name -> GeneratorPod
     # どのGeneratorがどのCCDを処理するかを示す
     # transferreing中にFrontendがどのどこからデータを取得するかを知るために必要
 
+    published_min_level: int | None = None
+    # このlevel以上のタイルは全てstorageに転送済み
+    # READYになる前でもFrontendはこれらのタイルをstorageから返せる
+
 
 @dataclass
 class QuicklookJobReport:
@@ -44,6 +52,7 @@ class QuicklookJobReport:
     generate_progress: dict[str, GenerateProgress] | None
     merge_progress: dict[str, MergeProgress] | None
     transfer_progress: dict[str, TransferProgress] | None
+    published_min_level: int | None = None
 
     @classmethod
     def from_job(cls, job: QuicklookJob) -> 'QuicklookJobReport':
@@ -54,5 +63,6 @@ class QuicklookJobReport:
             generate_progress=job.generate_progress,
             transfer_progress=job.transfer_progress,
             merge_progress=job.merge_progress,
+            published_min_level=job.published_min_level,
         )
     
\ No newline at end of file
@@ -0,0 +1,184 @@
+'''
+Dataflow scheduling of a quicklook job (config.job_scheduling == 'dataflow').
+
+In the barrier mode, merge starts after every CCD of the visit has been processed
+and transfer starts after every tile has been merged.
+In this mode a tile is merged as soon as all the CCDs that may contribute to it have been processed,
+and a packed tile is transferred as soon as all of its tiles have been merged.
+Phases are still reported in the same order as the barrier mode,
+e.g. MERGE_DONE means that all the tiles have been merged.
+A generate task that times out after it has reported some CCDs is not retried and the job fails,
+because the retried task would remake the tiles that may already have been merged.
+
+If config.job_coarse_min_level is set, the generators make the tiles of the coarse levels first,
+so that they are merged and transferred while the full-resolution tiles are being made.
+job.published_min_level tells the frontend which levels can already be served from the storage.
+'''
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from quicklook.config import config
+from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
+from quicklook.coordinator.quicklookjob.job_generate import job_generate
+from quicklook.coordinator.quicklookjob.job_merge import run_merge_task
+from quicklook.coordinator.quicklookjob.job_transfer import run_transfer_task
+from quicklook.coordinator.quicklookjob.tasks import MergeTask, TransferTask
+from quicklook.coordinator.quicklookjob.tiledependencies import Released, TileDependencies
+from quicklook.types import CcdCoarseDone, CcdMeta, GeneratorPod, MergeProgress, PackedTileId, Progress, TileId, TransferProgress
+
+logger = logging.getLogger(f'uvicorn.{__name__}')
+
+T = TypeVar('T')
+
+
+class _Batches(Generic[T]):
+    '''
+    Work queue whose consumer takes all the queued items at once.
+    '''
+
+    def __init__(self) -> None:
+        self._items: list[T] = []
+        self._closed = False
+        self._event = asyncio.Event()
+
+    def put(self, items: list[T]) -> None:
+        assert not self._closed
+        self._items.extend(items)
+        self._event.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._event.set()
+
+    async def take(self) -> list[T] | None:
+        while not self._items and not self._closed:
+            self._event.clear()
+            await self._event.wait()
+        if not self._items:
+            return None
+        items, self._items = self._items, []
+        return items
+
+
+async def job_dataflow(
+    job: QuicklookJob,
+    sync_job: Callable[[QuicklookJob], None],
+    *,
+    on_generate_done: Callable[[], Awaitable[None]],
+    on_merge_done: Callable[[], Awaitable[None]],
+):
+    deps: TileDependencies | None = None
+    merge_queues: dict[GeneratorPod, _Batches[TileId]] = {}
+    transfer_queues: dict[GeneratorPod, _Batches[PackedTileId]] = {}
+    merge_workers: list[asyncio.Task] = []
+    transfer_workers: list[asyncio.Task] = []
+    merge_nodes: dict[str, MergeProgress] = {}
+    transfer_nodes: dict[str, TransferProgress] = {}
+
+    def dependencies() -> TileDependencies:
+        nonlocal deps
+        if deps is None:
+            # job.ccd_generator_map は generate の開始時に作られる（pullモードでは割り当てのたびに埋まっていく）
+            assert job.ccd_generator_map is not None
+            deps = TileDependencies(job.ccd_generator_map, ccd_names=job.ccd_names)
+            logger.info(f'dataflow {job.visit.id}: {deps.num_tiles} tiles')
+        return deps
+
+    async def merge_worker(g: GeneratorPod, q: _Batches[TileId]):
+        done = 0
+        while (tile_ids := await q.take()) is not None:
+            last = Progress(count=0, total=0)
+
+            def on_progress(msg: MergeProgress):
+                nonlocal last
+                last = msg.merge
+                merge_nodes[g.name] = MergeProgress(merge=Progress(count=done + last.count, total=done + last.total))
+                job.merge_progress = merge_nodes
+                sync_job(job)
+
+            assert job.ccd_generator_map
+            await run_merge_task(MergeTask(visit=job.visit, generator=g, ccd_generator_map=job.ccd_generator_map, tile_ids=tile_ids), on_progress)
+            done += last.total
+            for owner, packed_ids in dependencies().tiles_merged(tile_ids).items():
+                transfer_queue(owner).put(packed_ids)
+
+    async def transfer_worker(g: GeneratorPod, q: _Batches[PackedTileId]):
+        done = 0
+        while (packed_ids := await q.take()) is not None:
+            last = Progress(count=0, total=0)
+
+            def on_progress(msg: TransferProgress):
+                nonlocal last
+                last = msg.transfer
+                transfer_nodes[g.name] = TransferProgress(transfer=Progress(count=done + last.count, total=done + last.total))
+                job.transfer_progress = transfer_nodes
+                sync_job(job)
+
+            assert job.ccd_generator_map
+            await run_transfer_task(TransferTask(visit=job.visit, generator=g, ccd_generator_map=job.ccd_generator_map, packed_ids=packed_ids), on_progress)
+            done += last.total
+            dependencies().packs_transferred(packed_ids)
+            published_min_level = dependencies().published_min_level()
+            if published_min_level != job.published_min_level:
+                logger.info(f'dataflow {job.visit.id}: level >= {published_min_level} published')
+                job.published_min_level = published_min_level
+                sync_job(job)
+
+    async with asyncio.TaskGroup() as tg:
+
+        def merge_queue(g: GeneratorPod) -> _Batches[TileId]:
+            if g not in merge_queues:
+                merge_queues[g] = _Batches()
+                merge_workers.append(tg.create_task(merge_worker(g, merge_queues[g])))
+            return merge_queues[g]
+
+        def transfer_queue(g: GeneratorPod) -> _Batches[PackedTileId]:
+            if g not in transfer_queues:
+                transfer_queues[g] = _Batches()
+                transfer_workers.append(tg.create_task(transfer_worker(g, transfer_queues[g])))
+            return transfer_queues[g]
+
+        def release(released: Released):
+            for g, tile_ids in released.to_merge.items():
+                merge_queue(g).put(tile_ids)
+            for g, packed_ids in released.to_transfer.items():
+                transfer_queue(g).put(packed_ids)
+
+        def on_ccd_done(meta: CcdMeta):
+            release(dependencies().ccd_done(meta.ccd_id.ccd_name))
+
+        def on_ccd_coarse_done(msg: CcdCoarseDone):
+            assert coarse_min_level is not None
+            release(dependencies().ccd_done(msg.ccd_id.ccd_name, min_level=coarse_min_level))
+
+        coarse_min_level = config.job_coarse_min_level
+        await job_generate(
+            job,
+            sync_job,
+            on_ccd_done=on_ccd_done,
+            coarse_min_level=coarse_min_level,
+            on_ccd_coarse_done=on_ccd_coarse_done,
+        )
+        release(dependencies().release_all_tiles())
+        await on_generate_done()
+
+        job.phase = QuicklookJobPhase.MERGE_RUNNING
+        sync_job(job)
+        for q in merge_queues.values():
+            q.close()
+        await asyncio.gather(*merge_workers)
+        job.merge_progress = None
+        job.phase = QuicklookJobPhase.MERGE_DONE
+        sync_job(job)
+        await on_merge_done()
+
+        job.phase = QuicklookJobPhase.TRANSFER_RUNNING
+        sync_job(job)
+        for q in transfer_queues.values():
+            q.close()
+        await asyncio.gather(*transfer_workers)
+        job.transfer_progress = None
+        job.phase = QuicklookJobPhase.TRANSFER_DONE
+        sync_job(job)
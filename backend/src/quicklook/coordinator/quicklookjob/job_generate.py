@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import dataclasses
 import logging
 from dataclasses import asdict
 from typing import Callable
@@ -8,28 +10,46 @@ import aiohttp
 from quicklook import storage
 from quicklook.config import config
 from quicklook.coordinator.api.generators import get_generators
+from quicklook.coordinator.quicklookjob.ccdpartition import count_cross_generator_tiles, partition_ccds
+from quicklook.coordinator.quicklookjob.ccdworkqueue import CcdWorkQueue, open_ccd_work_queue
 from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
 from quicklook.coordinator.quicklookjob.tasks import GenerateTask
 from quicklook.datasource import get_datasource
 from quicklook.generator.progress import GenerateProgress
-from quicklook.types import CcdMeta, GenerateTaskResponse, GeneratorPod, QuicklookMeta
+from quicklook.types import CcdCoarseDone, CcdMeta, GenerateTaskResponse, GeneratorPod, QuicklookMeta
+from quicklook.utils.http_request import client_session
 from quicklook.utils.message import message_from_async_reader
 from quicklook.utils.timeit import timeit
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
 
 
-async def job_generate(job: QuicklookJob, sync_job: Callable[[QuicklookJob], None]):
+async def job_generate(
+    job: QuicklookJob,
+    sync_job: Callable[[QuicklookJob], None],
+    *,
+    on_ccd_done: Callable[[CcdMeta], None] | None = None,
+    coarse_min_level: int | None = None,
+    on_ccd_coarse_done: Callable[[CcdCoarseDone], None] | None = None,
+):
     job.phase = QuicklookJobPhase.GENERATE_RUNNING
     sync_job(job)
-    process_ccd_results = await _scatter_generate_job(job, sync_job)
+    process_ccd_results = await _scatter_generate_job(
+        job,
+        sync_job,
+        on_ccd_done=on_ccd_done,
+        coarse_min_level=coarse_min_level,
+        on_ccd_coarse_done=on_ccd_coarse_done,
+    )
+    assert job.ccd_generator_map is not None
+    logger.info(f'{job.visit.id}: {count_cross_generator_tiles(job.ccd_generator_map)} tiles are shared by generators')
     storage.put_quicklook_meta(job.visit, QuicklookMeta(ccd_meta=process_ccd_results))
     job.generate_progress = None
     job.phase = QuicklookJobPhase.GENERATE_DONE
     sync_job(job)
 
 
-def _make_generate_tasks(job: QuicklookJob, generators: list[GeneratorPod]):
+def _make_generate_tasks(job: QuicklookJob, generators: list[GeneratorPod], *, coarse_min_level: int | None = None):
     ds = get_datasource()
 
     visit = job.visit
@@ -40,27 +60,41 @@ def _make_generate_tasks(job: QuicklookJob, generators: list[GeneratorPod]):
     if config.dev_ccd_limit is not None:  # pragma: no cover
         ccd_names_for_visit = ccd_names_for_visit[: config.dev_ccd_limit]
 
-    ng = len(generators)
-    nc = len(ccd_names_for_visit)
-
     tasks: list[GenerateTask] = []
     ccd_generator_map: dict[str, GeneratorPod] = {}
+    pull = config.generate_ccd_assignment == 'pull'
 
-    for i, g in enumerate(generators):
-        ccd_names = [ccd_name for ccd_name in ccd_names_for_visit[i * nc // ng : (i + 1) * nc // ng]]
-        task = GenerateTask(generator=g, visit=visit, ccd_names=ccd_names)
+    for g, ccd_names in zip(generators, partition_ccds(ccd_names_for_visit, len(generators), method=config.ccd_partitioner)):
+        # pullモードではccd_namesはそのgeneratorが最初に受け取るCCDで、割り当ては受け取ったときに決まる
+        task = GenerateTask(generator=g, visit=visit, ccd_names=ccd_names, coarse_min_level=coarse_min_level, pull=pull)
         tasks.append(task)
-        for ccd_name in ccd_names:
-            ccd_generator_map[ccd_name] = g
+        if not pull:
+            for ccd_name in ccd_names:
+                ccd_generator_map[ccd_name] = g
 
     return tasks, ccd_generator_map
 
 
-async def _scatter_generate_job(job: QuicklookJob, sync_job: Callable[[QuicklookJob], None]) -> list[CcdMeta]:
+async def _scatter_generate_job(
+    job: QuicklookJob,
+    sync_job: Callable[[QuicklookJob], None],
+    *,
+    on_ccd_done: Callable[[CcdMeta], None] | None = None,
+    coarse_min_level: int | None = None,
+    on_ccd_coarse_done: Callable[[CcdCoarseDone], None] | None = None,
+) -> list[CcdMeta]:
     nodes: dict[str, GenerateProgress] = {}
-    tasks, ccd_generator_map = _make_generate_tasks(job, get_generators())
+    tasks, ccd_generator_map = _make_generate_tasks(job, get_generators(), coarse_min_level=coarse_min_level)
     assert len(get_generators()) > 0
+    job.ccd_names = [ccd_name for task in tasks for ccd_name in task.ccd_names]
     job.ccd_generator_map = ccd_generator_map
+    work_queue: CcdWorkQueue | None = None
+    if config.generate_ccd_assignment == 'pull':
+        work_queue = CcdWorkQueue({task.generator: task.ccd_names for task in tasks}, job.ccd_generator_map)
+        tasks = [dataclasses.replace(task, ccd_names=[]) for task in tasks]
+
+    # dataflowでCCDの終了を通知したgenerator。そのタイルはもうmergeに回っているかもしれない
+    reported: set[GeneratorPod] = set()
 
     async def run_1_task(task: GenerateTask):
         for _ in range(5):
@@ -68,11 +102,16 @@ async def _scatter_generate_job(job: QuicklookJob, sync_job: Callable[[Quicklook
                 return await run_1_task_noretry(task)
             except aiohttp.ServerTimeoutError:
                 logger.warning(f'ClientTimeout for {task}')
+                if task.generator in reported:
+                    # やり直すとgeneratorはvisitのtmp storageを作り直すので、mergeに回ったタイルが消えてしまう
+                    raise RuntimeError(f'ClientTimeout for {task} after some of its CCDs were reported done')
+                if work_queue:
+                    work_queue.requeue(task.generator)
 
         raise RuntimeError(f'ClientTimeout for {task} after 5 retries')
 
     async def run_1_task_noretry(task: GenerateTask):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.post(
                 f'http://{task.generator.host}:{task.generator.port}/quicklooks',
                 json=asdict(task),
@@ -93,11 +132,19 @@ async def _scatter_generate_job(job: QuicklookJob, sync_job: Callable[[Quicklook
                             sync_job(job)
                         case CcdMeta():
                             process_ccd_results.append(msg)
+                            if on_ccd_done:
+                                reported.add(task.generator)
+                                on_ccd_done(msg)
+                        case CcdCoarseDone():
+                            if on_ccd_coarse_done:
+                                reported.add(task.generator)
+                                on_ccd_coarse_done(msg)
                         case _:  # pragma: no cover
                             raise TypeError(f'Unexpected message: {msg}')
                 return process_ccd_results
 
     gathered_results: list[CcdMeta] = []
-    for fut in asyncio.as_completed([run_1_task(task) for task in tasks]):
-        gathered_results.extend(await fut)
+    with open_ccd_work_queue(job.visit, work_queue) if work_queue else contextlib.nullcontext():
+        for fut in asyncio.as_completed([run_1_task(task) for task in tasks]):
+            gathered_results.extend(await fut)
     return gathered_results
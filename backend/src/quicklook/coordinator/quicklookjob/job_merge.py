@@ -9,6 +9,7 @@ from quicklook import storage
 from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
 from quicklook.coordinator.quicklookjob.tasks import MergeTask
 from quicklook.types import GeneratorPod, MergeProgress, MergeTaskResponse
+from quicklook.utils.http_request import client_session
 from quicklook.utils.message import message_from_async_reader
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
@@ -30,36 +31,44 @@ async def _scatter_merge_job(job: QuicklookJob, sync_job: Callable[[QuicklookJob
     nodes: dict[str, MergeProgress] = {}
 
     async def run_1_task(g: GeneratorPod):
-        for _ in range(5):
-            try:
-                return await run_1_task_noretry(g)
-            except aiohttp.ServerTimeoutError:
-                logger.warning(f'ClientTimeout for {g}')
-
-        raise RuntimeError(f'ClientTimeout for {g} after 5 retries')
-
-    async def run_1_task_noretry(g: GeneratorPod):
-        task = MergeTask(generator=g, visit=job.visit, ccd_generator_map=ccd_generator_map)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f'http://{g.host}:{g.port}/quicklooks/merge',
-                json=asdict(task),
-                raise_for_status=True,
-                timeout=aiohttp.ClientTimeout(total=3600),
-            ) as res:
-                while True:
-                    msg: MergeTaskResponse = await message_from_async_reader(res.content.readexactly)
-                    match msg:
-                        case None:
-                            break
-                        case BaseException():  # pragma: no cover
-                            raise msg
-                        case MergeProgress():
-                            nodes[g.name] = msg
-                            job.merge_progress = nodes
-                            sync_job(job)
-                        case _:  # pragma: no cover
-                            raise TypeError(f'Unexpected message: {msg}')
+        def on_progress(msg: MergeProgress):
+            nodes[g.name] = msg
+            job.merge_progress = nodes
+            sync_job(job)
+
+        await run_merge_task(MergeTask(generator=g, visit=job.visit, ccd_generator_map=ccd_generator_map), on_progress)
 
     generators = [*set(ccd_generator_map.values())]
     await asyncio.gather(*(run_1_task(g) for g in generators))
+
+
+async def run_merge_task(task: MergeTask, on_progress: Callable[[MergeProgress], None]):
+    for _ in range(5):
+        try:
+            return await _run_merge_task_noretry(task, on_progress)
+        except aiohttp.ServerTimeoutError:
+            logger.warning(f'ClientTimeout for {task.generator}')
+
+    raise RuntimeError(f'ClientTimeout for {task.generator} after 5 retries')
+
+
+async def _run_merge_task_noretry(task: MergeTask, on_progress: Callable[[MergeProgress], None]):
+    g = task.generator
+    async with client_session() as session:
+        async with session.post(
+            f'http://{g.host}:{g.port}/quicklooks/merge',
+            json=asdict(task),
+            raise_for_status=True,
+            timeout=aiohttp.ClientTimeout(total=3600),
+        ) as res:
+            while True:
+                msg: MergeTaskResponse = await message_from_async_reader(res.content.readexactly)
+                match msg:
+                    case None:
+                        break
+                    case BaseException():  # pragma: no cover
+                        raise msg
+                    case MergeProgress():
+                        on_progress(msg)
+                    case _:  # pragma: no cover
+                        raise TypeError(f'Unexpected message: {msg}')
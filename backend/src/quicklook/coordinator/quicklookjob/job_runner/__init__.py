@@ -18,6 +18,7 @@ from quicklook.utils.orderedsemaphore import OrderedSemaphore
 
 from ...housekeep import housekeep
 from ..job import QuicklookJob, QuicklookJobPhase, QuicklookJobReport
+from ..job_dataflow import job_dataflow
 from ..job_generate import job_generate
 from ..job_merge import job_merge
 from ..job_transfer import job_transfer
@@ -73,6 +74,17 @@ class JobRunner:
                 await housekeep()
 
     async def _run_job_main_flow(self, job: QuicklookJob) -> None:
+        if config.job_scheduling == 'dataflow':
+            await self._run_dataflow(job)
+        else:
+            await self._run_barriers(job)
+        job.phase = QuicklookJobPhase.READY
+        storage.save_quicklook_job(job)
+        self._update_job_phase(job, QuicklookJobPhase.READY)
+        _update_job_record_phase(job, 'ready')
+        await cleanup_job(job, tmp_tile=True, merged_tile=True)
+
+    async def _run_barriers(self, job: QuicklookJob) -> None:
         async with _overlapping_semaphore(self._ram_limit) as ram_limit_release:
             await job_generate(job, self._sync_job)
             _update_job_record_phase(job, 'in_progress')
@@ -85,11 +97,24 @@ class JobRunner:
                 self._raise_error_for_test(job, stop_on=QuicklookJobPhase.MERGE_DONE)
                 async with _overlapping_semaphore(self._transfer_limit) as _transfer_limit_release:
                     await job_transfer(job, self._sync_job)
-        job.phase = QuicklookJobPhase.READY
-        storage.save_quicklook_job(job)
-        self._update_job_phase(job, QuicklookJobPhase.READY)
-        _update_job_record_phase(job, 'ready')
-        await cleanup_job(job, tmp_tile=True, merged_tile=True)
+
+    async def _run_dataflow(self, job: QuicklookJob) -> None:
+        # 3つのphaseが重なって進むので、始めに全てのsemaphoreを取る
+        async with (
+            _overlapping_semaphore(self._ram_limit) as ram_limit_release,
+            _overlapping_semaphore(self._disk_limit) as _disk_limit_release,
+            _overlapping_semaphore(self._transfer_limit) as _transfer_limit_release,
+        ):
+
+            async def on_generate_done():
+                _update_job_record_phase(job, 'in_progress')
+                storage.put_quicklook_job_config(job)
+
+            async def on_merge_done():
+                await cleanup_job(job, tmp_tile=True, merged_tile=False)
+                ram_limit_release()
+
+            await job_dataflow(job, self._sync_job, on_generate_done=on_generate_done, on_merge_done=on_merge_done)
 
     def _raise_error_for_test(self, job: QuicklookJob, *, stop_on: QuicklookJobPhase):
         if mutable_config.job_stop_at == stop_on.name:
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from quicklook.types import GeneratorPod, Visit
+from quicklook.types import GeneratorPod, PackedTileId, TileId, Visit
 
 
 @dataclass
@@ -8,6 +8,8 @@ class GenerateTask:
     visit: Visit
     generator: GeneratorPod
     ccd_names: list[str]
+    coarse_min_level: int | None = None  # このlevel以上のタイルを先に作る
+    pull: bool = False  # Trueならccd_namesは使わず、coordinatorから処理するCCDを順に受け取る
 
 
 @dataclass
@@ -15,6 +17,7 @@ class MergeTask:
     visit: Visit
     generator: GeneratorPod
     ccd_generator_map: dict[str, GeneratorPod]
+    tile_ids: list[TileId] | None = None  # Noneなら全てのタイル
 
 
 @dataclass
@@ -22,3 +25,4 @@ class TransferTask:
     visit: Visit
     generator: GeneratorPod
     ccd_generator_map: dict[str, GeneratorPod]
+    packed_ids: list[PackedTileId] | None = None  # Noneならmerged tileがある全てのpacked tile
@@ -0,0 +1,132 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable
+
+from quicklook.config import config
+from quicklook.generator.iteratetiles import tile_ranges
+from quicklook.select_primary_generator import NoOverlappingGenerators, select_primary_generator
+from quicklook.tileinfo import CCD_BBOX_MARGIN, ccds_by_name
+from quicklook.types import GeneratorPod, PackedTileId, TileId
+
+
+@dataclass
+class Released:
+    to_merge: dict[GeneratorPod, list[TileId]]  # primary generator -> tiles
+    to_transfer: dict[GeneratorPod, list[PackedTileId]]
+
+
+class TileDependencies:
+    '''
+    Tracks which tiles can be merged and which packed tiles can be transferred.
+
+    The tiles of a CCD are estimated from its bbox in ccd-info.json widened by `margin` pixels,
+    so that a tile is never released before a CCD that actually touches it has been processed.
+    '''
+
+    def __init__(
+        self,
+        ccd_generator_map: dict[str, GeneratorPod],
+        *,
+        ccd_names: Iterable[str] | None = None,
+        margin: int = CCD_BBOX_MARGIN,
+    ) -> None:
+        self._ccd_generator_map = ccd_generator_map
+        self._tiles_of_ccd: dict[str, list[TileId]] = {}
+        self._waiting: dict[TileId, int] = defaultdict(int)  # tile -> まだ終わっていないCCDの数
+        self._pack_waiting: dict[PackedTileId, int] = defaultdict(int)  # packed tile -> まだmergeされていないタイルの数
+        self._pack_owner: dict[PackedTileId, GeneratorPod] = {}
+        self._untransferred: dict[int, set[PackedTileId]] = defaultdict(set)  # level -> まだ転送されていないpacked tile
+        # ccd_generator_mapがまだ埋まっていない場合（pullモード）はccd_namesを渡す。タイルをmergeに回すときには埋まっている
+        for ccd_name in ccd_generator_map if ccd_names is None else ccd_names:
+            ccd = ccds_by_name().get(ccd_name)
+            if ccd is None:  # pragma: no cover
+                continue
+            b = ccd.bbox
+            y1, y2 = int(b.miny) - margin, int(b.maxy) + 1 + margin
+            x1, x2 = int(b.minx) - margin, int(b.maxx) + 1 + margin
+            tiles = [TileId(level, i, j) for level, ri, rj in tile_ranges(y1, y2, x1, x2) for i in ri for j in rj]
+            self._tiles_of_ccd[ccd_name] = tiles
+            for tile_id in tiles:
+                if self._waiting[tile_id] == 0:
+                    packed_id = PackedTileId.from_unpacked(tile_id.level, tile_id.i, tile_id.j)
+                    self._pack_waiting[packed_id] += 1
+                    self._untransferred[packed_id.level].add(packed_id)
+                self._waiting[tile_id] += 1
+
+    @property
+    def num_tiles(self) -> int:
+        return len(self._waiting)
+
+    def ccd_done(self, ccd_name: str, *, min_level: int = 0) -> Released:
+        '''
+        Marks the tiles of `level >= min_level` of the CCD as made.
+        '''
+        released: list[TileId] = []
+        remaining: list[TileId] = []
+        for tile_id in self._tiles_of_ccd.pop(ccd_name, []):
+            if tile_id.level < min_level:
+                remaining.append(tile_id)
+                continue
+            self._waiting[tile_id] -= 1
+            if self._waiting[tile_id] == 0:
+                released.append(tile_id)
+        if remaining:
+            self._tiles_of_ccd[ccd_name] = remaining
+        return self._assign(released)
+
+    def release_all_tiles(self) -> Released:
+        '''
+        Releases the tiles waiting for CCDs that will never be reported (e.g. failed ones).
+        '''
+        self._tiles_of_ccd.clear()
+        released = [tile_id for tile_id, n in self._waiting.items() if n > 0]
+        for tile_id in released:
+            self._waiting[tile_id] = 0
+        return self._assign(released)
+
+    def tiles_merged(self, tile_ids: list[TileId]) -> dict[GeneratorPod, list[PackedTileId]]:
+        '''
+        Returns the packed tiles that have become ready to be transferred, grouped by the generator that transfers them.
+        '''
+        released: dict[GeneratorPod, list[PackedTileId]] = defaultdict(list)
+        for tile_id in tile_ids:
+            packed_id = PackedTileId.from_unpacked(tile_id.level, tile_id.i, tile_id.j)
+            self._pack_waiting[packed_id] -= 1
+            if self._pack_waiting[packed_id] == 0:
+                owner = self._pack_owner.get(packed_id)
+                if owner:
+                    released[owner].append(packed_id)
+                else:  # どのタイルもgeneratorに割り当てられていなければ転送するものはない
+                    self._untransferred[packed_id.level].discard(packed_id)
+        return released
+
+    def packs_transferred(self, packed_ids: list[PackedTileId]) -> None:
+        for packed_id in packed_ids:
+            self._untransferred[packed_id.level].discard(packed_id)
+
+    def published_min_level(self) -> int | None:
+        '''
+        The lowest level such that all the packed tiles of the level and above have been transferred.
+        None if some packed tiles of the highest level have not been transferred yet.
+        '''
+        published: int | None = None
+        for level in range(config.tile_max_level, -1, -1):
+            if self._untransferred.get(level):
+                break
+            published = level
+        return published
+
+    def _assign(self, tile_ids: list[TileId]) -> Released:
+        to_merge: dict[GeneratorPod, list[TileId]] = defaultdict(list)
+        unassigned: list[TileId] = []
+        for tile_id in tile_ids:
+            try:
+                primary, _ = select_primary_generator(self._ccd_generator_map, tile_id)
+            except NoOverlappingGenerators:
+                # marginのために含めたタイル
+                unassigned.append(tile_id)
+                continue
+            to_merge[primary].append(tile_id)
+            self._pack_owner.setdefault(PackedTileId.from_unpacked(tile_id.level, tile_id.i, tile_id.j), primary)
+        # mergeするものがないタイルはすぐにmerge済みとして扱う
+        return Released(to_merge=to_merge, to_transfer=self.tiles_merged(unassigned))
@@ -54,6 +54,9 @@ class ButlerDataSource(DataSourceBase):  # pragma: no cover
     def get_data(self, ccd_id: CcdId) -> bytes:
         return get_datasource(ccd_id.visit.data_type).get_data(ccd_id)
 
+    def get_data_id(self, ccd_id: CcdId) -> str | None:
+        return get_datasource(ccd_id.visit.data_type).get_data_id(ccd_id)
+
     def get_metadata(self, ccd_id: CcdId) -> DataSourceCcdMetadata:
         return get_datasource(ccd_id.visit.data_type).get_metadata(ccd_id)
 
@@ -140,11 +143,16 @@ class DataTypeSpecificDataSource:
     def get_data(self, ccd_id: CcdId) -> bytes:
         return retrieve_data(self._getUri(ccd_id), partial=self.partial)
 
+    def get_data_id(self, ccd_id: CcdId) -> str:
+        # partialの場合は先頭のHDUだけなので区別する
+        return f'{self._ref(ccd_id).id}{"#partial" if self.partial else ""}'
+
     def _getUri(self, ccd_id: CcdId) -> ResourcePath:
-        b = self._butler
+        return self._butler.getURI(self._ref(ccd_id))  # type: ignore
+
+    def _ref(self, ccd_id: CcdId) -> ButlerDatasetRef:
         detector_id = Instrument.get(default_instrument).ccd_2_detector[ccd_id.ccd_name]
-        ref = self._refs_by_visit(ccd_id.visit)[detector_id]
-        return b.getURI(ref)  # type: ignore
+        return self._refs_by_visit(ccd_id.visit)[detector_id]
 
     @lru_cache(maxsize=4)
     def _refs_by_visit(self, visit: Visit) -> dict[int, ButlerDatasetRef]:
@@ -27,6 +27,9 @@ class DummyDataSource(DataSourceBase):
         else:
             return _s3_get_visit_ccd_fits_raw(ccd_id.visit, ccd_id.ccd_name)
 
+    def get_data_id(self, ccd_id: CcdId) -> str | None:
+        return f"dummy-{ccd_id.visit.id}-{ccd_id.ccd_name}"
+
     def get_metadata(self, ref: CcdId) -> DataSourceCcdMetadata:
         i = Instrument.get("LSSTCam")
         return DataSourceCcdMetadata(
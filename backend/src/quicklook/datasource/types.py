@@ -25,6 +25,13 @@ class DataSourceBase(abc.ABC):
     def get_data(self, ref: CcdId) -> bytes:  # pragma: no cover
         ...
 
+    def get_data_id(self, ref: CcdId) -> str | None:
+        '''
+        Identifier of the contents returned by `get_data` (e.g. the dataset UUID), used as the key of the download cache.
+        None if the contents cannot be identified; they are not cached then.
+        '''
+        return None
+
     @abc.abstractmethod
     def get_metadata(self, ref: CcdId) -> 'DataSourceCcdMetadata':  # pragma: no cover
         ...
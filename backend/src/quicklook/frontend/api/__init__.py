@@ -8,6 +8,7 @@ from quicklook.config import config
 from quicklook.frontend.api.compression import setup_compression
 from quicklook.frontend.api.remotejobs import RemoteQuicklookJobsWatcher
 from quicklook.frontend.api.staticassets import setup_static_assets
+from quicklook.utils.http_request import activate_client_session
 
 from .cache_entries import router as cache_entries_router
 from .get_fits_file import router as get_fits_file_router
@@ -26,7 +27,7 @@ logger = logging.getLogger(f'uvicorn.{__name__}')
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with RemoteQuicklookJobsWatcher().activate():
+    async with activate_client_session(), RemoteQuicklookJobsWatcher().activate():
         yield
 
 
@@ -10,5 +10,6 @@ uvicorn.run(
     port=config.frontend_port,
     access_log=True,
     reload=config.dev_reload,
+    workers=config.frontend_workers,
     log_level=config.log_level,
 )
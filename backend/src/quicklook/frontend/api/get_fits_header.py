@@ -1,12 +1,12 @@
 import logging
 from typing import Annotated
 
-import aiohttp
 from fastapi import APIRouter, Depends, HTTPException, Response
 
 from quicklook import storage
 from quicklook.deps.visit_from_path import visit_from_path
 from quicklook.types import Visit, HeaderType
+from quicklook.utils.http_request import client_session
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
 
@@ -18,7 +18,7 @@ async def get_fits_header(
     visit: Annotated[Visit, Depends(visit_from_path)],
     ccd_name: str,
 ) -> Response:
-    job = storage.get_quicklook_job_config(visit)
+    job = await storage.get_quicklook_job_config_async(visit)
     ccd_generator_map = job.ccd_generator_map
 
     if ccd_generator_map is None:  # pragma: no cover
@@ -29,7 +29,7 @@ async def get_fits_header(
     if generator is None:  # pragma: no cover
         raise HTTPException(status_code=404, detail='CCD not found')
 
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         async with session.get(
             f'http://{generator.name}/quicklooks/{visit.id}/fits_header/{ccd_name}',
             raise_for_status=True,
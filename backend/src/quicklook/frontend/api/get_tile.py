@@ -8,22 +8,19 @@ from typing import Annotated
 import aiohttp
 import numpy
 from fastapi import APIRouter, Depends, HTTPException, Response, status
-from sqlalchemy import select
 
 from quicklook import storage
 from quicklook.config import config
-from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
-from quicklook.db import db_context
+from quicklook.coordinator.quicklookjob.job import QuicklookJobPhase
 from quicklook.deps.visit_from_path import visit_from_path
 from quicklook.frontend.api.remotejobs import RemoteQuicklookJobsWatcher
-from quicklook.models import QuicklookRecord
 from quicklook.select_primary_generator import NoOverlappingGenerators, select_primary_generator
 from quicklook.tileinfo import TileInfo
 from quicklook.types import GeneratorPod, TileId, Visit
 from quicklook.utils import zstd
+from quicklook.utils.http_request import client_session
 from quicklook.utils.numpyutils import ndarray2npybytes, npybytes2ndarray
 from quicklook.utils.s3 import NoSuchKey
-from quicklook.utils.sizelimitedset import SizeLimitedSet
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
 
@@ -37,18 +34,19 @@ async def get_tile(
     y: int,
     x: int,
 ) -> Response:
-    if is_visit_ready(visit):
+    watcher = RemoteQuicklookJobsWatcher()
+    if await watcher.is_visit_ready(visit):
         return await get_tile_from_storage(visit, z, y, x)
-    else:
-        report = RemoteQuicklookJobsWatcher().jobs.get(visit)
-        job = storage.get_quicklook_job_config(visit)
-        assert report and job
-        if report and job:
-            assert job.ccd_generator_map
+    report = watcher.jobs.get(visit)
+    if report and report.phase != QuicklookJobPhase.FAILED and report.published_min_level is not None and z >= report.published_min_level:
+        # 粗いlevelのタイルはjobの途中でもstorageにある
+        return await get_tile_from_storage(visit, z, y, x)
+    if report and report.phase >= QuicklookJobPhase.GENERATE_DONE:
+        job = await storage.get_quicklook_job_config_async(visit)
+        if job.ccd_generator_map:
             if report.phase >= QuicklookJobPhase.MERGE_DONE:
                 return await fetch_merged_tile(visit, z, y, x, job.ccd_generator_map)
-            if report.phase >= QuicklookJobPhase.GENERATE_DONE:
-                return await gather_tile(visit, z, y, x, job.ccd_generator_map)
+            return await gather_tile(visit, z, y, x, job.ccd_generator_map)
 
     raise HTTPException(status_code=404, detail='Tile not found')
 
@@ -57,7 +55,7 @@ async def get_tile_from_storage(visit: Visit, z: int, y: int, x: int) -> Respons
     headers = {'x-quicklook-phase': QuicklookJobPhase.READY.name}
     headers.update(get_cache_headers())
     try:
-        data = storage.get_quicklook_tile_bytes(visit, z, y, x)
+        data = await storage.get_quicklook_tile_bytes_async(visit, z, y, x)
     except NoSuchKey:
         return Response(blank_npy_zstd(), media_type='application/npy+zstd', headers={**headers, 'x-quicklook-error': 'Tile not found'})
     return Response(data, media_type='application/npy+zstd', headers=headers)
@@ -68,7 +66,7 @@ async def gather_tile(visit: Visit, z: int, y: int, x: int, ccd_generator_map: d
     generators = set(ccd_generator_map[ccd_name] for ccd_name in ccd_names if ccd_name in ccd_generator_map)
 
     async def get_npy(generator: GeneratorPod) -> numpy.ndarray:
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.get(
                 f'http://{generator.name}/quicklooks/{visit.id}/tiles/{z}/{y}/{x}',
                 raise_for_status=True,
@@ -108,7 +106,7 @@ async def fetch_merged_tile(visit: Visit, z: int, y: int, x: int, ccd_generator_
     except NoOverlappingGenerators:
         return Response(blank_npy_zstd(), media_type='application/npy+zstd', headers={**headers, 'x-quicklook-error': 'Tile not found'})
 
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         async with session.get(
             f'http://{generator.name}/quicklooks/{visit.id}/merged-tiles/{z}/{y}/{x}',
             raise_for_status=True,
@@ -117,21 +115,6 @@ async def fetch_merged_tile(visit: Visit, z: int, y: int, x: int, ccd_generator_
             return Response(await response.read(), media_type='application/npy+zstd', headers=headers)
 
 
-ready_visits = SizeLimitedSet[Visit](config.max_storage_entries, ttl=30)
-
-
-def is_visit_ready(visit: Visit):
-    if visit in ready_visits:
-        ready_visits.add(visit)
-        return True
-    with db_context() as db:
-        record = db.execute(select(QuicklookRecord).where(QuicklookRecord.id == visit.id)).scalar_one_or_none()
-        if record and record.phase == 'ready':
-            ready_visits.add(visit)
-            return True
-    return False
-
-
 @cache
 def blank_npy_zstd():
     arr = numpy.zeros((config.tile_size, config.tile_size), dtype=numpy.float32)
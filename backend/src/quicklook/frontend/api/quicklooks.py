@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from fastapi import APIRouter, HTTPException, WebSocket, status
@@ -25,6 +26,7 @@ class QuicklookStatus(BaseModel):
     generate_progress: dict[str, GenerateProgress] | None
     transfer_progress: dict[str, TransferProgress] | None
     merge_progress: dict[str, MergeProgress] | None
+    published_min_level: int | None = None
 
     @classmethod
     def from_report(cls, report: QuicklookJobReport) -> 'QuicklookStatus':
@@ -34,6 +36,7 @@ class QuicklookStatus(BaseModel):
             generate_progress=report.generate_progress,
             transfer_progress=report.transfer_progress,
             merge_progress=report.merge_progress,
+            published_min_level=report.published_min_level,
         )
 
 
@@ -52,7 +55,7 @@ async def list_quicklooks_ws(client_ws: WebSocket):
 async def show_quicklook_status(id: str):
     visit = Visit.from_id(id)
     report = RemoteQuicklookJobsWatcher().jobs.get(visit)
-    return quicklook_status(visit, report)
+    return await quicklook_status(visit, report)
 
 
 @router.websocket('/api/quicklooks/{id}/status.ws')
@@ -65,18 +68,18 @@ async def show_quicklook_status_ws(id: str, client_ws: WebSocket):
             return qls.get(visit)
 
         async for report in RemoteQuicklookJobsWatcher().watch(pick):  # pragma: no branch
-            status = quicklook_status(visit, report)
+            status = await quicklook_status(visit, report)
             try:
                 await client_ws.send_json(status.model_dump() if status else None)
             except WebSocketDisconnect:
                 break
 
 
-def quicklook_status(visit: Visit, report: QuicklookJobReport | None) -> QuicklookStatus | None:
+async def quicklook_status(visit: Visit, report: QuicklookJobReport | None) -> QuicklookStatus | None:
     if report:
         status = QuicklookStatus.from_report(report)
     else:
-        job = storage.load_quicklook_job(visit)
+        job = await storage.load_quicklook_job_async(visit)
         if job:
             status = QuicklookStatus.from_report(QuicklookJobReport.from_job(job))
         else:
@@ -93,15 +96,15 @@ class QuicklookMetadata(BaseModel):
 
 @router.get('/api/quicklooks/{id}/metadata', response_model=QuicklookMetadata)
 async def show_quicklook_metadata(id: str):
-    metadata = quicklook_metadata(visit=Visit.from_id(id))
+    metadata = await quicklook_metadata(visit=Visit.from_id(id))
     if metadata:
-        touch_quicklook(visit=Visit.from_id(id))
+        await asyncio.to_thread(touch_quicklook, visit=Visit.from_id(id))
         return metadata
     raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
-def quicklook_metadata(visit: Visit) -> QuicklookMetadata | None:
-    meta = storage.get_quicklook_meta(visit)
+async def quicklook_metadata(visit: Visit) -> QuicklookMetadata | None:
+    meta = await storage.get_quicklook_meta_async(visit)
     if meta:
         scale = 0.2 / 3600.0  # pixel size in degree
         return QuicklookMetadata(
@@ -0,0 +1,85 @@
+from typing import Iterable
+
+from sqlalchemy import select
+
+from quicklook.coordinator.quicklookjob.job import QuicklookJobPhase, QuicklookJobReport
+from quicklook.db import db_context
+from quicklook.models import QuicklookRecord
+from quicklook.types import Visit
+
+
+class ReadinessIndex:
+    """
+    Set of visits whose tiles are in the storage.
+
+    It is loaded from the quicklooks table (`apply_snapshot`) and kept up to date by the job events from the coordinator (`apply_report`).
+    Events received while a snapshot is being loaded win over the snapshot,
+    because the coordinator reports READY before it updates the table.
+    Several snapshots may be loaded at the same time; a snapshot begun before the last applied one is ignored.
+    """
+
+    def __init__(self) -> None:
+        self._ready: set[Visit] = set()
+        # 読み込み中のsnapshotごとに、その間にイベントを受け取ったvisit
+        self._touched: dict[int, set[Visit]] = {}
+        self._epoch = 0
+        self._applied_epoch = 0
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def __contains__(self, visit: Visit) -> bool:
+        return visit in self._ready
+
+    def begin_snapshot(self) -> int:
+        '''
+        Returns the epoch of the snapshot to pass to `apply_snapshot`.
+        '''
+        self._epoch += 1
+        self._touched[self._epoch] = set()
+        return self._epoch
+
+    def apply_snapshot(self, epoch: int, ready_visits: Iterable[Visit]) -> set[Visit]:
+        '''
+        Returns the visits that are no longer ready.
+        '''
+        touched = self._touched.pop(epoch)
+        # 後から始まったsnapshotの方が新しい
+        if epoch < self._applied_epoch:
+            return set()
+        self._applied_epoch = epoch
+        previous = self._ready
+        self._ready = {v for v in ready_visits if v not in touched} | (self._ready & touched)
+        self._loaded = True
+        return previous - self._ready
+
+    def cancel_snapshot(self, epoch: int) -> None:
+        self._touched.pop(epoch, None)
+
+    def apply_report(self, report: QuicklookJobReport) -> bool:
+        '''
+        Returns True if the visit was ready and is no longer.
+        '''
+        # READY以外のjobがあるvisitは（再）生成中なのでstorageのタイルは使えない
+        was_ready = report.visit in self._ready
+        if report.phase == QuicklookJobPhase.READY:
+            self._ready.add(report.visit)
+        else:
+            self._ready.discard(report.visit)
+        for touched in self._touched.values():
+            touched.add(report.visit)
+        return was_ready and report.visit not in self._ready
+
+
+def load_ready_visits() -> list[Visit]:
+    with db_context() as db:
+        ids = db.execute(select(QuicklookRecord.id).where(QuicklookRecord.phase == 'ready')).scalars().all()
+    return [Visit.from_id(id) for id in ids]
+
+
+def is_visit_ready_in_db(visit: Visit) -> bool:
+    with db_context() as db:
+        record = db.execute(select(QuicklookRecord).where(QuicklookRecord.id == visit.id)).scalar_one_or_none()
+        return record is not None and record.phase == 'ready'
@@ -8,8 +8,10 @@ from typing import Callable, TypeVar
 
 import websockets
 
+from quicklook import storage
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.job import QuicklookJobReport
+from quicklook.frontend.api.readiness import ReadinessIndex, is_visit_ready_in_db, load_ready_visits
 from quicklook.types import Visit
 from quicklook.utils.asynctask import cancel_at_exit
 from quicklook.utils.broadcastqueue import BroadcastQueue
@@ -24,12 +26,13 @@ class _RemoteQuicklookJobsWatcher:
     def __init__(self):
         self._jobs: dict[Visit, QuicklookJobReport] = {}
         self._q = BroadcastQueue[dict[Visit, QuicklookJobReport]]()
+        self._ready = ReadinessIndex()
         self._active = False
 
     @asynccontextmanager
     async def activate(self):
         self._active = True
-        with cancel_at_exit(asyncio.create_task(self._watch())):
+        with cancel_at_exit(asyncio.create_task(self._watch())), cancel_at_exit(asyncio.create_task(self._refresh_ready_visits())):
             try:
                 yield
             finally:
@@ -40,11 +43,18 @@ class _RemoteQuicklookJobsWatcher:
             self._jobs = {}
             try:
                 async with websockets.connect(f'{config.coordinator_ws_base_url}/quicklook-jobs/events.ws') as ws:
+                    # 切断中に見逃したイベントがあるかもしれないので接続のたびにDBから読み直す
+                    await self._load_ready_visits()
                     while True:
                         events: list[WatchEvent[QuicklookJobReport]] = pickle.loads(await ws.recv())  # type: ignore
+                        invalidated: set[Visit] = set()
                         for event in events:
+                            if self._ready.apply_report(event.value):
+                                invalidated.add(event.value.visit)
                             match event.type:
                                 case 'added':
+                                    # 新しいjobはstorageのタイルを作り直す
+                                    invalidated.add(event.value.visit)
                                     self._jobs[event.value.visit] = event.value
                                 case 'deleted':
                                     self._jobs.pop(event.value.visit, None)
@@ -53,6 +63,7 @@ class _RemoteQuicklookJobsWatcher:
                                 case _:  # pragma: no cover
                                     raise ValueError(f'unknown event type {event.type}')
                         self._q.put(self._jobs)
+                        await self._invalidate_tile_cache(invalidated)
             except asyncio.CancelledError:
                 break
             except Exception:  # pragma: no cover
@@ -60,6 +71,37 @@ class _RemoteQuicklookJobsWatcher:
                 logger.warning('retrying in 5 seconds')
                 await asyncio.sleep(5)
 
+    async def _refresh_ready_visits(self):
+        # housekeepによるvisitの削除はイベントにならないので定期的にDBと同期する
+        while True:
+            await asyncio.sleep(config.ready_visits_refresh_interval)
+            try:
+                await self._load_ready_visits()
+            except Exception:  # pragma: no cover
+                logger.exception('failed to refresh ready visits')
+
+    async def _load_ready_visits(self):
+        # 再接続と定期的な同期で同時に呼ばれることがある
+        epoch = self._ready.begin_snapshot()
+        try:
+            ready_visits = await asyncio.to_thread(load_ready_visits)
+        except BaseException:
+            self._ready.cancel_snapshot(epoch)
+            raise
+        # housekeepで削除されたvisit
+        removed = self._ready.apply_snapshot(epoch, ready_visits)
+        await self._invalidate_tile_cache(removed)
+
+    async def _invalidate_tile_cache(self, visits: set[Visit]):
+        for visit in visits:
+            await storage.invalidate_visit_tile_cache_async(visit)
+
+    async def is_visit_ready(self, visit: Visit) -> bool:
+        if self._ready.loaded:
+            return visit in self._ready
+        # 起動直後でまだDBを読み込めていない場合
+        return await asyncio.to_thread(is_visit_ready_in_db, visit)
+
     def subscribe(self):
         assert self._active
         return self._q.subscribe()
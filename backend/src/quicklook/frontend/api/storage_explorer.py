@@ -1,6 +1,7 @@
 import logging
 
 from fastapi import APIRouter
+from pydantic import BaseModel
 
 from quicklook import storage
 
@@ -14,6 +15,41 @@ async def list_storage_entries(path: str) -> list[storage.Entry]:
     return [*storage.list_entries(path)]
 
 
+class FetchStats(BaseModel):
+    calls: int
+    executions: int
+    saved: int
+
+
+@router.get('/api/storage:stats', response_model=dict[str, FetchStats])
+async def show_storage_stats() -> dict[str, FetchStats]:
+    return {name: FetchStats(calls=s.calls, executions=s.executions, saved=s.saved) for name, s in storage.fetch_stats().items()}
+
+
+class TileCacheStats(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    bytes: int
+    entries: int
+    max_bytes: int
+    hit_ratio: float
+
+
+@router.get('/api/storage:tile-cache-stats', response_model=TileCacheStats)
+async def show_tile_cache_stats() -> TileCacheStats:
+    s = await storage.tile_cache_stats_async()
+    return TileCacheStats(
+        hits=s.hits,
+        misses=s.misses,
+        evictions=s.evictions,
+        bytes=s.bytes,
+        entries=s.entries,
+        max_bytes=s.max_bytes,
+        hit_ratio=s.hit_ratio,
+    )
+
+
 @router.delete('/api/storage/by-prefix')
 def delete_storage_entries_by_prefix(prefix: str) -> None:
     storage.delete_objects_by_prefix(prefix)
@@ -1,10 +1,9 @@
+import json
 import logging
 import os
-from contextlib import asynccontextmanager, contextmanager
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from dataclasses import dataclass
-from multiprocessing.connection import Connection
-from pathlib import Path
-from typing import Annotated, Callable, TypeVar
+from typing import Annotated
 
 from fastapi import Depends, FastAPI, HTTPException, Response
 from fastapi.responses import StreamingResponse
@@ -13,14 +12,17 @@ from pydantic import BaseModel
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.tasks import GenerateTask, MergeTask, TransferTask
 from quicklook.deps.visit_from_path import visit_from_path
-from quicklook.generator.api.processcomm import Connection, spawn_process_with_comm
-from quicklook.generator.api.tilegenerate import run_generate
+from quicklook.generator.api.supervisor import activate_supervisor, run_task
+from quicklook.generator.api.tilegenerate import fits_header_path, run_generate
 from quicklook.generator.api.tilemerge import run_merge
 from quicklook.generator.api.tiletransfer import run_transfer
 from quicklook.generator.generatorstorage import mergedtile_storage, tmptile_storage
 from quicklook.mutableconfig import update_mutable_config
-from quicklook.types import CcdId, GenerateTaskResponse, MergeTaskResponse, TransferProgress, Visit
+from quicklook.types import CcdId, GenerateTaskResponse, MergeTaskResponse, TileId, TransferProgress, Visit
+from quicklook.utils.fitsheader import raw_headers_to_list
 from quicklook.utils.globalstack import GlobalStack
+from quicklook.utils import zstd
+from quicklook.utils.http_request import activate_client_session
 from quicklook.utils.message import encode_message
 from quicklook.utils.numpyutils import ndarray2npybytes
 from quicklook.utils.podstatus import pod_status
@@ -43,8 +45,9 @@ GeneratorRuntimeSettings.stack.set_default(GeneratorRuntimeSettings(port=config.
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with ctx.activate(GeneratorRuntimeSettings.stack.top.port):
-        yield
+    with activate_supervisor() if config.generator_supervisor else nullcontext():
+        async with activate_client_session(), ctx.activate(GeneratorRuntimeSettings.stack.top.port):
+            yield
 
 
 app = FastAPI(lifespan=lifespan)
@@ -60,9 +63,9 @@ def create_quicklook(task: GenerateTask):
     def stream_task_updates():
         logger.info(f'Generate quicklook for {task}')
         with timeit(f'Generate quicklook for {task}'):
-            with spawn_process_with_comm(make_process_target(run_generate, task)) as p:
+            with run_task(run_generate, task) as recv:
                 while True:
-                    msg: GenerateTaskResponse = p.comm.recv()
+                    msg: GenerateTaskResponse = recv()
                     yield encode_message(msg)
                     if msg is None:
                         break
@@ -75,9 +78,9 @@ def merge_quicklook(task: MergeTask):
     def stream_task_updates():
         logger.info(f'Merge quicklook for {task}')
         with timeit(f'Merge quicklook for {task}'):
-            with spawn_process_with_comm(make_process_target(run_merge, task)) as p:
+            with run_task(run_merge, task) as recv:
                 while True:
-                    msg: MergeTaskResponse = p.comm.recv()
+                    msg: MergeTaskResponse = recv()
                     yield encode_message(msg)
                     if msg is None:
                         break
@@ -90,9 +93,9 @@ def transfer_quicklook(task: TransferTask):
     def stream_task_updates():
         logger.info(f'Transfer quicklook for {task}')
         with timeit(f'Transfer quicklook for {task}'):
-            with spawn_process_with_comm(make_process_target(run_transfer, task)) as p:
+            with run_task(run_transfer, task) as recv:
                 while True:
-                    msg: TransferProgress = p.comm.recv()
+                    msg: TransferProgress = recv()
                     yield encode_message(msg)
                     if msg is None:
                         break
@@ -107,12 +110,38 @@ def get_tile(
     y: int,
     x: int,
 ):
+    if not tmptile_storage.has_tile(visit, z, y, x):
+        # 1つのCCDだけが重なるタイルはgenerateの時点でmerged storageに書き込まれている
+        try:
+            npy = zstd.decompress(mergedtile_storage.get_compressed_tile_data(visit, z, y, x))
+            return Response(npy, media_type='application/npy')
+        except FileNotFoundError:
+            pass
     return Response(
         ndarray2npybytes(tmptile_storage.get_tile_npy(visit, z, y, x)),
         media_type='application/npy',
     )
 
 
+class BulkTilesRequest(BaseModel):
+    tile_ids: list[tuple[int, int, int]]
+
+
+@app.post('/quicklooks/{id}/tiles:bulk')
+def get_tiles_bulk(
+    visit: Annotated[Visit, Depends(visit_from_path)],
+    params: BulkTilesRequest,
+):
+    # merge中のgenerator同士でタイルをまとめてやりとりするためのもの
+    # (TileId, ndarray) のメッセージをリクエストされた順に返し、最後にNoneを返す
+    def stream_tiles():
+        for level, i, j in params.tile_ids:
+            yield encode_message((TileId(level, i, j), tmptile_storage.get_tile_npy(visit, level, i, j)))
+        yield encode_message(None)
+
+    return StreamingResponse(stream_tiles(), media_type='application/octet-stream')
+
+
 @app.get('/quicklooks/{id}/merged-tiles/{z}/{y}/{x}')
 def get_merged_tile(
     visit: Annotated[Visit, Depends(visit_from_path)],
@@ -134,13 +163,11 @@ def get_fits_header(
     visit: Annotated[Visit, Depends(visit_from_path)],
     ccd_name: str,
 ):
-    ccd_id = CcdId(visit, ccd_name)
-    outfile = Path(f'{config.fits_header_tmpdir}/{ccd_id.name}.json')
+    outfile = fits_header_path(CcdId(visit, ccd_name))
     if not outfile.exists():  # pragma: no cover
         return
-    # ファイルの内容はjsonであることが保証されている
-    # 内容が大きいのでそのまま返す
-    return Response(outfile.read_bytes(), media_type='application/json')
+    # 内容が大きいのでresponse_modelを通さずに返す
+    return Response(json.dumps(raw_headers_to_list(outfile.read_bytes())), media_type='application/json')
 
 
 @app.get('/pod_status')
@@ -179,25 +206,3 @@ if config.environment == 'test':
     async def config_endpoint(params: MutableConfigUpdate):
         update_mutable_config(params.new)
 
-
-T = TypeVar('T')
-P = TypeVar('P')
-
-
-def make_process_target(
-    runner_func: Callable[
-        [T, Callable[[P], None]],
-        None,
-    ],
-    task: T,
-) -> Callable[[Connection], None]:
-    def process_target(comm: Connection):
-        try:
-            runner_func(task, comm.send)
-        except Exception as e:
-            logger.exception(f'Error in process: {e}')
-            comm.send(e)
-        finally:
-            comm.send(None)
-
-    return process_target
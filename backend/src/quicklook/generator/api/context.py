@@ -2,10 +2,9 @@ import asyncio
 import logging
 from contextlib import asynccontextmanager
 
-import aiohttp
-
 from quicklook.config import config
 from quicklook.utils.asynctask import cancel_at_exit
+from quicklook.utils.http_request import client_session
 
 
 class GeneratorContext:
@@ -25,7 +24,7 @@ class GeneratorContext:
             await asyncio.sleep(config.heartbeat_interval)
 
     async def _register(self):
-        async with aiohttp.ClientSession() as session:
+        async with client_session() as session:
             async with session.post(
                 f'{config.coordinator_base_url}/register_generator',
                 json={
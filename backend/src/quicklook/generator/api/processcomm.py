@@ -5,7 +5,7 @@ import signal
 from contextlib import contextmanager
 from dataclasses import dataclass
 from multiprocessing.connection import Connection
-from typing import Callable
+from typing import Callable, TypeVar
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
 
@@ -41,3 +41,26 @@ def spawn_process_with_comm(process_target: Callable[[Connection], None]):
             # この行はデバッグ用
             # 本当はこのtry/exceptは必要ない・・はず・・
             logger.exception('Failed to join process')
+
+
+T = TypeVar('T')
+P = TypeVar('P')
+
+
+def make_process_target(
+    runner_func: Callable[
+        [T, Callable[[P], None]],
+        None,
+    ],
+    task: T,
+) -> Callable[[Connection], None]:
+    def process_target(comm: Connection):
+        try:
+            runner_func(task, comm.send)
+        except Exception as e:
+            logger.exception(f'Error in process: {e}')
+            comm.send(e)
+        finally:
+            comm.send(None)
+
+    return process_target
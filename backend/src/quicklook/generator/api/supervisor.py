@@ -0,0 +1,198 @@
+'''
+Long-lived process that runs the tasks of a generator.
+
+The supervisor is started once in the lifespan of the generator app.
+It imports and warms up the heavy modules (astropy's compression code, ccd-info and its rtree, ...)
+and keeps the worker pools (see generator/workerpool.py) so that every task starts with warm workers.
+Each task runs in a thread of the supervisor and its messages are multiplexed over one Pipe.
+A task whose stream is closed before it finishes is cancelled: its next `send` raises `TaskCancelled`.
+The worker pools are shared by the tasks, so a runner must discard or wait for its outstanding pool work
+before it returns (see `drain` in generator/workerpool.py).
+'''
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Iterator, TypeVar
+
+from quicklook.config import config
+from quicklook.generator.api.processcomm import make_process_target, spawn_process_with_comm
+from quicklook.generator.generatorstorage import accumulator_slots
+from quicklook.generator.workerpool import warm_worker_pools
+from quicklook.tileinfo import ccds_by_name, rtree_index
+from quicklook.utils.fits import preload_pyfits_compression_code
+
+logger = logging.getLogger(f'uvicorn.{__name__}')
+
+T = TypeVar('T')
+P = TypeVar('P')
+Runner = Callable[[T, Callable[[P], None]], None]
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+@dataclass
+class _Submit:
+    task_id: int
+    runner: Callable  # pickleされるのでモジュールレベルの関数であること
+    task: Any
+
+
+@dataclass
+class _Cancel:
+    task_id: int
+
+
+def warm_up() -> None:
+    preload_pyfits_compression_code()
+    rtree_index()
+    ccds_by_name()
+    if config.tile_accumulate_min_level is not None:
+        accumulator_slots(config.tile_accumulate_min_level)
+
+
+class Supervisor:
+    def __init__(self) -> None:
+        self._task_ids = itertools.count()
+        self._channels: dict[int, queue.Queue[Any]] = {}
+        self._send_lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        self._comm, child_comm = multiprocessing.Pipe()
+        # daemonなプロセスは子プロセス（worker pool）を持てない
+        process = multiprocessing.Process(target=_supervisor_main, args=(child_comm,), name='generator-supervisor')
+        process.start()
+        child_comm.close()
+        router = threading.Thread(target=self._route, daemon=True)
+        router.start()
+        try:
+            yield self
+        finally:
+            with self._send_lock:
+                self._comm.send(None)
+            process.join(timeout=30)
+            if process.is_alive():  # pragma: no cover
+                process.terminate()
+                process.join()
+            self._comm.close()
+            router.join()
+
+    @contextmanager
+    def run(self, runner: Runner, task: Any) -> Iterator[Callable[[], Any]]:
+        task_id = next(self._task_ids)
+        channel: queue.Queue[Any] = queue.Queue()
+        self._channels[task_id] = channel
+        finished = False
+
+        def recv():
+            nonlocal finished
+            msg = channel.get()
+            finished = msg is None
+            return msg
+
+        try:
+            with self._send_lock:
+                self._comm.send(_Submit(task_id, runner, task))
+            yield recv
+        finally:
+            if not finished:
+                with self._send_lock:
+                    self._comm.send(_Cancel(task_id))
+            del self._channels[task_id]
+
+    def _route(self):
+        while True:
+            try:
+                task_id, msg = self._comm.recv()
+            except (EOFError, OSError):
+                break
+            channel = self._channels.get(task_id)
+            if channel:  # キャンセルされたタスクのメッセージは捨てる
+                channel.put(msg)
+        # supervisorが終了したら実行中のタスクも終わらせる
+        for channel in [*self._channels.values()]:  # pragma: no cover
+            channel.put(RuntimeError('generator supervisor exited'))
+            channel.put(None)
+
+
+def _supervisor_main(comm: Connection) -> None:
+    # 終了はlifespanから送られるNoneで行う
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    send_lock = threading.Lock()
+    cancel_events: dict[int, threading.Event] = {}
+
+    def run_task(submit: _Submit, cancelled: threading.Event):
+        def send(msg):
+            if cancelled.is_set():
+                raise TaskCancelled()
+            with send_lock:
+                comm.send((submit.task_id, msg))
+
+        try:
+            submit.runner(submit.task, send)
+        except TaskCancelled:
+            logger.info(f'Task {submit.task_id} cancelled')
+        except Exception as e:
+            logger.exception(f'Error in task: {e}')
+            with send_lock:
+                comm.send((submit.task_id, e))
+        finally:
+            with send_lock:
+                comm.send((submit.task_id, None))
+            cancel_events.pop(submit.task_id, None)
+
+    warm_up()
+    with warm_worker_pools([config.tile_ccd_processing_parallel, config.tile_merge_parallel], initializer=warm_up):
+        while True:
+            try:
+                msg = comm.recv()
+            except EOFError:  # pragma: no cover
+                break
+            match msg:
+                case None:
+                    break
+                case _Submit():
+                    cancel_events[msg.task_id] = threading.Event()
+                    threading.Thread(target=run_task, args=(msg, cancel_events[msg.task_id]), daemon=True).start()
+                case _Cancel():
+                    if msg.task_id in cancel_events:  # pragma: no branch
+                        cancel_events[msg.task_id].set()
+                case _:  # pragma: no cover
+                    raise TypeError(f'Unexpected message: {msg}')
+
+
+_supervisor: Supervisor | None = None
+
+
+@contextmanager
+def activate_supervisor():
+    global _supervisor
+    with Supervisor().activate() as supervisor:
+        _supervisor = supervisor
+        try:
+            yield supervisor
+        finally:
+            _supervisor = None
+
+
+@contextmanager
+def run_task(runner: Runner, task: Any) -> Iterator[Callable[[], Any]]:
+    '''
+    Runs `runner(task, send)` in the supervisor if it is active, otherwise in a new process.
+    Yields a function that receives the messages sent by the runner. The last message is None.
+    '''
+    if _supervisor is not None:
+        with _supervisor.run(runner, task) as recv:
+            yield recv
+    else:
+        with spawn_process_with_comm(make_process_target(runner, task)) as p:
+            yield p.comm.recv
@@ -1,24 +1,29 @@
 import contextlib
-import json
 import logging
-import tempfile
-import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from functools import cache
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator, Sized
 
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.tasks import GenerateTask
 from quicklook.datasource import get_datasource
+from quicklook.datasource.types import DataSourceBase
 from quicklook.generator.iteratetiles import iterate_tiles
 from quicklook.generator.preprocess_ccd import preprocess_ccd
 from quicklook.generator.progress import GenerateProgress, GeneratorProgressReporter
-from quicklook.generator.generatorstorage import tmptile_storage
-from quicklook.types import CcdId, CcdMeta, GenerateTaskResponse, PreProcessedCcd, Progress, Tile, Visit
-from quicklook.utils import multiprocessing_coverage_compatible as mp
-from quicklook.utils import throttle
-from quicklook.utils.dynamicsemaphore import DynamicSemaphore
+from quicklook.generator.workerpool import drain, worker_pool
+from quicklook.generator.generatorstorage import mergedtile_storage, tmptile_storage
+from quicklook.tileinfo import CCD_BBOX_MARGIN, TileInfo
+from quicklook.types import CcdCoarseDone, CcdId, CcdMeta, GenerateTaskResponse, PreProcessedCcd, Progress, Tile, Visit
+from quicklook.utils import throttle, zstd
+from quicklook.utils.adaptiveconcurrency import AdaptiveConcurrency
+from quicklook.utils.http_request import http_session
+from quicklook.utils.numpyutils import ndarray2npybytes
+from quicklook.utils.sharedcache import SharedBytesCache
 from quicklook.utils.timeit import timeit
 
 logger = logging.getLogger(f'uvicorn.{__name__}')
@@ -29,48 +34,129 @@ def run_generate(task: GenerateTask, send: Callable[[GenerateTaskResponse], None
     def on_update(progress: GenerateProgress):
         send(progress)
 
-    with iterate_downloaded_ccds(task.visit, task.ccd_names) as files:
-        with timeit('generator'):
-            with mp.Pool(config.tile_ccd_processing_parallel) as pool:
-                with GeneratorProgressReporter(task, on_update=on_update) as progress:
+    def on_coarse_done(ccd_id: CcdId):
+        send(CcdCoarseDone(ccd_id))
 
-                    def args():
-                        for ccd_id, file in files:
-                            progress.download_done()
-                            yield ProcessCcdArgs(ccd_id, file, progress.updator)
+    # 処理中と先読みのCCDの数だけダウンロードを始める（pullモードではcoordinatorからCCDを受け取る）
+    # workerの処理が追いつかないときはダウンロードが止まる
+    # 処理が終わるか、ダウンロードに失敗したら解放する
+    slots = threading.Semaphore(config.tile_ccd_processing_parallel + config.generate_pull_prefetch)
+    aborted = threading.Event()
 
-                    for result in pool.imap_unordered(process_ccd, args()):
-                        send(result)
+    def static_ccd_names():
+        for ccd_name in task.ccd_names:
+            slots.acquire()
+            if aborted.is_set():
+                return
+            yield ccd_name
+
+    with _exclusive_visit(task.visit):
+        accumulator = tmptile_storage.reset(task.visit)
+
+        with GeneratorProgressReporter(task, on_update=on_update, on_coarse_done=on_coarse_done) as progress:
+            ccd_names = pull_ccd_names(task, slots, on_assigned=progress.ccd_assigned) if task.pull else static_ccd_names()
+            with iterate_downloaded_ccds(task.visit, ccd_names, on_failed=lambda ccd_name: slots.release()) as files:
+                with timeit('generator'):
+                    with worker_pool(config.tile_ccd_processing_parallel) as pool:
+
+                        def args():
+                            for ccd_id, file in files:
+                                if aborted.is_set():
+                                    return
+                                progress.download_done()
+                                yield ProcessCcdArgs(ccd_id, file, progress.updator(ccd_id), task.coarse_min_level, accumulator)
+
+                        results = pool.imap_unordered(process_ccd, args())
+                        try:
+                            for result in results:
+                                send(result)
+                                slots.release()
+                        except BaseException:
+                            # キャンセルされたかCCDの処理に失敗した
+                            # worker poolは他のタスクと共有されていることがあるので、このタスクの残りのCCDを捨て、終わるまで待つ
+                            aborted.set()
+                            progress.cancel()
+                            slots.release()
+                            # 止まっているダウンロードを進めて、argsを終わらせる
+                            drain(results, on_result=slots.release)
+                            raise
 
     throttle.flush(on_update)
 
 
+class CcdProcessingCancelled(Exception):
+    pass
+
+
+_running_visits: set[Visit] = set()
+_running_visits_cond = threading.Condition()
+
+
+@contextlib.contextmanager
+def _exclusive_visit(visit: Visit):
+    # キャンセルされたタスクがworker poolを待っている間に、同じvisitの次のタスクがtmp storageを作り直さないように
+    with _running_visits_cond:
+        _running_visits_cond.wait_for(lambda: visit not in _running_visits)
+        _running_visits.add(visit)
+    try:
+        yield
+    finally:
+        with _running_visits_cond:
+            _running_visits.discard(visit)
+            _running_visits_cond.notify_all()
+
+
+def pull_ccd_names(task: GenerateTask, slots: threading.Semaphore, *, on_assigned: Callable[[], None]) -> Iterator[str]:
+    while True:
+        slots.acquire()
+        res = http_session().post(
+            f'{config.coordinator_base_url}/quicklooks/{task.visit.id}/ccd-assignments',
+            json={'generator': asdict(task.generator)},
+        )
+        res.raise_for_status()
+        ccd_names: list[str] = res.json()
+        if len(ccd_names) == 0:
+            break
+        for ccd_name in ccd_names:
+            on_assigned()
+            yield ccd_name
+
+
 @dataclass
 class ProcessCcdArgs:
     ccd_id: CcdId
-    path: Path
+    fits: 'SharedFitsBuffer'
     progress_updator: GeneratorProgressReporter.InterProcessUpdator
+    coarse_min_level: int | None = None
+    accumulator: str | None = None
 
 
 def process_ccd(args: ProcessCcdArgs) -> CcdMeta:
     def update_maketile_progress(progress: Progress):
-        if (progress.count == progress.total) or (progress.count % 32 == 0):
-            args.progress_updator.update_maketile_progress(args.ccd_id.ccd_name, progress)
+        if args.progress_updator.cancelled():
+            raise CcdProcessingCancelled(args.ccd_id.name)
+        args.progress_updator.update_maketile_progress(progress)
 
     with timeit(f'process-{args.ccd_id.name}'):
         try:
-            try:
-                ppccd = preprocess_ccd(args.ccd_id, args.path)
-                args.progress_updator.preprocess_done()
-            finally:
-                args.path.unlink()
+            if args.progress_updator.cancelled():
+                # 共有されたworker poolのqueueに残っていた
+                raise CcdProcessingCancelled(args.ccd_id.name)
+            with args.fits.attach() as buf:
+                ppccd = preprocess_ccd(args.ccd_id, buf)
+            args.progress_updator.preprocess_done()
 
             save_headers(ppccd)
 
             make_tiles(
                 ppccd,
                 update_progress=update_maketile_progress,
+                coarse_min_level=args.coarse_min_level,
+                on_coarse_done=args.progress_updator.coarse_done,
+                accumulator=args.accumulator,
             )
+        except CcdProcessingCancelled:
+            raise
         except Exception:
             # 明示的にエラーを書き出さないとエラーログがどこかへ消えてしまう
             logger.exception(f'Failed to process {args.ccd_id.name}')
@@ -88,53 +174,172 @@ def make_tiles(
     ppccd: PreProcessedCcd,
     *,
     update_progress: Callable[[Progress], None],
+    coarse_min_level: int | None = None,
+    on_coarse_done: Callable[[], None] | None = None,
+    accumulator: str | None = None,
 ):
-    def cb(tile: Tile, progress: Progress):
-        tmptile_storage.put_tile(ppccd.ccd_id, tile)
-        update_progress(progress)
+    with tmptile_storage.writer(ppccd.ccd_id, accumulator) as writer:
+
+        def cb(tile: Tile, progress: Progress):
+            if config.tile_single_ccd_fast_path and is_single_contributor(tile, ppccd.ccd_id.ccd_name):
+                # このCCDのgeneratorがprimaryになるので、mergeの結果として書き込んでしまう
+                compressed = zstd.compress(ndarray2npybytes(tile.data))
+                mergedtile_storage.put_compressed_tile_data(tile.visit, tile.level, tile.i, tile.j, compressed)
+            else:
+                writer.put_tile(tile)
+            update_progress(progress)
 
-    iterate_tiles(ppccd, cb)
+        def coarse_done():
+            # coarseなlevelのタイルは他のlevelより先にmergeされるので、ここで読めるようにしておく
+            writer.flush()
+            if on_coarse_done:
+                on_coarse_done()
+
+        iterate_tiles(ppccd, cb, coarse_min_level=coarse_min_level, on_coarse_done=coarse_done)
+
+
+def is_single_contributor(tile: Tile, ccd_name: str) -> bool:
+    # 隣のCCDがbboxの外に書き込んだタイルはmergeで上書きされてしまうので、TileDependenciesと同じだけ広げて判定する
+    return TileInfo.of(tile.level, tile.i, tile.j, margin=CCD_BBOX_MARGIN).ccd_names == [ccd_name]
+
+
+@dataclass
+class SharedFitsBuffer:
+    '''
+    Downloaded FITS file passed to a worker through shared memory.
+    '''
+
+    name: str
+    size: int
+
+    @classmethod
+    def create(cls, data: bytes) -> 'SharedFitsBuffer':
+        # trackするとresource_trackerが作成したプロセスの終了時にunlinkしようとする
+        shm = SharedMemory(create=True, size=max(len(data), 1), track=False)
+        try:
+            shm.buf[: len(data)] = data
+            return cls(shm.name, len(data))
+        finally:
+            shm.close()
+
+    @contextlib.contextmanager
+    def attach(self) -> Iterator[memoryview]:
+        shm = SharedMemory(name=self.name, track=False)
+        buf = shm.buf[: self.size]
+        try:
+            yield buf
+        finally:
+            buf.release()
+            shm.close()
+            # 一度読んだら不要
+            self.unlink()
+
+    def unlink(self):
+        try:
+            SharedMemory(name=self.name, track=False).unlink()
+        except FileNotFoundError:
+            pass
 
 
 @contextlib.contextmanager
 def iterate_downloaded_ccds(
     visit: Visit,
-    ccd_names: list[str],
-    parallel: int = 2,
+    ccd_names: Iterable[str],
     update_progress: Callable[[Progress], None] = Progress.noop_progress,
+    on_failed: Callable[[str], None] = lambda ccd_name: None,
 ):
-    sem = DynamicSemaphore(1)
+    '''
+    Downloads `ccd_names` and yields `(CcdId, SharedFitsBuffer)`.
+    CCDs that could not be downloaded are skipped and reported to `on_failed`.
+    '''
     ds = get_datasource()
+    # 最初は1つずつダウンロードし、スループットが上がる間は並列数を増やす
+    concurrency = AdaptiveConcurrency(
+        config.generate_download_parallel_min,
+        config.generate_download_parallel_max,
+        name=f'download-{visit.name}',
+    )
+
+    def fetch(ccd_id: CcdId) -> bytes:
+        # キャッシュから読んだ分は数えない
+        with concurrency.measure() as m:
+            data = ds.get_data(ccd_id)
+            m.nbytes = len(data)
+        return data
 
     def download(visit: Visit, ccd_name: str):
-        with sem:
-            with timeit(f'download-{visit.name}/{ccd_name}'):
-                filecontents = ds.get_data(CcdId(visit, ccd_name))
-                filename = Path(f'{tmpdir}/{ccd_name}.fits')
-                filename.parent.mkdir(parents=True, exist_ok=True)
-                Path(filename).write_bytes(filecontents)
-                if sem.max_count < parallel:
-                    sem.set_max_count(parallel)
-                return CcdId(visit, ccd_name), filename
-
-    Path(config.fitsio_tmpdir).mkdir(parents=True, exist_ok=True)
-    with tempfile.TemporaryDirectory(dir=config.fitsio_tmpdir) as tmpdir:
+        with timeit(f'download-{visit.name}/{ccd_name}'):
+            filecontents = get_data_cached(ds, CcdId(visit, ccd_name), fetch)
+            # ファイルを経由せずにworkerのdecompressorへ渡す
+            fits = SharedFitsBuffer.create(filecontents)
+            created.append(fits)
+            return CcdId(visit, ccd_name), fits
+
+    created: list[SharedFitsBuffer] = []
+    try:
 
         def g():
-            with ThreadPoolExecutor(parallel) as executor:
-                fs = [executor.submit(download, visit, ccd_name) for ccd_name in ccd_names]
-                for i, f in enumerate(as_completed(fs)):
-                    update_progress(Progress(i + 1, len(ccd_names)))
-                    try:
-                        yield f.result()
-                    except Exception as e:  # pragma: no cover
-                        traceback.print_exc()
+            # ccd_namesはcoordinatorから順に受け取る場合もあるので、必要になった分だけ取り出す
+            names = iter(ccd_names)
+            total = len(ccd_names) if isinstance(ccd_names, Sized) else None
+            with ThreadPoolExecutor(config.generate_download_parallel_max) as executor:
+                fs: dict[Future, str] = {}
+
+                def fill():
+                    while len(fs) < concurrency.limit and (ccd_name := next(names, None)) is not None:
+                        fs[executor.submit(download, visit, ccd_name)] = ccd_name
+
+                fill()
+                i = 0
+                while fs:
+                    done, _ = wait(fs, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        ccd_name = fs.pop(f)
+                        i += 1
+                        update_progress(Progress(i, total if total is not None else i))
+                        try:
+                            result = f.result()
+                        except Exception:
+                            logger.exception(f'Failed to download {visit.name}/{ccd_name}')
+                            on_failed(ccd_name)
+                            continue
+                        yield result
+                    fill()
 
         yield g()
+    finally:
+        # 処理されなかったものを片付ける
+        for fits in created:
+            fits.unlink()
+
+
+def get_data_cached(ds: DataSourceBase, ccd_id: CcdId, fetch: Callable[[CcdId], bytes] | None = None) -> bytes:
+    fetch = fetch or ds.get_data
+    raw_cache = _raw_cache()
+    data_id = ds.get_data_id(ccd_id) if raw_cache else None
+    if raw_cache is None or data_id is None:
+        return fetch(ccd_id)
+    data = raw_cache.get(data_id)
+    if data is None:
+        data = fetch(ccd_id)
+        raw_cache.put(data_id, data)
+    return data
+
+
+@cache
+def _raw_cache() -> SharedBytesCache | None:
+    # 同じvisitを再度generateするときにダウンロードし直さない
+    if config.raw_cache_max_bytes <= 0:
+        return None
+    return SharedBytesCache(config.raw_cache_dir, config.raw_cache_max_bytes)
+
+
+def fits_header_path(ccd_id: CcdId) -> Path:
+    return Path(f'{config.fits_header_tmpdir}/{ccd_id.name}.hdr')
 
 
 def save_headers(ppccd: PreProcessedCcd):
-    outfile = Path(f'{config.fits_header_tmpdir}/{ppccd.ccd_id.name}.json')
+    # astropyでのcardの解析は要求されたときまで遅らせる
+    outfile = fits_header_path(ppccd.ccd_id)
     outfile.parent.mkdir(parents=True, exist_ok=True)
-    with outfile.open('w') as f:
-        json.dump(ppccd.headers, f)
+    outfile.write_bytes(b''.join(ppccd.raw_headers))
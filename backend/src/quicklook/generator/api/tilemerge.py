@@ -1,19 +1,24 @@
+import queue
+import threading
 import traceback
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from logging import getLogger
-from typing import Callable, Generator
+from typing import Callable, Generator, Iterable
 
 import numpy
-import requests
 
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.tasks import MergeTask
 from quicklook.generator.generatorstorage import mergedtile_storage, tmptile_storage
+from quicklook.generator.workerpool import drain, worker_pool
 from quicklook.select_primary_generator import select_primary_generator
 from quicklook.types import GeneratorPod, MergeProgress, MergeTaskResponse, Progress, TileId, Visit
-from quicklook.utils import multiprocessing_coverage_compatible, throttle, zstd
-from quicklook.utils.numpyutils import ndarray2npybytes, npybytes2ndarray
+from quicklook.utils import throttle, zstd
+from quicklook.utils.http_request import http_session
+from quicklook.utils.message import message_from_stream
+from quicklook.utils.numpyutils import ndarray2npybytes
 from quicklook.utils.timeit import timeit
 
 logger = getLogger(f'uvicorn.{__name__}')
@@ -23,37 +28,70 @@ logger = getLogger(f'uvicorn.{__name__}')
 class Args:
     visit: Visit
     tile_id: TileId
-    generators: list[GeneratorPod]
+    peer_sum: numpy.ndarray | None = None  # 他のgeneratorのタイルの和
 
 
 def run_merge(task: MergeTask, send: Callable[[MergeTaskResponse], None]) -> None:
-    def iter_tiles():
-        for level, i, j in tmptile_storage.iter_tiles(task.visit):
-            tile_id = TileId(level, i, j)
+    local_tiles: list[TileId] = []
+    peer_tiles: dict[GeneratorPod, list[TileId]] = defaultdict(list)
+
+    def candidate_tiles() -> Iterable[TileId]:
+        if task.tile_ids is None:
+            return (TileId(level, i, j) for level, i, j in tmptile_storage.iter_tiles(task.visit))
+        return (t for t in task.tile_ids if tmptile_storage.has_tile(task.visit, t.level, t.i, t.j))
+
+    def enumerate_tiles():
+        for tile_id in candidate_tiles():
             primary, all_generators = select_primary_generator(task.ccd_generator_map, tile_id)
             if primary == task.generator:
-                non_primary_generators = [g for g in all_generators if g != primary]
-                yield Args(
-                    visit=task.visit,
-                    tile_id=tile_id,
-                    generators=non_primary_generators,
-                )
+                local_tiles.append(tile_id)
+                for g in all_generators:
+                    if g != primary:
+                        peer_tiles[g].append(tile_id)
+
+    def iter_args() -> Generator[Args, None, None]:
+        # 他のgeneratorのタイルが不要なものから処理する
+        shared = {tile_id for tile_ids in peer_tiles.values() for tile_id in tile_ids}
+        for tile_id in local_tiles:
+            if tile_id not in shared:
+                yield Args(visit=task.visit, tile_id=tile_id)
+        for tile_id, peer_sum in gather_tiles_bulk(task.visit, peer_tiles):
+            yield Args(visit=task.visit, tile_id=tile_id, peer_sum=peer_sum)
+
+    # poolは他のタスクと共有されていることがあるので、キャンセルされたときに残りを捨てられるように少しずつ渡す
+    pending = threading.Semaphore(2 * config.tile_merge_parallel)
+    aborted = threading.Event()
+
+    def bounded_args() -> Generator[Args, None, None]:
+        for args in iter_args():
+            pending.acquire()
+            if aborted.is_set():
+                return
+            yield args
 
     @throttle.throttle(0.1)
     def on_update(progress: MergeProgress):
         send(progress)
 
     with timeit(f'merge enumerate {task.visit.id}'):
-        params_list = list(iter_tiles())
-        total = len(params_list)
+        enumerate_tiles()
+        total = len(local_tiles)
 
     on_update(MergeProgress(merge=Progress(count=0, total=total)))
 
     with timeit(f'merge {task.visit.id}'):
-        with multiprocessing_coverage_compatible.Pool(config.tile_merge_parallel) as pool:
-            for done, _ in enumerate(pool.imap_unordered(process_tile, params_list)):
-                progress = MergeProgress(merge=Progress(count=done + 1, total=total))
-                on_update(progress)
+        with worker_pool(config.tile_merge_parallel) as pool:
+            results = pool.imap_unordered(process_tile, bounded_args())
+            try:
+                for done, _ in enumerate(results):
+                    pending.release()
+                    progress = MergeProgress(merge=Progress(count=done + 1, total=total))
+                    on_update(progress)
+            except BaseException:
+                aborted.set()
+                pending.release()
+                drain(results, on_result=pending.release)
+                raise
 
     throttle.flush(on_update)
 
@@ -62,35 +100,96 @@ def process_tile(params: Args) -> None:
     tile_id = params.tile_id
     visit = params.visit
     npy = tmptile_storage.get_tile_npy(visit, tile_id.level, tile_id.i, tile_id.j)
-    if len(params.generators) > 0:
-        for tile in gather_tiles(params.generators, visit, tile_id.level, tile_id.i, tile_id.j):
-            npy += tile
+    if params.peer_sum is not None:
+        npy = npy + params.peer_sum  # npyは読み込み専用のことがある
     compressed = zstd.compress(ndarray2npybytes(npy))
     mergedtile_storage.put_compressed_tile_data(visit, tile_id.level, tile_id.i, tile_id.j, compressed)
 
 
-def gather_tiles(
-    generators: list[GeneratorPod],
+def gather_tiles_bulk(
     visit: Visit,
-    z: int,
-    y: int,
-    x: int,
-) -> Generator[numpy.ndarray, None, None]:
-    """Generator function that yields tile arrays as they become available"""
-
-    def get_npy(generator: GeneratorPod) -> numpy.ndarray | None:
+    peer_tiles: dict[GeneratorPod, list[TileId]],
+) -> Generator[tuple[TileId, numpy.ndarray | None], None, None]:
+    """
+    Fetches the tiles from each peer with one streaming request per peer,
+    and yields the sum over the peers for each tile once all the peers have delivered it.
+    Tiles that a peer failed to deliver are summed over the other peers (None if no peer delivered).
+
+    The tiles are requested from every peer in the same (sorted) order and summed in that order,
+    so at most `4 * config.tile_merge_parallel` tiles per peer are held in memory; a slow peer holds back the others.
+    """
+    if len(peer_tiles) == 0:
+        return
+
+    requests = {g: sorted(set(tile_ids), key=lambda t: (t.level, t.i, t.j)) for g, tile_ids in peer_tiles.items()}
+    order = sorted({t for tile_ids in requests.values() for t in tile_ids}, key=lambda t: (t.level, t.i, t.j))
+    peers_of: dict[TileId, list[GeneratorPod]] = defaultdict(list)
+    for g, tile_ids in requests.items():
+        for tile_id in tile_ids:
+            peers_of[tile_id].append(g)
+
+    # peerごとのqueue。peerはリクエストされた順にタイルを返す
+    queues = {g: queue.Queue[tuple[TileId, numpy.ndarray] | None](maxsize=4 * config.tile_merge_parallel) for g in requests}
+    stop = threading.Event()
+
+    def put(q: queue.Queue, item) -> bool:
+        # 読み手がいなくなったら止まる
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_peer(generator: GeneratorPod, tile_ids: list[TileId]) -> None:
+        q = queues[generator]
         try:
-            response = requests.get(f'http://{generator.name}/quicklooks/{visit.id}/tiles/{z}/{y}/{x}', timeout=30)
-            response.raise_for_status()
-            return npybytes2ndarray(response.content)
+            with http_session().post(
+                f'http://{generator.name}/quicklooks/{visit.id}/tiles:bulk',
+                json={'tile_ids': [(t.level, t.i, t.j) for t in tile_ids]},
+                stream=True,
+                timeout=30,
+            ) as response:
+                response.raise_for_status()
+                while (msg := message_from_stream(response.raw)) is not None:
+                    if not put(q, msg):
+                        return
         except Exception:  # pragma: no cover
             traceback.print_exc()
+        finally:
+            put(q, None)
+
+    ended: set[GeneratorPod] = set()
+
+    def next_tile(generator: GeneratorPod, tile_id: TileId) -> numpy.ndarray | None:
+        if generator in ended:  # pragma: no cover
+            return None
+        msg = queues[generator].get()
+        if msg is None:  # pragma: no cover
+            # 途中で失敗した。残りのタイルは届かない
+            ended.add(generator)
             return None
+        delivered, arr = msg
+        if delivered != tile_id:  # pragma: no cover
+            raise RuntimeError(f'{generator.name} returned {delivered} instead of {tile_id}')
+        return arr
 
-    with ThreadPoolExecutor(len(generators)) as executor:
-        futures = {executor.submit(get_npy, g): g for g in generators}
+    with ThreadPoolExecutor(len(requests)) as executor:
+        futures = [executor.submit(read_peer, g, tile_ids) for g, tile_ids in requests.items()]
+        try:
+            for tile_id in order:
+                total: numpy.ndarray | None = None
+                for g in peers_of[tile_id]:
+                    arr = next_tile(g, tile_id)
+                    if arr is None:
+                        continue
+                    if total is None:
+                        total = arr
+                    else:
+                        total += arr
+                yield tile_id, total
+        finally:
+            stop.set()
         for future in as_completed(futures):
-            arr = future.result()
-            if arr is None:  # pragma: no cover
-                continue
-            yield arr
+            future.result()
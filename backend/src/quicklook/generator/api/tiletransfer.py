@@ -12,6 +12,7 @@ from quicklook.generator.generatorstorage import mergedtile_storage
 from quicklook.select_primary_generator import NoOverlappingGenerators, select_primary_generator
 from quicklook.types import PackedTileId, Progress, TileId, TransferProgress, TransferTaskResponse
 from quicklook.utils import throttle
+from quicklook.utils.http_request import http_session
 from quicklook.utils.timeit import timeit
 
 logger = getLogger(f'uvicorn.{__name__}')
@@ -22,8 +23,10 @@ def run_transfer(task: TransferTask, send: Callable[[TransferTaskResponse], None
     def on_update(progress: TransferProgress):
         send(progress)
 
-
     def iter_tiles():
+        if task.packed_ids is not None:
+            yield from task.packed_ids
+            return
         distinct_tiles: set[PackedTileId] = set()
         for level, i, j in mergedtile_storage.iter_tiles(task.visit):
             tile_id = PackedTileId.from_unpacked(level, i, j)
@@ -66,7 +69,7 @@ def transfer_packed_tile(task: TransferTask, packed_id: PackedTileId) -> None:
                     return None
 
             try:
-                response = requests.get(f'http://{generator.name}/quicklooks/{task.visit.id}/merged-tiles/{level}/{tile_id.i}/{tile_id.j}', timeout=30)
+                response = http_session().get(f'http://{generator.name}/quicklooks/{task.visit.id}/merged-tiles/{level}/{tile_id.i}/{tile_id.j}', timeout=30)
                 response.raise_for_status()
                 return response.content
             except requests.HTTPError as e:
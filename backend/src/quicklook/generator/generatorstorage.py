@@ -1,54 +1,343 @@
+import fcntl
 import logging
+import mmap
+import os
 import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import cache
 from pathlib import Path
-from typing import Generator
+from typing import BinaryIO, Generator, Iterable, Iterator
 
 import numpy
 
 from quicklook.config import config
+from quicklook.generator.iteratetiles import tile_ranges
+from quicklook.tileinfo import ccd_list
 from quicklook.types import CcdId, Tile, Visit
-from quicklook.utils.numpyutils import ndarray2npybytes
 
 logger = logging.getLogger(f'uviorn.{__name__}')
 
 
+# タイルはCCDごとに1つのファイルに書き出す
+#   {ccd_name}.{token}.tiles               float32のタイルのデータを順に並べたもの
+#   {ccd_name}.{token}.{seq}.index.npy     各タイルの (level, i, j, offset, h, w)
+# tokenはwriterごと、seqはflushごとに新しくなるので、同じ名前のファイルの内容が変わることはない
+# 読む側はファイル名だけで変更を検知できる
+_index_dtype = numpy.dtype([('level', '<i8'), ('i', '<i8'), ('j', '<i8'), ('offset', '<i8'), ('h', '<i8'), ('w', '<i8')])
+
+
+class TileAccumulator:
+    """
+    Sums of the tiles of `level >= min_level` over the CCDs processed by this generator.
+
+    The sums are kept in a sparse file in `config.tile_tmpdir` that has a slot for each such tile of the focal plane,
+    so only the slots that are written use memory.
+    The workers add their tiles into the mapped file under a lock of the byte range of the slot.
+    """
+
+    def __init__(self, path: Path):
+        # ファイル名は accumulator.{token}.{min_level}.tiles
+        self.path = path
+        self.min_level = int(path.name.split('.')[2])
+        self.tiles, self._slots = accumulator_slots(self.min_level)
+        n = len(self.tiles)
+        self._slot_bytes = config.tile_size * config.tile_size * 4
+        self._header_bytes = -(-n * 8 // mmap.PAGESIZE) * mmap.PAGESIZE
+        size = self._header_bytes + n * self._slot_bytes
+        self._fd = os.open(path, os.O_RDWR)
+        stat = os.fstat(self._fd)
+        self.ino = stat.st_ino
+        if stat.st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._counts = numpy.frombuffer(self._mm, dtype='<i8', count=n)  # slotに足されたCCDの数
+
+    def add(self, tile: Tile) -> bool:
+        slot = self._slots.get((tile.level, tile.i, tile.j))
+        if slot is None or tile.data.shape != (config.tile_size, config.tile_size):
+            return False
+        offset = self._header_bytes + slot * self._slot_bytes
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._slot_bytes, offset)
+        try:
+            data = self._slot(slot)
+            numpy.add(data, tile.data, out=data)
+            self._counts[slot] += 1
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._slot_bytes, offset)
+        return True
+
+    def get(self, key: tuple[int, int, int]) -> numpy.ndarray | None:
+        slot = self._slots.get(key)
+        if slot is None or self._counts[slot] == 0:
+            return None
+        data = self._slot(slot)
+        data.flags.writeable = False
+        return data
+
+    def keys(self) -> list[tuple[int, int, int]]:
+        return [self.tiles[slot] for slot in numpy.flatnonzero(self._counts)]
+
+    def _slot(self, slot: int) -> numpy.ndarray:
+        return numpy.frombuffer(
+            self._mm,
+            dtype=numpy.float32,
+            count=config.tile_size * config.tile_size,
+            offset=self._header_bytes + slot * self._slot_bytes,
+        ).reshape(config.tile_size, config.tile_size)
+
+    def close(self):
+        os.close(self._fd)
+        del self._counts
+        try:
+            self._mm.close()
+        except BufferError:
+            # 読み手のviewが残っている。最後のviewが消えたときにunmapされる
+            pass
+
+
+@cache
+def accumulator_slots(min_level: int) -> tuple[list[tuple[int, int, int]], dict[tuple[int, int, int], int]]:
+    tiles: set[tuple[int, int, int]] = set()
+    for ccd in ccd_list():
+        b = ccd.bbox
+        for level, ri, rj in tile_ranges(int(b.miny), int(b.maxy) + 1, int(b.minx), int(b.maxx) + 1):
+            if level >= min_level:
+                tiles.update((level, i, j) for i in ri for j in rj)
+    sorted_tiles = sorted(tiles)
+    return sorted_tiles, {key: slot for slot, key in enumerate(sorted_tiles)}
+
+
+class TmpTileWriter:
+    def __init__(self, ccds_dir: Path, ccd_name: str, accumulator: TileAccumulator | None = None):
+        self._ccds_dir = ccds_dir
+        self._ccd_name = ccd_name
+        self._accumulator = accumulator
+        self._entries: list[tuple[int, int, int, int, int, int]] = []
+        self._offset = 0
+        self._token = time.time_ns()
+        self._seq = 0
+        # 同じCCDが再処理された場合は古いファイルを消す
+        # mapしている読み手がいてもunlinkなら問題ない（truncateするとSIGBUSになる）
+        for p in [*ccds_dir.glob(f'{ccd_name}.*.index.npy'), *ccds_dir.glob(f'{ccd_name}.*.tiles')]:
+            p.unlink(missing_ok=True)
+        # 全てのタイルがaccumulatorに入る場合はファイルを作らない
+        self._file: BinaryIO | None = None
+
+    def put_tile(self, tile: Tile):
+        if self._accumulator and self._accumulator.add(tile):
+            return
+        data = numpy.ascontiguousarray(tile.data, dtype=numpy.float32)
+        h, w = data.shape
+        if self._file is None:
+            self._file = open(self._ccds_dir / f'{self._ccd_name}.{self._token}.tiles', 'wb')
+        self._file.write(data)
+        self._entries.append((tile.level, tile.i, tile.j, self._offset, h, w))
+        self._offset += data.nbytes
+
+    def flush(self):
+        """
+        Makes the tiles put so far visible to the readers.
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        index = numpy.array(self._entries, dtype=_index_dtype)
+        tmpfile = self._ccds_dir / f'.{self._ccd_name}.index.npy'
+        numpy.save(tmpfile, index)
+        tmpfile.rename(self._ccds_dir / f'{self._ccd_name}.{self._token}.{self._seq}.index.npy')
+        self._seq += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class _VisitIndex:
+    def __init__(self):
+        self.generations: dict[str, str] = {}  # ccd_name -> indexのファイル名
+        self.tiles: dict[tuple[int, int, int], dict[str, tuple[int, int, int]]] = {}  # (level, i, j) -> {ccd_name: (offset, h, w)}
+        self.ccd_tiles: dict[str, list[tuple[int, int, int]]] = {}
+        self.files: dict[str, mmap.mmap] = {}
+
+    def update(self, ccds_dir: Path, index_names: Iterable[str]):
+        latest: dict[str, tuple[tuple[int, int], str]] = {}
+        for name in index_names:
+            ccd_name, token, seq = name.split('.')[:3]
+            generation = int(token), int(seq)
+            if ccd_name not in latest or generation > latest[ccd_name][0]:
+                latest[ccd_name] = generation, name
+        for ccd_name, ((token, _), name) in latest.items():
+            if self.generations.get(ccd_name) == name:
+                continue
+            try:
+                index = numpy.load(ccds_dir / name)
+                with open(ccds_dir / f'{ccd_name}.{token}.tiles', 'rb') as f:
+                    # indexより前に書き出されたデータは全てmapされる
+                    file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if len(index) > 0 else None
+            except FileNotFoundError:  # pragma: no cover
+                continue  # 再処理で消された
+            self._remove(ccd_name)
+            if file is not None:
+                self.files[ccd_name] = file
+            for level, i, j, offset, h, w in index.tolist():
+                self.tiles.setdefault((level, i, j), {})[ccd_name] = (offset, h, w)
+            self.ccd_tiles[ccd_name] = [(level, i, j) for level, i, j, *_ in index.tolist()]
+            self.generations[ccd_name] = name
+
+    def _remove(self, ccd_name: str):
+        for key in self.ccd_tiles.pop(ccd_name, []):
+            tiles = self.tiles[key]
+            del tiles[ccd_name]
+            if len(tiles) == 0:
+                del self.tiles[key]
+        self.files.pop(ccd_name, None)
+
+    def arrays(self, key: tuple[int, int, int]) -> list[numpy.ndarray]:
+        return [
+            numpy.frombuffer(self.files[ccd_name], dtype=numpy.float32, count=h * w, offset=offset).reshape(h, w)
+            for ccd_name, (offset, h, w) in self.tiles.get(key, {}).items()
+        ]
+
+
 class _GeneratorTmpTile:
-    def put_tile(self, ccd_id: CcdId, tile: Tile):
-        outfile = Path(f'{self.visit_dir(tile.visit)}/tiles/{tile.level}/{tile.i}/{tile.j}/{ccd_id.ccd_name}.npy')
-        outfile.parent.mkdir(parents=True, exist_ok=True)
-        outfile.write_bytes(ndarray2npybytes(tile.data))
+    max_cached_visits = 2  # mapしたままだと消したvisitの/dev/shmが解放されないので少なく
+
+    def __init__(self):
+        self._indexes: OrderedDict[Path, tuple[frozenset[str], _VisitIndex]] = OrderedDict()
+        self._accumulators: OrderedDict[Path, TileAccumulator] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reset(self, visit: Visit) -> str | None:
+        """
+        Deletes the tiles of `visit` and creates a new accumulator if `config.tile_accumulate_min_level` is set.
+        Returns the name of the accumulator that the writers of this generation should add into.
+        """
+        # 再試行されたタスクのCCDが二重に足されないように、タスクごとに作り直す
+        self.delete(visit)
+        if config.tile_accumulate_min_level is None:
+            return None
+        visit_dir = self.visit_dir(visit)
+        visit_dir.mkdir(parents=True, exist_ok=True)
+        name = f'accumulator.{time.time_ns()}.{config.tile_accumulate_min_level}.tiles'
+        os.close(os.open(visit_dir / name, os.O_RDWR | os.O_CREAT | os.O_EXCL))
+        return name
+
+    def _accumulator(self, visit: Visit) -> TileAccumulator | None:
+        # 読み手は最新のものを使う
+        visit_dir = self.visit_dir(visit)
+        try:
+            names = [n for n in os.listdir(visit_dir) if n.startswith('accumulator.')]
+        except FileNotFoundError:
+            names = []
+        path = visit_dir / max(names, key=lambda n: int(n.split('.')[1])) if names else None
+        try:
+            ino = os.stat(path).st_ino if path else None
+        except FileNotFoundError:
+            ino = None
+        with self._lock:
+            # 別のプロセスでresetされた古い世代はunmapする
+            for p in [p for p, acc in self._accumulators.items() if p.parent == visit_dir and (p != path or acc.ino != ino)]:
+                self._accumulators.pop(p).close()
+            if path is None or ino is None:
+                return None
+            acc = self._accumulators.get(path)
+            if acc is None:
+                while len(self._accumulators) >= self.max_cached_visits:
+                    self._accumulators.popitem(last=False)[1].close()
+                acc = self._accumulators[path] = TileAccumulator(path)
+            self._accumulators.move_to_end(path)
+            return acc
+
+    @contextmanager
+    def writer(self, ccd_id: CcdId, accumulator: str | None = None) -> Iterator[TmpTileWriter]:
+        ccds_dir = self.ccds_dir(ccd_id.visit)
+        ccds_dir.mkdir(parents=True, exist_ok=True)
+        # workerはCCDごとにmapする。常駐するworkerが消されたvisitのページを持ち続けないように
+        acc = TileAccumulator(self.visit_dir(ccd_id.visit) / accumulator) if accumulator else None
+        w = TmpTileWriter(ccds_dir, ccd_id.ccd_name, acc)
+        try:
+            yield w
+            w.flush()
+        finally:
+            w.close()
+            if acc:
+                acc.close()
+
+    def _index(self, visit: Visit) -> _VisitIndex:
+        ccds_dir = self.ccds_dir(visit)
+        try:
+            names = frozenset(name for name in os.listdir(ccds_dir) if name.endswith('.index.npy') and not name.startswith('.'))
+        except FileNotFoundError:
+            names = frozenset()
+        with self._lock:
+            if ccds_dir in self._indexes:
+                self._indexes.move_to_end(ccds_dir)
+                seen, index = self._indexes[ccds_dir]
+            else:
+                while len(self._indexes) >= self.max_cached_visits:
+                    self._indexes.popitem(last=False)
+                seen, index = frozenset(), _VisitIndex()
+            if seen != names:
+                index.update(ccds_dir, names)
+            self._indexes[ccds_dir] = names, index
+            return index
 
     def iter_tiles(self, visit: Visit) -> Generator[tuple[int, int, int], None, None]:
-        for p in Path(f'{config.tile_tmpdir}/{visit.id}/tiles').iterdir():
-            if p.is_dir():  # pragma: no branch
-                for q in p.iterdir():
-                    if q.is_dir():  # pragma: no branch
-                        for r in q.iterdir():
-                            if r.is_dir():  # pragma: no branch
-                                yield int(p.name), int(q.name), int(r.name)
+        tiles = [*self._index(visit).tiles]
+        acc = self._accumulator(visit)
+        if acc:
+            tiles = [*set(tiles).union(acc.keys())]
+        yield from tiles
 
     def visit_dir(self, visit: Visit):
         return Path(f'{config.tile_tmpdir}/{visit.id}')
 
+    def ccds_dir(self, visit: Visit):
+        return self.visit_dir(visit) / 'ccds'
+
+    def has_tile(self, visit: Visit, level: int, i: int, j: int) -> bool:
+        if (level, i, j) in self._index(visit).tiles:
+            return True
+        acc = self._accumulator(visit)
+        return acc is not None and acc.get((level, i, j)) is not None
+
     def get_tile_npy(self, visit: Visit, level: int, i: int, j: int) -> numpy.ndarray:
-        pool: numpy.ndarray | None = None
-        for path in Path(f'{self.visit_dir(visit)}/tiles/{level}/{i}/{j}').glob('*.npy'):
-            arr = numpy.load(path)
-            if pool is None:
-                pool = arr
-            else:
-                pool += arr
-        if pool is None:  # pragma: no cover
-            pool = numpy.zeros((config.tile_size, config.tile_size), dtype=numpy.float32)
+        """
+        Returns the sum of the tiles of all the CCDs.
+        If the tile is in only one file (a CCD or the accumulator), a read-only view of the mapped file is returned.
+        """
+        arrays = self._index(visit).arrays((level, i, j))
+        acc = self._accumulator(visit)
+        if acc and (summed := acc.get((level, i, j))) is not None:
+            arrays.append(summed)
+        if len(arrays) == 0:  # pragma: no cover
+            return numpy.zeros((config.tile_size, config.tile_size), dtype=numpy.float32)
+        if len(arrays) == 1:
+            return arrays[0]
+        pool = arrays[0] + arrays[1]
+        for arr in arrays[2:]:
+            pool += arr
         return pool
 
     def delete(self, visit: Visit):
+        with self._lock:
+            self._indexes.pop(self.ccds_dir(visit), None)
+            for path in [p for p in self._accumulators if p.parent == self.visit_dir(visit)]:
+                self._accumulators.pop(path).close()
         try:
             shutil.rmtree(Path(f'{config.tile_tmpdir}/{visit.id}'))
         except FileNotFoundError:
             pass
 
     def delete_all(self):
+        with self._lock:
+            self._indexes.clear()
+            for acc in self._accumulators.values():
+                acc.close()
+            self._accumulators.clear()
         try:
             shutil.rmtree(Path(config.tile_tmpdir))
         except FileNotFoundError:
@@ -13,22 +13,35 @@ class IsrConfig:
     do_row_bias: bool = True
 
 
-def bias_correction(data: numpy.ndarray, datasec: DataSection, config: IsrConfig = IsrConfig()):
+def bias_correction(
+    data: numpy.ndarray,
+    datasec: DataSection,
+    config: IsrConfig = IsrConfig(),
+    *,
+    out: numpy.ndarray | None = None,
+):
+    '''
+    Returns the bias corrected data section of `data` as float32.
+    `data` may be of any dtype and byte order (e.g. a big-endian view of the FITS buffer); it is not modified.
+    If `out` is given, the result is written into it. It can be any view of the output (e.g. transposed or flipped).
+    '''
     (x1, x2), (y1, y2) = datasec
     assert x1 < x2
     assert y1 < y2
-    # h, w = hdu.data.shape
-    data = numpy.array(data, dtype=numpy.float32)
-    # assert config.do_row_bias is False
-    if config.do_row_bias:  # pragma: no branch
-        row_bias = data[:, x2:].mean(axis=1)
-        operator.isub(data.T, row_bias)
-        # ↑ is equivalent to ↓
-        # data -= numpy.repeat(row_bias.reshape((-1, 1)), w, axis=1)
+    h, w = data.shape
+    # overscanの領域だけをfloat32にして補正値を求める
+    row_bias = data[:, x2:].mean(axis=1, dtype=numpy.float32) if config.do_row_bias else numpy.zeros(h, dtype=numpy.float32)
     if config.do_col_bias:  # pragma: no branch
-        col_bias = data[y2 - 1 :, :].mean(axis=0)
-        data -= col_bias
-    return data[y1 - 1 : y2, x1 - 1 : x2]
+        overscan = numpy.subtract(data[y2 - 1 :, :], row_bias[y2 - 1 :, None], dtype=numpy.float32)
+        col_bias = overscan.mean(axis=0)
+    else:  # pragma: no cover
+        col_bias = numpy.zeros(w, dtype=numpy.float32)
+    if out is None:
+        out = numpy.empty((y2 - y1 + 1, x2 - x1 + 1), dtype=numpy.float32)
+    # data sectionだけを、変換しながら直接outに書き込む
+    numpy.subtract(data[y1 - 1 : y2, x1 - 1 : x2], row_bias[y1 - 1 : y2, None], out=out, dtype=numpy.float32)
+    operator.isub(out, col_bias[x1 - 1 : x2])
+    return out
 
 
 def parse_slice(s: str) -> DataSection:
@@ -1,119 +1,171 @@
-from typing import Callable
+from dataclasses import dataclass
+from typing import Callable, Generator, Iterable
 
 import numpy
 
 from quicklook.config import config
-from quicklook.types import PreProcessedCcd, Progress, Tile
+from quicklook.types import PreProcessedCcd, Progress, Tile, Visit
 
 
 def iterate_tiles(
     ppccd: PreProcessedCcd,
     cb: Callable[[Tile, Progress], None],
+    *,
+    coarse_min_level: int | None = None,
+    on_coarse_done: Callable[[], None] | None = None,
 ):
+    """
+    Calls `cb` for each tile of `ppccd`.
+
+    Tiles are made from level 0 to `config.tile_max_level`.
+    If `coarse_min_level` is given, the tiles of `level >= coarse_min_level` are made first
+    and `on_coarse_done` is called before the rest of the tiles are made.
+    """
     progress = Progress(
         count=0,
         total=calc_num_total_tiles(ppccd),
     )
-    tile_size = config.tile_size
-    max_level = config.tile_max_level
-    data = ppccd.pool
-    h, w = data.shape
-    y1 = int(ppccd.bbox.miny)  # focal planeでの始まりのy-index
-    x1 = int(ppccd.bbox.minx)
-    y2 = int(y1 + h)  # 終わりのindex
-    x2 = int(x1 + w)
-    for level in range(max_level + 1):  # pragma: no branch
-        tile_yi1 = y1 // tile_size
-        tile_yi2 = (y2 - 1) // tile_size + 1
-        tile_xi1 = x1 // tile_size
-        tile_xi2 = (x2 - 1) // tile_size + 1
-        for tile_yi in range(tile_yi1, tile_yi2):
-            tile_y1 = tile_yi * tile_size
-            tile_y2 = tile_y1 + tile_size
-            for tile_xi in range(tile_xi1, tile_xi2):
-                tile_x1 = tile_xi * tile_size
-                tile_x2 = tile_x1 + tile_size
-                tile_data = safe_slice(data, x1, y1, tile_x1, tile_y1, tile_x2, tile_y2)
-                progress.count += 1
-                cb(Tile(visit=ppccd.ccd_id.visit, level=level, i=tile_yi, j=tile_xi, data=tile_data), progress)
-        if level >= max_level:
-            break
-        data = shrink_image(data, y1 % 2, y2 % 2, x1 % 2, x2 % 2)
-        if y1 % 2 != 0:
-            y1 -= 1
-        if y2 % 2 != 0:
-            y2 += 1
-        if x1 % 2 != 0:
-            x1 -= 1
-        if x2 % 2 != 0:
-            x2 += 1
-        y1 //= 2
-        x1 //= 2
-        y2 //= 2
-        x2 //= 2
+    levels: Iterable[_Level] = _iterate_levels(ppccd)
+    if coarse_min_level is not None:
+        # 縮小はlevel 0から順にしかできないので、先に全てのlevelの画像を作っておく
+        all_levels = [*levels]
+        levels = [lv for lv in all_levels if lv.level >= coarse_min_level] + [lv for lv in all_levels if lv.level < coarse_min_level]
+        del all_levels
+    coarse_done = coarse_min_level is None
+    for lv in levels:
+        if not coarse_done and lv.level < coarse_min_level:  # type: ignore[operator]
+            coarse_done = True
+            if on_coarse_done:
+                on_coarse_done()
+        for tile in lv.tiles(ppccd.ccd_id.visit):
+            progress.count += 1
+            cb(tile, progress)
+    if not coarse_done and on_coarse_done:
+        on_coarse_done()
 
 
-def safe_slice(
-    pool: numpy.ndarray,
-    pool_x1: int,  # focal planeでの始まりのx-index
-    pool_y1: int,
-    x1: int,  # tileでの始まりのx-index
-    y1: int,
-    x2: int,  # tileでの終わりのx-index
-    y2: int,
-):
-    if x1 >= pool_x1 and y1 >= pool_y1 and x2 <= pool_x1 + pool.shape[1] and y2 <= pool_y1 + pool.shape[0]:
-        return pool[y1 - pool_y1 : y2 - pool_y1, x1 - pool_x1 : x2 - pool_x1]
-    zeros = numpy.zeros((y2 - y1, x2 - x1), dtype=pool.dtype)
-    x1_ = max(x1, pool_x1)
-    y1_ = max(y1, pool_y1)
-    x2_ = min(x2, pool_x1 + pool.shape[1])
-    y2_ = min(y2, pool_y1 + pool.shape[0])
-    zeros[y1_ - y1 : y2_ - y1, x1_ - x1 : x2_ - x1] = pool[
-        y1_ - pool_y1 : y2_ - pool_y1,
-        x1_ - pool_x1 : x2_ - pool_x1,
-    ]
-    return zeros
-
-
-def shrink_image(
-    data: numpy.ndarray,  # 2D array
-    y1: int,
-    y2: int,
-    x1: int,
-    x2: int,
-):
-    if y1 != 0:
-        data = numpy.vstack((numpy.zeros(data.shape[1], dtype=numpy.float32), data))
-    if y2 != 0:
-        data = numpy.vstack((data, numpy.zeros(data.shape[1], dtype=numpy.float32)))
-    if x1 != 0:
-        data = numpy.hstack((numpy.zeros((data.shape[0], 1), dtype=numpy.float32), data))
-    if x2 != 0:
-        data = numpy.hstack((data, numpy.zeros((data.shape[0], 1), dtype=numpy.float32)))
-    h, w = data.shape
-    data = numpy.mean(data.reshape(h // 2, 2, w // 2, 2), axis=(1, 3))
-    return data
+@dataclass
+class _Level:
+    level: int
+    data: numpy.ndarray  # tileの境界に揃えたbuffer
+    y1: int  # focal planeでのdataの始まりのy-index（tile_sizeの倍数）
+    x1: int
+
+    def tiles(self, visit: Visit) -> Generator[Tile, None, None]:
+        tile_size = config.tile_size
+        h, w = self.data.shape
+        for yi in range(0, h, tile_size):
+            for xi in range(0, w, tile_size):
+                # copyせずにbufferのviewを渡す
+                tile_data = self.data[yi : yi + tile_size, xi : xi + tile_size]
+                yield Tile(visit=visit, level=self.level, i=(self.y1 + yi) // tile_size, j=(self.x1 + xi) // tile_size, data=tile_data)
+
+
+def _iterate_levels(ppccd: PreProcessedCcd) -> Generator[_Level, None, None]:
+    pyramid = _Pyramid(ppccd)
+    for level in range(len(pyramid.levels)):
+        yield pyramid.build(level)
+
+
+class _Pyramid:
+    """
+    Tile-aligned buffers of all the levels of a CCD.
+
+    The buffers are allocated at once and a level is made by averaging 2x2 pixels of the previous level in place.
+    Pixels outside of the CCD are 0 and NaN pixels are excluded from the average.
+    """
+
+    def __init__(self, ppccd: PreProcessedCcd):
+        tile_size = config.tile_size
+        assert tile_size % 2 == 0
+        data = ppccd.pool
+        h, w = data.shape
+        y1 = int(ppccd.bbox.miny)
+        x1 = int(ppccd.bbox.minx)
+        shapes = [
+            (level, ri.start * tile_size, rj.start * tile_size, len(ri) * tile_size, len(rj) * tile_size)
+            for level, ri, rj in tile_ranges(y1, y1 + h, x1, x1 + w)
+        ]
+        arena = numpy.zeros(sum(bh * bw for _, _, _, bh, bw in shapes), dtype=numpy.float32)
+        self.levels: list[_Level] = []
+        offset = 0
+        for level, by1, bx1, bh, bw in shapes:
+            self.levels.append(_Level(level, arena[offset : offset + bh * bw].reshape(bh, bw), by1, bx1))
+            offset += bh * bw
+        lv0 = self.levels[0]
+        lv0.data[y1 - lv0.y1 : y1 - lv0.y1 + h, x1 - lv0.x1 : x1 - lv0.x1 + w] = data
+        # 合計がNaNでなければNaNの画素はない（配列を確保せずに調べられる）
+        self._has_nan = bool(numpy.isnan(data.sum()))
+        self._nan_scratch: tuple[numpy.ndarray, numpy.ndarray] | None = None
+        self._built = 1
+
+    def build(self, level: int) -> _Level:
+        while self._built <= level:
+            self._shrink(self.levels[self._built - 1], self.levels[self._built])
+            self._built += 1
+        return self.levels[level]
+
+    def _shrink(self, src: _Level, dst: _Level):
+        sh, sw = src.data.shape
+        dh, dw = dst.data.shape
+        # dstのうちsrcに対応する範囲（dstの座標）
+        y1 = max(dst.y1, src.y1 // 2)
+        y2 = min(dst.y1 + dh, (src.y1 + sh) // 2)
+        x1 = max(dst.x1, src.x1 // 2)
+        x2 = min(dst.x1 + dw, (src.x1 + sw) // 2)
+        if y1 >= y2 or x1 >= x2:  # pragma: no cover
+            return
+        s = src.data[2 * y1 - src.y1 : 2 * y2 - src.y1, 2 * x1 - src.x1 : 2 * x2 - src.x1]
+        d = dst.data[y1 - dst.y1 : y2 - dst.y1, x1 - dst.x1 : x2 - dst.x1]
+        quads = (s[0::2, 0::2], s[0::2, 1::2], s[1::2, 0::2], s[1::2, 1::2])
+        if self._has_nan:
+            self._has_nan = self._shrink_nan(quads, d)
+        else:
+            numpy.add(quads[0], quads[1], out=d)
+            numpy.add(d, quads[2], out=d)
+            numpy.add(d, quads[3], out=d)
+            d *= 0.25
+
+    def _shrink_nan(self, quads: tuple[numpy.ndarray, ...], d: numpy.ndarray) -> bool:
+        if self._nan_scratch is None:
+            # level 1の大きさがあれば全てのlevelで使える
+            size = self.levels[1].data.size
+            self._nan_scratch = (numpy.empty(size, dtype=numpy.float32), numpy.empty(size, dtype=bool))
+        count = self._nan_scratch[0][: d.size].reshape(d.shape)
+        valid = self._nan_scratch[1][: d.size].reshape(d.shape)
+        d.fill(0)
+        count.fill(0)
+        for q in quads:
+            numpy.isnan(q, out=valid)
+            numpy.logical_not(valid, out=valid)
+            numpy.add(d, q, out=d, where=valid)
+            numpy.add(count, valid, out=count)
+        numpy.greater(count, 0, out=valid)
+        numpy.divide(d, count, out=d, where=valid)
+        # 4画素とも NaN の場合だけ NaN が残る
+        numpy.logical_not(valid, out=valid)
+        numpy.copyto(d, numpy.nan, where=valid)
+        return bool(valid.any())
 
 
 def calc_num_total_tiles(
     ccd: PreProcessedCcd,
 ):
-    tile_size = config.tile_size
-    max_level = config.tile_max_level
-    data = ccd.pool
-    h, w = data.shape
+    h, w = ccd.pool.shape
     y1 = int(ccd.bbox.miny)  # focal planeでの始まりのy-index
     x1 = int(ccd.bbox.minx)
-    y2 = int(y1 + h)  # 終わりのindex
-    x2 = int(x1 + w)
-    num_tiles = 0
-    for _ in range(max_level + 1):
-        tile_yi1 = y1 // tile_size
-        tile_yi2 = (y2 - 1) // tile_size + 1
-        tile_xi1 = x1 // tile_size
-        tile_xi2 = (x2 - 1) // tile_size + 1
-        num_tiles += (tile_yi2 - tile_yi1) * (tile_xi2 - tile_xi1)
+    return sum(len(ri) * len(rj) for _, ri, rj in tile_ranges(y1, y1 + h, x1, x1 + w))
+
+
+def tile_ranges(y1: int, y2: int, x1: int, x2: int) -> Generator[tuple[int, range, range], None, None]:
+    """
+    Yields (level, range of i, range of j) of the tiles that `iterate_tiles` makes
+    for an image covering [y1, y2) x [x1, x2) of the focal plane.
+    """
+    tile_size = config.tile_size
+    max_level = config.tile_max_level
+    for level in range(max_level + 1):
+        yield level, range(y1 // tile_size, (y2 - 1) // tile_size + 1), range(x1 // tile_size, (x2 - 1) // tile_size + 1)
         if y1 % 2 != 0:
             y1 -= 1
         if y2 % 2 != 0:
@@ -126,4 +178,3 @@ def calc_num_total_tiles(
             x2 += 1
         x1 //= 2
         x2 //= 2
-    return num_tiles
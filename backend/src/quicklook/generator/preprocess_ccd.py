@@ -1,9 +1,8 @@
 import functools
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Iterable, Literal
 
-import astropy.io.fits as afits
 import mineo_fits_decompress
 import numpy
 
@@ -11,7 +10,7 @@ from quicklook.config import config
 from quicklook.generator.isr import bias_correction, parse_slice
 from quicklook.tileinfo import ccds_by_name
 from quicklook.types import AmpMeta, BBox, CcdId, ImageStat, PreProcessedCcd
-from quicklook.utils.fitsheader import fitsheader_to_list
+from quicklook.utils.fits import FitsHdu, parse_hdus
 from quicklook.utils.timeit import timeit
 
 from .isr import parse_slice
@@ -19,28 +18,28 @@ from .isr import parse_slice
 
 def preprocess_ccd(
     ccd_id: CcdId,
-    path: Path,
+    fits: Path | memoryview,
 ) -> PreProcessedCcd:
     match ccd_id.visit.data_type:
         case 'raw':
-            return preprocess_ccd_raw(ccd_id, path)
+            return preprocess_ccd_raw(ccd_id, fits)
         case 'post_isr_image' | 'calexp' | 'preliminary_visit_image':
-            return preprocess_ccd_calexp(ccd_id, path)
+            return preprocess_ccd_calexp(ccd_id, fits)
         case _:  # pragma: no cover
             raise ValueError(f'Unknown data_type: {ccd_id.visit.data_type}')
 
 
 def preprocess_ccd_calexp(
     ccd_id: CcdId,
-    path: Path,
+    fits: Path | memoryview,
 ) -> PreProcessedCcd:
     ccd_name = ccd_id.ccd_name
     with timeit(f'preprocess-{ccd_id.name}'):
-        hdul = fast_open_comressed_fits(path)
+        hdus = fast_open_comressed_fits(fits)
         # header = hdul[0].header  # type: ignore
         # assert ccd_name == f'{header["RAFTNAME"]}_{header["SENSNAME"]}'
         bbox = ccds_by_name()[ccd_name].bbox
-        pool: numpy.ndarray = numpy.array(hdul[1].data, dtype='<f4')  # type: ignore
+        pool: numpy.ndarray = numpy.array(hdus[1].data, dtype='<f4')
         with timeit(f'image-stat-{ccd_id.name}'):
             stat = image_stat(pool)
         return PreProcessedCcd(
@@ -49,7 +48,7 @@ def preprocess_ccd_calexp(
             pool=pool,
             stat=stat,
             amps=[],
-            headers=fitsheader_to_list(hdul),
+            raw_headers=[bytes(hdu.header) for hdu in hdus],
         )
 
 
@@ -61,11 +60,12 @@ class RawAmp:
     wcs: 'RawFitsWcs'
 
     @classmethod
-    def from_hdu(cls, fits_index: int, hdu: afits.ImageHDU):
-        header: dict[str, Any] = dict(hdu.header)  # type: ignore
+    def from_hdu(cls, fits_index: int, hdu: FitsHdu):
+        header = hdu.cards
         wcs = RawFitsWcs.from_header(header)
-        datasec = parse_slice(header['DATASEC'])  # type: ignore
-        raw: numpy.ndarray = hdu.data.copy()  # type: ignore
+        datasec = parse_slice(header['DATASEC'])
+        # bufferのviewのまま渡し、bias_correctionの中でnativeなfloat32への変換を１回だけ行う
+        raw: numpy.ndarray = hdu.data  # type: ignore
         corrected = bias_correction(raw, datasec=datasec)
         return cls(
             fits_index=fits_index,
@@ -77,15 +77,14 @@ class RawAmp:
 
 def preprocess_ccd_raw(
     ccd_id: CcdId,
-    path: Path,
+    fits: Path | memoryview,
 ) -> PreProcessedCcd:
     ccd_name = ccd_id.ccd_name
     with timeit(f'preprocess-{ccd_id.name}'):
-        hdul = fast_open_comressed_fits(path)
-        header = hdul[0].header  # type: ignore
+        hdus = fast_open_comressed_fits(fits, RAW_CARDS)
+        header = hdus[0].cards
         assert ccd_name == f'{header["RAFTBAY"]}_{header["CCDSLOT"]}'
-        amps = [RawAmp.from_hdu(j, hdu) for j, hdu in enumerate(hdul) if hdu.name.startswith('Segment')]  # type: ignore
-        assembly = assemble_raw_amps(amps, ccd_name)
+        assembly = assemble_raw_amps([hdu for hdu in hdus if hdu.name.startswith('Segment')], ccd_name)
         with timeit(f'image-stat-{ccd_id.name}'):
             stat = image_stat(assembly.data)
         return PreProcessedCcd(
@@ -94,13 +93,16 @@ def preprocess_ccd_raw(
             pool=assembly.data,
             stat=stat,
             amps=assembly.amp_metas,
-            headers=fitsheader_to_list(hdul),
+            raw_headers=[bytes(hdu.header) for hdu in hdus],
         )
 
 
-def fast_open_comressed_fits(path: Path):
-    buf = mineo_fits_decompress.decompressed_bytes(path, config.fitsio_decompress_parallel)
-    return afits.HDUList.fromstring(buf)
+def fast_open_comressed_fits(fits: Path | memoryview, keys: Iterable[str] = ()) -> list[FitsHdu]:
+    if isinstance(fits, Path):
+        buf = mineo_fits_decompress.decompressed_bytes(fits, config.fitsio_decompress_parallel)
+    else:
+        buf = mineo_fits_decompress.decompressed_bytes_from_buffer(fits, config.fitsio_decompress_parallel)
+    return parse_hdus(buf, keys)
 
 
 @dataclass
@@ -110,7 +112,7 @@ class AssemblyResult:
     amp_metas: list[AmpMeta]
 
 
-def assemble_raw_amps(amps: Iterable[RawAmp], ccd_name: str) -> AssemblyResult:
+def assemble_raw_amps(hdus: Iterable[FitsHdu], ccd_name: str) -> AssemblyResult:
     # bbox = functools.reduce(lambda a, b: a.union(b.wcs.bbox), amps[1:], amps[0].wcs.bbox)
     bbox = ccds_by_name()[ccd_name].bbox
     pool = numpy.zeros(
@@ -118,16 +120,18 @@ def assemble_raw_amps(amps: Iterable[RawAmp], ccd_name: str) -> AssemblyResult:
         dtype=numpy.float32,
     )
     amp_metas: list[AmpMeta] = []
-    for amp in amps:
-        aligned = amp.wcs.align(amp.data)
-        b = amp.wcs.bbox
-        pool[
+    for hdu in hdus:
+        wcs = RawFitsWcs.from_header(hdu.cards)
+        b = wcs.bbox
+        dst = pool[
             int(b.miny - bbox.miny) : int(b.maxy - bbox.miny + 1),
             int(b.minx - bbox.minx) : int(b.maxx - bbox.minx + 1),
-        ] = aligned
+        ]
+        # 補正したdata sectionをampの向きのviewを通してpoolに直接書き込む
+        bias_correction(hdu.data, wcs.data_section, out=wcs.unalign(dst))  # type: ignore
         amp_metas.append(
             AmpMeta(
-                amp_id=amp.fits_index,
+                amp_id=hdu.index,
                 bbox=b,
             )
         )
@@ -138,9 +142,32 @@ def assemble_raw_amps(amps: Iterable[RawAmp], ccd_name: str) -> AssemblyResult:
     )
 
 
-def image_stat(array: numpy.ndarray):
-    median: Any = numpy.median(array)
-    mad: Any = numpy.median(numpy.absolute(array - median))
+IMAGE_STAT_SAMPLES = 1 << 18
+
+
+def image_stat(array: numpy.ndarray, method: Literal['exact', 'sample'] | None = None):
+    '''
+    Median and MAD of the finite pixels of `array`. They are None if there is no finite pixel.
+
+    With method='sample' they are computed from a regular grid of about IMAGE_STAT_SAMPLES pixels.
+    For i.i.d. samples, the DKW inequality would put the estimated median between the 49.5th and 50.5th
+    percentiles of the image with a probability of about 1 - 4e-6 (2 exp(-2 n 0.005^2) with n = 2^18),
+    and likewise the MAD for the absolute deviations. The grid is not random, so this is only a heuristic:
+    it holds as long as the image has no structure aligned with the grid.
+    '''
+    method = method or config.image_stat_method
+    sample = array
+    if method == 'sample':
+        step = max(1, int((array.size / IMAGE_STAT_SAMPLES) ** 0.5))
+        # 各区画の中央の画素を使う
+        sample = array[step // 2 :: step, step // 2 :: step]
+    finite = numpy.isfinite(sample)
+    # post_isr_imageにはNaNが含まれることがある
+    values = sample if finite.all() else sample[finite]
+    if values.size == 0:
+        return ImageStat(median=None, mad=None, shape=array.shape)
+    median: Any = numpy.median(values)
+    mad: Any = numpy.median(numpy.absolute(values - median))
     return ImageStat(
         median=float(median),
         mad=float(mad),
@@ -148,6 +175,11 @@ def image_stat(array: numpy.ndarray):
     )
 
 
+_WCS_FIELDS = 'PC1_1 PC1_2 PC2_1 PC2_2 CRVAL1 CRVAL2'.split()
+# rawのpreprocessで読むcard
+RAW_CARDS = ['RAFTBAY', 'CCDSLOT', 'DATASEC', *(f'{f}E' for f in _WCS_FIELDS)]
+
+
 @dataclass
 class RawFitsWcs:
     PC1_1: float
@@ -163,7 +195,7 @@ class RawFitsWcs:
         d: Any = {
             'DATASEC': header['DATASEC'],
         }
-        for f in 'PC1_1 PC1_2 PC2_1 PC2_2 CRVAL1 CRVAL2'.split():
+        for f in _WCS_FIELDS:
             d[f] = float(header[f'{f}{wcs_system}'])
         return cls(**d)
 
@@ -212,3 +244,19 @@ class RawFitsWcs:
         if ey[1] < 0:  # pragma: no branch
             data = data[::-1]
         return data
+
+    def unalign(self, aligned: numpy.ndarray):
+        '''
+        Inverse of `align`. Returns a view of `aligned` in the orientation of the data section.
+        '''
+        ex, ey = self.pc.T
+        transpose = abs(ex[0]) < abs(ey[0])
+        if transpose:  # pragma: no branch
+            ex, ey = ey, ex
+        if ey[1] < 0:  # pragma: no branch
+            aligned = aligned[::-1]
+        if ex[0] < 0:
+            aligned = aligned[:, ::-1]
+        if transpose:  # pragma: no branch
+            aligned = aligned.T
+        return aligned
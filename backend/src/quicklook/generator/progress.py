@@ -1,53 +1,76 @@
 import contextlib
-import multiprocessing
-import queue
+import struct
 import threading
 import time
 from dataclasses import dataclass
-from functools import cached_property
-from typing import Any, Callable
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
 
+import numpy
 import tqdm
 
 from quicklook.coordinator.quicklookjob.tasks import GenerateTask
-from quicklook.types import GenerateProgress, GenerateTaskResponse, Progress
+from quicklook.tileinfo import ccd_list
+from quicklook.types import CcdId, GenerateProgress, GenerateTaskResponse, Progress
 from quicklook.utils.exitstack import exit_stack
 
+# 進捗はCCDごとのslotに書き込まれ、GeneratorProgressReporterが定期的に読み取る
+# 1つのslotに書き込むのはそのCCDを処理するworkerだけなのでlockは要らない
+_PREPROCESS_DONE, _MAKETILE_COUNT, _MAKETILE_TOTAL, _COARSE_DONE = range(4)
+_SLOT_FIELDS = 4
+# slotの前にタスク全体のfieldを置く
+_CANCELLED = 0
+_HEADER_FIELDS = 1
+_field = struct.Struct('<q')
+
 
 class GeneratorProgressReporter:
+    sample_interval = 0.1
+    refresh_interval = 3  # 変化がなくてもこの間隔で送る（coordinatorのsock_readのタイムアウトより短く）
+
     def __init__(
         self,
         task: GenerateTask,
         *,
         on_update: Callable[[GenerateProgress], None] | None = None,
+        on_coarse_done: Callable[[CcdId], None] | None = None,
     ):
         self._task = task
         self._on_update = on_update
+        self._on_coarse_done = on_coarse_done
         self._progress = GenerateProgress(
             download=Progress(0, len(task.ccd_names)),
             preprocess=Progress(0, len(task.ccd_names)),
             maketile=Progress(0, 0),
         )
+        # pullモードではどのCCDを受け取るかわからないので、焦点面の全てのCCDの分を用意する
+        self._capacity = max(len(task.ccd_names), len(ccd_list()))
+        self._slot_ccds: list[CcdId] = []
+        self._coarse_reported: set[int] = set()
+        self._maketile_size = len(task.ccd_names)
+        self._lock = threading.Lock()
         self._stop_event = threading.Event()
         self._refresh()
 
     def __enter__(self):
         with exit_stack() as self._exit_stack:
-            self._exit_stack = contextlib.ExitStack()
-            manager = multiprocessing.Manager()
-            self._exit_stack.enter_context(manager)
-            self._q = manager.Queue()
-            self._exit_stack.enter_context(self._watch())
-            self._exit_stack.enter_context(self._periodic_refresh())
+            self._shm = SharedMemory(create=True, size=(_HEADER_FIELDS + self._capacity * _SLOT_FIELDS) * _field.size)
+            self._exit_stack.callback(self._release_shm)
+            self._shm.buf[:] = bytes(len(self._shm.buf))
+            self._exit_stack.enter_context(self._periodic_sample())
             return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._exit_stack.close()
 
+    def _release_shm(self):
+        self._shm.close()
+        self._shm.unlink()
+
     @contextlib.contextmanager
-    def _periodic_refresh(self):
+    def _periodic_sample(self):
         self._stop_event.clear()
-        t = threading.Thread(target=self._refresh_periodically)
+        t = threading.Thread(target=self._sample_periodically)
         t.daemon = True
         t.start()
         try:
@@ -55,47 +78,40 @@ class GeneratorProgressReporter:
         finally:
             self._stop_event.set()
             t.join()
+            self._sample()
 
-    def _refresh_periodically(self):
-        while not self._stop_event.is_set():
-            # 3秒間待機するか、stopイベントがセットされるまで待機
-            if self._stop_event.wait(3):
-                break
-            # イベントがセットされていなければ更新を実行
-            if not self._stop_event.is_set():
+    def _sample_periodically(self):
+        last_refresh = time.time()
+        while not self._stop_event.wait(self.sample_interval):
+            if self._sample() or time.time() - last_refresh >= self.refresh_interval:
                 self._refresh()
-
-    @contextlib.contextmanager
-    def _watch(self):
-        t = threading.Thread(target=self._watch_thread)
-        t.start()
-        try:
-            yield
-        finally:
-            self._q.put(None)
-            t.join()
-
-    def _watch_thread(self):
-        while True:
-            msg = self._q.get()
-            match msg:
-                case None:
-                    break
-                case PreprocessDoneMsg():
-                    self._progress.preprocess.count += 1
-                    self._refresh()
-                case UpdateMaketileProgressMsg():
-                    self._update_maketile_progress(msg)
-                case _:  # pragma: no cover
-                    raise ValueError(f'Unknown message: {msg}')
-
-    @cached_property
-    def _maketiles_progress_dict(self):
-        return ProgressDict(len(self._task.ccd_names))
-
-    def _update_maketile_progress(self, msg: 'UpdateMaketileProgressMsg'):
-        self._progress.maketile = self._maketiles_progress_dict.update(msg.ccd_name, msg.progress).merged()
-        self._refresh()
+                last_refresh = time.time()
+
+    def _sample(self) -> bool:
+        with self._lock:
+            ccds = [*self._slot_ccds]
+        n = len(ccds)
+        offset = _HEADER_FIELDS * _field.size
+        slots = numpy.frombuffer(bytes(self._shm.buf[offset : offset + n * _SLOT_FIELDS * _field.size]), dtype='<i8').reshape(n, _SLOT_FIELDS)
+
+        for k in numpy.flatnonzero(slots[:, _COARSE_DONE]):
+            if k not in self._coarse_reported:
+                self._coarse_reported.add(k)
+                if self._on_coarse_done:  # pragma: no branch
+                    self._on_coarse_done(ccds[k])
+
+        maketile = ProgressDict(self._maketile_size)
+        for k in numpy.flatnonzero(slots[:, _MAKETILE_TOTAL]):
+            maketile.update(ccds[k].ccd_name, Progress(int(slots[k, _MAKETILE_COUNT]), int(slots[k, _MAKETILE_TOTAL])))
+        preprocess_count = int(slots[:, _PREPROCESS_DONE].sum())
+        merged = maketile.merged()
+
+        changed = preprocess_count != self._progress.preprocess.count or merged != self._progress.maketile
+        self._progress.preprocess.count = preprocess_count
+        self._progress.maketile = merged
+        if changed:
+            self._refresh()
+        return changed
 
     def _refresh(self):
         if self._on_update:  # pragma: no branch
@@ -105,29 +121,61 @@ class GeneratorProgressReporter:
         self._progress.download.count += 1
         self._refresh()
 
-    @cached_property
-    def updator(self):
-        return GeneratorProgressReporter.InterProcessUpdator(self._q)
+    def ccd_assigned(self):
+        # pullモードではCCDの数は受け取るまでわからない
+        self._progress.download.total += 1
+        self._progress.preprocess.total += 1
+        self._maketile_size += 1
+        self._refresh()
+
+    def cancel(self):
+        '''
+        Tells the workers to stop processing the CCDs of this task. See `InterProcessUpdator.cancelled`.
+        '''
+        _field.pack_into(self._shm.buf, _CANCELLED * _field.size, 1)
+
+    def updator(self, ccd_id: CcdId) -> 'GeneratorProgressReporter.InterProcessUpdator':
+        with self._lock:
+            slot = len(self._slot_ccds)
+            if slot >= self._capacity:  # pragma: no cover
+                raise RuntimeError(f'Too many CCDs for the progress block: {ccd_id}')
+            self._slot_ccds.append(ccd_id)
+        return GeneratorProgressReporter.InterProcessUpdator(self._shm.name, slot)
 
     @dataclass
     class InterProcessUpdator:
-        _q: queue.Queue
+        shm_name: str
+        slot: int
 
         def preprocess_done(self):
-            self._q.put(PreprocessDoneMsg())
+            self._set(_PREPROCESS_DONE, 1)
+
+        def update_maketile_progress(self, progress: Progress):
+            self._set(_MAKETILE_TOTAL, progress.total)
+            self._set(_MAKETILE_COUNT, progress.count)
+
+        def coarse_done(self):
+            self._set(_COARSE_DONE, 1)
+
+        def cancelled(self) -> bool:
+            return _field.unpack_from(_attach(self.shm_name).buf, _CANCELLED * _field.size)[0] != 0
 
-        def update_maketile_progress(self, ccd_name: str, progress: Progress):
-            self._q.put(UpdateMaketileProgressMsg(ccd_name, progress))
+        def _set(self, field: int, value: int):
+            _field.pack_into(_attach(self.shm_name).buf, (_HEADER_FIELDS + self.slot * _SLOT_FIELDS + field) * _field.size, value)
 
 
-class PreprocessDoneMsg:
-    pass
+_attached: dict[str, SharedMemory] = {}
 
 
-@dataclass
-class UpdateMaketileProgressMsg:
-    ccd_name: str
-    progress: Progress
+def _attach(name: str) -> SharedMemory:
+    # workerは複数のタスクで使い回されるので、古いものから閉じる
+    shm = _attached.get(name)
+    if shm is None:
+        while len(_attached) >= 8:
+            _attached.pop(next(iter(_attached))).close()
+        # unlinkは作成したGeneratorProgressReporterが行う
+        shm = _attached[name] = SharedMemory(name=name, track=False)
+    return shm
 
 
 class ProgressDict:
@@ -0,0 +1,58 @@
+'''
+Worker pools of the generator.
+
+The supervisor process (see generator/api/supervisor.py) keeps warm pools for the lifetime of the generator,
+so that a task does not pay for forking the workers and importing astropy etc. in them.
+Without the supervisor (e.g. in tests and scripts) a pool is created for each use as before.
+'''
+
+import multiprocessing
+import multiprocessing.pool
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator
+
+from quicklook.utils import multiprocessing_coverage_compatible
+
+_warm_pools: dict[int, multiprocessing.pool.Pool] = {}
+
+
+@contextmanager
+def worker_pool(parallel: int) -> Iterator[multiprocessing.pool.Pool]:
+    pool = _warm_pools.get(parallel)
+    if pool is not None:
+        # 他のタスクと共有しているのでcloseしない
+        yield pool
+        return
+    with multiprocessing_coverage_compatible.Pool(parallel) as pool:
+        yield pool
+
+
+def drain(results: Iterator[Any], on_result: Callable[[], None] = lambda: None) -> None:
+    '''
+    Waits for the remaining results of `imap_unordered`, ignoring their errors.
+    A task that stops consuming the results early calls this so that its work in a shared pool does not outlive the task.
+    '''
+    while True:
+        try:
+            next(results)
+        except StopIteration:
+            break
+        except Exception:
+            pass
+        on_result()
+
+
+@contextmanager
+def warm_worker_pools(sizes: Iterable[int], *, initializer: Callable[[], None] | None = None):
+    assert len(_warm_pools) == 0
+    try:
+        for parallel in set(sizes):
+            _warm_pools[parallel] = multiprocessing.Pool(parallel, initializer=initializer)
+        yield
+    finally:
+        pools = [*_warm_pools.values()]
+        _warm_pools.clear()
+        for pool in pools:
+            pool.close()
+        for pool in pools:
+            pool.join()
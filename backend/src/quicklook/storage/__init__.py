@@ -1,12 +1,21 @@
+import asyncio
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from functools import lru_cache
-from typing import Iterable, Literal
+from functools import cache, lru_cache, partial
+from typing import Callable, Iterable, Literal, ParamSpec, TypeVar
 
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.job import QuicklookJob
+from quicklook.storage.packedtile import PackedTileIndex, decode_packed_tile_index, encode_packed_tiles, packed_tile_header_size
 from quicklook.types import PackedTileId, QuicklookMeta, Visit
-from quicklook.utils.s3 import NoSuchKey, s3_delete_object, s3_delete_objects_with_prefix, s3_download_object, s3_list_objects, s3_upload_object
+from quicklook.utils.s3 import NoSuchKey, s3_delete_object, s3_delete_objects_with_prefix, s3_download_object, s3_download_object_async, s3_list_objects, s3_upload_object
+from quicklook.utils.sharedcache import SharedBytesCache, SharedBytesCacheStats
+from quicklook.utils.singleflight import SingleFlight, SingleFlightStats
+
+T = TypeVar('T')
+P = ParamSpec('P')
 
 
 def put(key: str, value: bytes) -> None:
@@ -17,6 +26,24 @@ def get(key: str) -> bytes:
     return s3_download_object(config.s3_tile, key)
 
 
+# 以下の *_async 関数は frontend のように event loop 上から呼ぶためのもの。
+# boto3 の呼び出しは専用のスレッドプールで行い、event loop をブロックしない。
+
+
+@cache
+def _io_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(config.storage_io_parallel, thread_name_prefix='storage-io')
+
+
+async def _run_io(f: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor(), partial(f, *args, **kwargs))
+
+
+async def get_async(key: str) -> bytes:
+    return await s3_download_object_async(config.s3_tile, key, executor=_io_executor())
+
+
 @dataclass
 class Entry:
     name: str
@@ -51,6 +78,13 @@ def get_quicklook_meta(visit: Visit) -> QuicklookMeta | None:
         pass
 
 
+async def get_quicklook_meta_async(visit: Visit) -> QuicklookMeta | None:
+    try:
+        return QuicklookMeta.model_validate_json(await get_async(f'quicklook/{visit.id}/meta'))
+    except NoSuchKey:
+        pass
+
+
 def put_quicklook_job_config(job: QuicklookJob) -> None:
     visit = job.visit
     put(f'quicklook/{visit.id}/job-config', job.model_dump_json().encode())
@@ -62,6 +96,10 @@ def get_quicklook_job_config(visit: Visit) -> QuicklookJob:
     return QuicklookJob.model_validate_json(get(f'quicklook/{visit.id}/job-config'))
 
 
+async def get_quicklook_job_config_async(visit: Visit) -> QuicklookJob:
+    return await _run_io(get_quicklook_job_config, visit)
+
+
 def save_quicklook_job(job: QuicklookJob) -> None:
     put(f'quicklook/{job.visit.id}/job', job.model_dump_json().encode())
 
@@ -74,27 +112,153 @@ def load_quicklook_job(visit: Visit) -> QuicklookJob | None:
         pass
 
 
+async def load_quicklook_job_async(visit: Visit) -> QuicklookJob | None:
+    try:
+        raw = await get_async(f'quicklook/{visit.id}/job')
+        return QuicklookJob.model_validate_json(raw)
+    except NoSuchKey:
+        pass
+
+
+def _packed_tile_key(visit: Visit, packed_id: PackedTileId) -> str:
+    return f'quicklook/{visit.id}/packed-tile/{packed_id.level}/{packed_id.i}/{packed_id.j}.qlpt'
+
+
 def put_quicklook_packed_tile_array(visit: Visit, packed_id: PackedTileId, array: list[bytes | None]) -> None:
-    # TODO: don't use pickle
-    data = pickle.dumps(array)
-    put(f'quicklook/{visit.id}/packed-tile/{packed_id.level}/{packed_id.i}/{packed_id.j}.npy.zstd.list.pickle', data)
+    put(_packed_tile_key(visit, packed_id), encode_packed_tiles(array))
 
 
-@lru_cache(maxsize=128)  # 1 Tile 100kbほど。config.tile_pack == 2 で PackedTile 1.6MBほど
-def get_quicklook_packed_tile_bytes(visit: Visit, packed_id: PackedTileId) -> list[bytes | None]:
-    # TODO: don't use pickle
-    return pickle.loads(get(f'quicklook/{visit.id}/packed-tile/{packed_id.level}/{packed_id.i}/{packed_id.j}.npy.zstd.list.pickle'))
+@cache
+def _tile_cache() -> SharedBytesCache:
+    # 同じpodのuvicorn workerで共有される
+    return SharedBytesCache(config.tile_cache_dir, config.tile_cache_max_bytes)
 
 
-def get_quicklook_tile_bytes(visit: Visit, level: int, i: int, j: int) -> bytes | None:
+@cache
+def _tile_cache_generations() -> SharedBytesCache:
+    # visitごとの世代。タイルのキャッシュのキーに含めるので、更新すると古いエントリは使われなくなる（そのうちevictされる）
+    return SharedBytesCache(f'{config.tile_cache_dir}/generations', 16 * 1024 * 1024)
+
+
+def _visit_generation(visit: Visit) -> str:
+    generation = _tile_cache_generations().get(visit.id)
+    return generation.decode() if generation else '0'
+
+
+def invalidate_visit_tile_cache(visit: Visit) -> None:
+    '''
+    Makes the cached tiles of `visit` unreachable.
+    Called when the tiles in the storage are deleted or about to be regenerated.
+    '''
+    _tile_cache_generations().put(visit.id, str(time.time_ns()).encode())
+
+
+def get_quicklook_packed_tile_index(visit: Visit, packed_id: PackedTileId) -> PackedTileIndex:
+    return _get_packed_tile_index(visit, packed_id, _visit_generation(visit))
+
+
+@lru_cache(maxsize=1024)  # headerは config.tile_pack == 2 で 264 bytes
+def _get_packed_tile_index(visit: Visit, packed_id: PackedTileId, generation: str) -> PackedTileIndex:
+    key = _packed_tile_key(visit, packed_id)
+    header = _tile_cache().get(f'{key}#header@{generation}')
+    if header is None:
+        header_size = packed_tile_header_size((1 << config.tile_pack) ** 2)
+        header = s3_download_object(config.s3_tile, key, length=header_size)
+        _tile_cache().put(f'{key}#header@{generation}', header)
+    return decode_packed_tile_index(header)
+
+
+def _tile_cache_key(visit: Visit, level: int, i: int, j: int) -> str:
+    return f'quicklook/{visit.id}/tile/{level}/{i}/{j}@{_visit_generation(visit)}'
+
+
+def _get_cached_tile_bytes(visit: Visit, level: int, i: int, j: int) -> tuple[bool, bytes | None]:
+    cached = _tile_cache().get(_tile_cache_key(visit, level, i, j))
+    if cached is None:
+        return False, None
+    return True, cached or None  # 空のbytesは「タイルが存在しない」ことを表す
+
+
+def _fetch_quicklook_tile_bytes(visit: Visit, level: int, i: int, j: int) -> bytes | None:
+    # ダウンロード中に世代が変わった場合は古い世代のキーに書き込む
+    cache_key = _tile_cache_key(visit, level, i, j)
     packed_id = PackedTileId.from_unpacked(level, i, j)
-    packed = get_quicklook_packed_tile_bytes(visit, packed_id)
     index = packed_id.index(i, j)
-    return packed[index]
+    try:
+        packed_index = get_quicklook_packed_tile_index(visit, packed_id)
+    except NoSuchKey:
+        # 以前の形式で保存されたvisit
+        data = _get_legacy_packed_tile_array(visit, packed_id)[index]
+    else:
+        r = packed_index.range(index)
+        if r is None:
+            data = None
+        else:
+            offset, length = r
+            data = s3_download_object(config.s3_tile, _packed_tile_key(visit, packed_id), offset=offset, length=length)
+    _tile_cache().put(cache_key, data or b'')
+    return data
+
+
+def get_quicklook_tile_bytes(visit: Visit, level: int, i: int, j: int) -> bytes | None:
+    hit, data = _get_cached_tile_bytes(visit, level, i, j)
+    if hit:
+        return data
+    return _fetch_quicklook_tile_bytes(visit, level, i, j)
+
+
+@lru_cache(maxsize=8)
+def _get_legacy_packed_tile_array(visit: Visit, packed_id: PackedTileId) -> list[bytes | None]:
+    '''
+    Reads a packed tile stored before the format of `packedtile`, i.e. a pickled list of the compressed tiles.
+    Reading this format is supported for the visits generated by the older versions, which are not regenerated.
+    '''
+    return pickle.loads(get(f'quicklook/{visit.id}/packed-tile/{packed_id.level}/{packed_id.i}/{packed_id.j}.npy.zstd.list.pickle'))
+
+
+# visitを開いた直後にはブラウザから同じpacked tileに属するタイルのリクエストが大量に来るので、
+# 同時に起きたキャッシュミスは1回のGETにまとめる
+_packed_tile_index_flight = SingleFlight[tuple[Visit, PackedTileId], PackedTileIndex]()
+_tile_flight = SingleFlight[tuple[Visit, int, int, int], bytes | None]()
+
+
+async def get_quicklook_tile_bytes_async(visit: Visit, level: int, i: int, j: int) -> bytes | None:
+    # キャッシュの読み込みも他のプロセスのevictionを待つことがあるので、event loop上では行わない
+    hit, data = await _run_io(_get_cached_tile_bytes, visit, level, i, j)
+    if hit:
+        return data
+    packed_id = PackedTileId.from_unpacked(level, i, j)
+    try:
+        # headerを先に読んでおくと、同じpacked tileの別のタイルの読み込みがheaderのGETを共有できる
+        await _packed_tile_index_flight.do((visit, packed_id), lambda: _run_io(get_quicklook_packed_tile_index, visit, packed_id))
+    except NoSuchKey:
+        pass
+    return await _tile_flight.do((visit, level, i, j), lambda: _run_io(_fetch_quicklook_tile_bytes, visit, level, i, j))
+
+
+def fetch_stats() -> dict[str, SingleFlightStats]:
+    return {
+        'packed_tile_index': _packed_tile_index_flight.stats(),
+        'tile': _tile_flight.stats(),
+    }
+
+
+def tile_cache_stats() -> SharedBytesCacheStats:
+    return _tile_cache().stats()
+
+
+async def tile_cache_stats_async() -> SharedBytesCacheStats:
+    return await _run_io(tile_cache_stats)
+
+
+async def invalidate_visit_tile_cache_async(visit: Visit) -> None:
+    await _run_io(invalidate_visit_tile_cache, visit)
 
 
 def remove_visit_data(visit: Visit) -> None:
     delete_objects_by_prefix(f'quicklook/{visit.id}/')
+    # 別のpodのfrontendのキャッシュはRemoteQuicklookJobsWatcherが無効にする
+    invalidate_visit_tile_cache(visit)
 
 
 def clear_all():
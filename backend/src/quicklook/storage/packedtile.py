@@ -0,0 +1,88 @@
+'''
+Binary container for packed tiles.
+
+A packed tile object stores up to `(1 << config.tile_pack) ** 2` zstd compressed tiles.
+The header has a fixed size that depends only on the number of entries,
+so a reader can fetch the header with one range request and then fetch a single tile with another.
+
+    offset      size        content
+    0           4           magic b'QLPT'
+    4           2           format version (uint16 little endian)
+    6           2           number of entries n (uint16 little endian)
+    8           16 * n      entries: (offset, length) as uint64 little endian.
+                            offset is relative to the beginning of the object.
+                            length == 0 means the tile does not exist.
+    8 + 16 * n  ...         concatenated tile payloads
+'''
+
+import struct
+from dataclasses import dataclass
+
+MAGIC = b'QLPT'
+VERSION = 1
+
+_preamble = struct.Struct('<4sHH')
+_entry = struct.Struct('<QQ')
+
+
+class InvalidPackedTile(ValueError):
+    pass
+
+
+def packed_tile_header_size(num_entries: int) -> int:
+    return _preamble.size + _entry.size * num_entries
+
+
+@dataclass(frozen=True)
+class PackedTileIndex:
+    entries: tuple[tuple[int, int], ...]  # (offset, length)
+
+    def range(self, index: int) -> tuple[int, int] | None:
+        offset, length = self.entries[index]
+        if length == 0:
+            return None
+        return offset, length
+
+    @property
+    def header_size(self) -> int:
+        return packed_tile_header_size(len(self.entries))
+
+
+def encode_packed_tiles(tiles: list[bytes | None]) -> bytes:
+    offset = packed_tile_header_size(len(tiles))
+    header = [_preamble.pack(MAGIC, VERSION, len(tiles))]
+    for tile in tiles:
+        length = 0 if tile is None else len(tile)
+        header.append(_entry.pack(offset if length else 0, length))
+        offset += length
+    return b''.join([*header, *(tile for tile in tiles if tile)])
+
+
+def decode_packed_tile_index(data: bytes) -> PackedTileIndex:
+    '''
+    `data` must contain at least the header. Extra bytes after the header are ignored.
+    '''
+    if len(data) < _preamble.size:
+        raise InvalidPackedTile('Packed tile is too short')
+    magic, version, n = _preamble.unpack_from(data)
+    if magic != MAGIC:
+        raise InvalidPackedTile(f'Bad magic: {magic!r}')
+    if version != VERSION:
+        raise InvalidPackedTile(f'Unsupported packed tile version: {version}')
+    if len(data) < packed_tile_header_size(n):
+        raise InvalidPackedTile('Packed tile header is truncated')
+    entries = tuple(_entry.unpack_from(data, _preamble.size + _entry.size * k) for k in range(n))
+    return PackedTileIndex(entries=entries)
+
+
+def decode_packed_tiles(data: bytes) -> list[bytes | None]:
+    index = decode_packed_tile_index(data)
+    tiles: list[bytes | None] = []
+    for k in range(len(index.entries)):
+        r = index.range(k)
+        if r is None:
+            tiles.append(None)
+        else:
+            offset, length = r
+            tiles.append(data[offset : offset + length])
+    return tiles
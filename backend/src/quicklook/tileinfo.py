@@ -6,7 +6,6 @@ from dataclasses import dataclass
 from functools import cache
 from pathlib import Path
 
-import astropy.io.fits as afits
 import rtree
 
 from quicklook.config import config
@@ -18,13 +17,16 @@ class TileInfo:
     ccd_names: list[str]
 
     @classmethod
-    def of(cls, level: int, i: int, j: int):
+    def of(cls, level: int, i: int, j: int, *, margin: int = 0):
+        '''
+        With `margin`, the CCDs whose bbox widened by `margin` pixels intersects the tile are listed.
+        '''
         tile_size = config.tile_size * (1 << level)
         bbox = BBox(
-            minx=j * tile_size,
-            miny=i * tile_size,
-            maxx=(j + 1) * tile_size,
-            maxy=(i + 1) * tile_size,
+            minx=j * tile_size - margin,
+            miny=i * tile_size - margin,
+            maxx=(j + 1) * tile_size + margin,
+            maxy=(i + 1) * tile_size + margin,
         )
         return TileInfo(ccd_names=[*ccds_intersecting(bbox)])
 
@@ -42,6 +44,9 @@ def ccds_intersecting(bbox: BBox):
 
 ccd_info_path = Path(__file__).parent / 'ccd-info.json'
 
+# CCDはccd-info.jsonのbboxの少し外のタイルにも書き込むことがある
+CCD_BBOX_MARGIN = 16
+
 
 @cache
 def ccd_list() -> list[_Ccd]:
@@ -73,13 +78,13 @@ if __name__ == '__main__':  # pragma: no cover
         ccd_info_path.write_text(json.dumps(ccds, indent=2))
 
     def _make_ccd_meta(p: Path):
-        from .generator.preprocess_ccd import RawAmp
-
-        with afits.open(p, memmap=False) as hdul:  # type: ignore
-            amps = [RawAmp.from_hdu(j, hdu) for j, hdu in enumerate(hdul) if hdu.name.startswith('Segment')]  # type: ignore
-            bbox = functools.reduce(lambda a, b: a.union(b.wcs.bbox), amps[1:], amps[0].wcs.bbox)
-            header = hdul[0].header  # type: ignore
-            ccd_name = f'{header["RAFTBAY"]}_{header["CCDSLOT"]}'
-            return dict(name=ccd_name, bbox=dataclasses.asdict(bbox))
+        from .generator.preprocess_ccd import RAW_CARDS, RawAmp, fast_open_comressed_fits
+
+        hdus = fast_open_comressed_fits(p, RAW_CARDS)
+        amps = [RawAmp.from_hdu(hdu.index, hdu) for hdu in hdus if hdu.name.startswith('Segment')]
+        bbox = functools.reduce(lambda a, b: a.union(b.wcs.bbox), amps[1:], amps[0].wcs.bbox)
+        header = hdus[0].cards
+        ccd_name = f'{header["RAFTBAY"]}_{header["CCDSLOT"]}'
+        return dict(name=ccd_name, bbox=dataclasses.asdict(bbox))
 
     regenerate_ccd_info()
@@ -107,7 +107,8 @@ class PreProcessedCcd:
     pool: numpy.ndarray
     stat: ImageStat
     amps: list[AmpMeta]
-    headers: list[HeaderType]
+    raw_headers: list[bytes]
+    # HDUごとのヘッダーのブロック。cardの一覧にするのはヘッダーが要求されたとき（raw_headers_to_list）
 
 
 @dataclass(frozen=True)
@@ -147,11 +148,17 @@ class CcdMeta:
     bbox: BBox
 
 
+@dataclass
+class CcdCoarseDone:
+    # CCDの粗いlevelのタイルが全て作られた
+    ccd_id: CcdId
+
+
 class QuicklookMeta(BaseModel):
     ccd_meta: list[CcdMeta]
 
 
-GenerateTaskResponse = None | GenerateProgress | BaseException | CcdMeta
+GenerateTaskResponse = None | GenerateProgress | BaseException | CcdMeta | CcdCoarseDone
 MergeTaskResponse = None | MergeProgress | BaseException
 TransferTaskResponse = None | TransferProgress | BaseException
 
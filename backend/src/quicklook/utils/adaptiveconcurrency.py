@@ -0,0 +1,151 @@
+'''
+Concurrency limit that follows the measured throughput.
+
+The limit is adjusted by hill climbing: after each window of completed operations, the throughput
+(bytes per second while at least one operation was in flight) is compared with the previous window.
+If it improved, the limit keeps moving in the same direction; if it got worse, the direction is reversed;
+if it is flat, the limit stays. The limit is lowered when the latency per byte grows well beyond the best seen,
+which is how an overloaded upstream shows up.
+
+A window in which fewer operations than the limit were in flight (e.g. because the consumer applied
+backpressure) says nothing about the limit, so it does not change it.
+'''
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+logger = logging.getLogger(f'uvicorn.{__name__}')
+
+
+@dataclass
+class ConcurrencyDecision:
+    previous: int
+    limit: int
+    reason: str
+    throughput: float  # bytes/s
+    latency: float  # s/MB
+
+
+class Measurement:
+    def __init__(self) -> None:
+        self.nbytes = 0
+
+
+class AdaptiveConcurrency:
+    def __init__(
+        self,
+        min_limit: int,
+        max_limit: int,
+        *,
+        name: str = 'concurrency',
+        tolerance: float = 0.05,
+        latency_factor: float = 2.0,
+        saturation: float = 0.8,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        assert 1 <= min_limit <= max_limit
+        self._min = min_limit
+        self._max = max_limit
+        self._name = name
+        self._tolerance = tolerance
+        self._latency_factor = latency_factor
+        self._saturation = saturation
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._limit = min_limit
+        self._direction = 1
+        self._active = 0
+        self._last_event = clock()
+        self._prev_throughput: float | None = None
+        self._best_latency: float | None = None
+        self.decisions: list[ConcurrencyDecision] = []
+        self._reset_window()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @contextmanager
+    def measure(self) -> Iterator[Measurement]:
+        '''
+        Wraps one operation. Set `nbytes` of the yielded object to the size of what was transferred.
+        Failed operations are not counted.
+        '''
+        m = Measurement()
+        with self._lock:
+            self._advance()
+            self._active += 1
+        start = self._clock()
+        ok = False
+        try:
+            yield m
+            ok = True
+        finally:
+            decision = None
+            with self._lock:
+                self._advance()
+                self._active -= 1
+                if ok:
+                    self._bytes += m.nbytes
+                    self._seconds += self._clock() - start
+                    self._count += 1
+                    if self._count >= max(2, self._limit):
+                        decision = self._decide()
+            if decision:
+                logger.info(
+                    f'{self._name}: {decision.previous} -> {decision.limit} ({decision.reason}, '
+                    f'throughput={decision.throughput / 1e6:.1f}MB/s, latency={decision.latency:.3f}s/MB)'
+                )
+
+    def _reset_window(self):
+        self._bytes = 0
+        self._seconds = 0.0
+        self._count = 0
+        self._busy = 0.0
+        self._area = 0.0  # 実行中の数の時間積分
+
+    def _advance(self):
+        now = self._clock()
+        dt = now - self._last_event
+        if self._active > 0:
+            self._busy += dt
+            self._area += self._active * dt
+        self._last_event = now
+
+    def _decide(self) -> ConcurrencyDecision | None:
+        busy = max(self._busy, 1e-9)
+        throughput = self._bytes / busy
+        latency = self._seconds / max(self._bytes / 1e6, 1e-9)
+        saturated = self._area / busy >= self._saturation * self._limit
+        self._reset_window()
+        if not saturated:
+            # 下流が詰まっているなどでlimitまで使われていない
+            return None
+
+        prev = self._prev_throughput
+        self._prev_throughput = throughput
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+
+        if latency > self._latency_factor * self._best_latency and self._limit > self._min:
+            self._direction = -1
+            reason = 'latency'
+        elif prev is None or throughput > prev * (1 + self._tolerance):
+            reason = 'throughput up'
+        elif throughput < prev * (1 - self._tolerance):
+            self._direction = -self._direction
+            reason = 'throughput down'
+        else:
+            return None
+
+        limit = min(self._max, max(self._min, self._limit + self._direction))
+        if limit == self._limit:
+            return None
+        decision = ConcurrencyDecision(self._limit, limit, reason, throughput, latency)
+        self._limit = limit
+        self.decisions.append(decision)
+        return decision
@@ -2,7 +2,7 @@ import io
 import warnings
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterable
 
 import astropy.io.fits as pyfits
 import numpy
@@ -73,3 +73,121 @@ def stride_fits(path: Path, select: Callable[[pyfits.Header], bool] | None = Non
             start = next_offset
             hdu_index += 1
     return ranges
+
+
+_BLOCK = 2880
+_CARD = 80
+_BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+_STRUCTURAL_KEYS = {'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'EXTNAME'}
+
+
+@dataclass
+class FitsHdu:
+    '''
+    HDU found by `parse_hdus`.
+    `header` and `data` are views of the buffer. `cards` has only the structural keywords and the requested ones.
+    '''
+
+    index: int
+    cards: dict[str, Any]
+    header: memoryview
+    data_offset: int
+    data_size: int
+    _buf: Any
+
+    @property
+    def name(self) -> str:
+        return self.cards.get('EXTNAME', 'PRIMARY' if self.index == 0 else '')
+
+    @property
+    def is_image(self) -> bool:
+        return self.index == 0 or self.cards.get('XTENSION') == 'IMAGE'
+
+    @property
+    def data(self) -> numpy.ndarray | None:
+        '''
+        The image data as stored in the file (big-endian) without copying.
+        If BSCALE/BZERO are given, a scaled array is returned as astropy does.
+        '''
+        if not self.is_image or self.data_size == 0:
+            return None
+        dtype = numpy.dtype(_BITPIX_DTYPES[self.cards['BITPIX']])
+        shape = tuple(self.cards[f'NAXIS{n}'] for n in range(self.cards['NAXIS'], 0, -1))
+        data = numpy.frombuffer(self._buf, dtype=dtype, count=int(numpy.prod(shape)), offset=self.data_offset).reshape(shape)
+        bscale = self.cards.get('BSCALE', 1)
+        bzero = self.cards.get('BZERO', 0)
+        if bscale == 1 and bzero == 0:
+            return data
+        scaled = data.astype(numpy.float32 if dtype.itemsize <= 2 else numpy.float64)
+        scaled *= bscale
+        scaled += bzero
+        return scaled
+
+    def astropy_header(self) -> pyfits.Header:
+        return pyfits.Header.fromstring(bytes(self.header))
+
+
+def parse_hdus(buf, keys: Iterable[str] = ()) -> list[FitsHdu]:
+    '''
+    Locates the HDUs of an uncompressed FITS file in `buf` without copying it.
+    Only the cards in `keys` (and the ones needed to locate the data) are parsed.
+    '''
+    view = memoryview(buf).cast('B')
+    wanted = _STRUCTURAL_KEYS | set(keys)
+    hdus: list[FitsHdu] = []
+    offset = 0
+    while offset + _BLOCK <= len(view):
+        header_start = offset
+        cards: dict[str, Any] = {}
+        while True:
+            if offset + _BLOCK > len(view):
+                raise ValueError(f'Truncated FITS header at {header_start}')
+            block = bytes(view[offset : offset + _BLOCK])
+            offset += _BLOCK
+            if _scan_cards(block, wanted, cards):
+                break
+        if len(hdus) == 0 and 'SIMPLE' not in cards:
+            raise ValueError('Not a FITS file')
+        naxis = cards.get('NAXIS', 0)
+        size = 0
+        if naxis > 0:
+            size = int(numpy.prod([cards[f'NAXIS{n}'] for n in range(1, naxis + 1)], dtype=numpy.int64))
+        size = abs(cards['BITPIX']) // 8 * cards.get('GCOUNT', 1) * (cards.get('PCOUNT', 0) + size)
+        if offset + size > len(view):
+            raise ValueError(f'Truncated FITS data at {offset}')
+        hdus.append(FitsHdu(len(hdus), cards, view[header_start:offset], offset, size, view))
+        offset += -(-size // _BLOCK) * _BLOCK
+    return hdus
+
+
+def _scan_cards(block: bytes, wanted: set[str], cards: dict[str, Any]) -> bool:
+    # ENDが見つかったらTrueを返す
+    for i in range(0, _BLOCK, _CARD):
+        keyword = block[i : i + 8].rstrip().decode('ascii')
+        if keyword == 'END':
+            return True
+        if (keyword in wanted or keyword.startswith('NAXIS')) and block[i + 8 : i + 10] == b'= ':
+            cards[keyword] = _card_value(block[i + 10 : i + _CARD].decode('ascii'))
+    return False
+
+
+def _card_value(s: str) -> Any:
+    s = s.strip()
+    if s.startswith("'"):
+        # ''は'のエスケープ
+        end = 1
+        while True:
+            end = s.index("'", end)
+            if s[end + 1 : end + 2] != "'":
+                break
+            end += 2
+        return s[1:end].replace("''", "'").rstrip()
+    s = s.split('/', 1)[0].strip()
+    if s == '':
+        return None
+    if s in ('T', 'F'):
+        return s == 'T'
+    try:
+        return int(s)
+    except ValueError:
+        return float(s.replace('D', 'E'))
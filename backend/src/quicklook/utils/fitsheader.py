@@ -1,19 +1,33 @@
+import io
+
 import astropy.io.fits as pyfits
 
 from quicklook.types import HeaderType
 
 
 def fitsheader_to_list(hdul: pyfits.HDUList) -> list[HeaderType]:
+    return [header_to_list(hdu.header) for hdu in hdul]  # type: ignore
+
+
+def raw_headers_to_list(buf: bytes) -> list[HeaderType]:
+    '''
+    Converts the concatenated header blocks of the HDUs (`PreProcessedCcd.raw_headers`).
+    '''
+    f = io.BytesIO(buf)
     headers: list[HeaderType] = []
-    for hdu in hdul:
-        cards: HeaderType = []
-        for card in hdu.header.cards:  # type: ignore
-            keyword, value, comment = card
-            cards.append((keyword, value.__class__.__name__, stringify(value), comment))
-        headers.append(cards)
+    while f.tell() < len(buf):
+        headers.append(header_to_list(pyfits.Header.fromfile(f)))
     return headers
 
 
+def header_to_list(header: pyfits.Header) -> HeaderType:
+    cards: HeaderType = []
+    for card in header.cards:
+        keyword, value, comment = card
+        cards.append((keyword, value.__class__.__name__, stringify(value), comment))
+    return cards
+
+
 def stringify(value) -> str:
     if isinstance(value, bool):
         return 'T' if value else 'F'
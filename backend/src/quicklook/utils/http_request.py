@@ -1,10 +1,71 @@
-from typing import Any
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
 
 import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from quicklook.config import config
+
+# pod間の通信は同じホストへの小さなリクエストが大量に発生するので、keep-aliveの接続をプロセス内で使い回す
+
+_session: tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession] | None = None
+
+
+@asynccontextmanager
+async def activate_client_session():
+    '''
+    Keep one `aiohttp.ClientSession` for the lifetime of the app.
+    Use this in the lifespan of the FastAPI apps.
+    '''
+    global _session
+    session = aiohttp.ClientSession(connector=_connector())
+    _session = (asyncio.get_running_loop(), session)
+    try:
+        yield
+    finally:
+        _session = None
+        await session.close()
+
+
+@asynccontextmanager
+async def client_session() -> AsyncIterator[aiohttp.ClientSession]:
+    '''
+    The session activated by `activate_client_session`.
+    A short-lived session is used if no session is active on the running loop (e.g. scripts and tests).
+    '''
+    if _session is not None and _session[0] is asyncio.get_running_loop():
+        yield _session[1]
+    else:
+        async with aiohttp.ClientSession(connector=_connector()) as session:
+            yield session
+
+
+def _connector() -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(limit=config.http_pool_limit, limit_per_host=config.http_pool_limit_per_host)
+
+
+_sync_session: tuple[int, requests.Session] | None = None
+
+
+def http_session() -> requests.Session:
+    '''
+    `requests.Session` for blocking code such as the worker processes of the generator.
+    A session is created for each process because connections cannot be shared after fork.
+    '''
+    global _sync_session
+    if _sync_session is None or _sync_session[0] != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=config.http_pool_limit, pool_maxsize=config.http_pool_limit_per_host)
+        session.mount('http://', adapter)
+        _sync_session = (os.getpid(), session)
+    return _sync_session[1]
 
 
 async def http_request(method: str, url: str, *, content: bytes | None = None, json: Any | None = None) -> Any:
-    async with aiohttp.ClientSession() as session:
+    async with client_session() as session:
         async with session.request(method, url, data=content, json=json) as response:
             response.raise_for_status()
             return await response.json()
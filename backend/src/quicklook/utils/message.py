@@ -17,7 +17,19 @@ def message_from_stream(stream: BinaryIO) -> Any:
     if length_b == b'':
         raise EOFError
     length = int.from_bytes(length_b, 'big')
-    return pickle.loads(stream.read(length))
+    return pickle.loads(_read_exactly(stream, length))
+
+
+def _read_exactly(stream: BinaryIO, n: int) -> bytes:
+    # socketから読む場合はnバイトより短く返ることがある
+    chunks: list[bytes] = []
+    while n > 0:
+        chunk = stream.read(n)
+        if chunk == b'':  # pragma: no cover
+            raise EOFError
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
 
 
 async def message_from_async_reader(read: Callable[[int], Awaitable]) -> Any:
@@ -1,5 +1,7 @@
+import asyncio
+from concurrent.futures import Executor
 from dataclasses import dataclass
-from functools import cache
+from functools import cache, partial
 from typing import Any, Iterable, Literal
 
 import boto3
@@ -43,6 +45,24 @@ def s3_download_object(
     return response['Body'].read()
 
 
+async def s3_download_object_async(
+    settings: S3Config,
+    key: str,
+    *,
+    offset: int = 0,
+    length: int = 0,
+    executor: Executor | None = None,
+) -> bytes:
+    """
+    Awaitable version of s3_download_object.
+    boto3 is blocking, so the request is run on `executor` (the default executor of the loop if None).
+    Callers serving many concurrent requests should pass a dedicated, bounded executor
+    so that S3 latency never stalls the event loop or starves other users of the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(s3_download_object, settings, key, offset=offset, length=length))
+
+
 def s3_upload_object(
     s3_config: S3Config,
     key: str,
@@ -0,0 +1,166 @@
+'''
+Byte-budgeted cache shared by all processes on a host.
+
+Each entry is a file under `<directory>/entries` (intended to be on tmpfs such as /dev/shm),
+so every uvicorn worker on a pod reads the same entries without keeping its own copy.
+Recency is tracked by mtime, which is bumped on every hit.
+
+Counters live in `<directory>/stats`, which every process maps with mmap.
+They are updated under `flock` so that the numbers are consistent across processes.
+When the total size exceeds `max_bytes`, the oldest entries are removed
+until the total size drops to `low_water * max_bytes`.
+'''
+
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+_counters = struct.Struct('<5q')
+_HITS, _MISSES, _EVICTIONS, _BYTES, _ENTRIES = range(5)
+
+
+@dataclass
+class SharedBytesCacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    bytes: int
+    entries: int
+    max_bytes: int
+
+    @property
+    def hit_ratio(self) -> float:
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
+class SharedBytesCache:
+    def __init__(self, directory: str, max_bytes: int, *, low_water: float = 0.9) -> None:
+        assert 0 < low_water <= 1
+        self._dir = Path(directory)
+        self._max_bytes = max_bytes
+        self._low_water_bytes = int(max_bytes * low_water)
+        # flockはopen file descriptionごとのロックなので、同じプロセス内のスレッド間の排他には使えない
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._stats_fd = -1
+        self._stats_mm: mmap.mmap | None = None
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except FileNotFoundError:
+            with self._locked() as c:
+                c[_MISSES] += 1
+            return None
+        with suppress(FileNotFoundError):  # 読んだ直後に別のプロセスがevictした場合
+            os.utime(path)
+        with self._locked() as c:
+            c[_HITS] += 1
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self._max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # '.' で始まる名前は書き込み途中のファイルでevictionの対象にしない
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            with self._locked() as c:
+                with suppress(FileNotFoundError):
+                    old_size = path.stat().st_size
+                    c[_BYTES] -= old_size
+                    c[_ENTRIES] -= 1
+                os.replace(tmp, path)
+                c[_BYTES] += len(value)
+                c[_ENTRIES] += 1
+                if c[_BYTES] > self._max_bytes:
+                    self._evict(c)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+    def stats(self) -> SharedBytesCacheStats:
+        with self._locked() as c:
+            return SharedBytesCacheStats(
+                hits=c[_HITS],
+                misses=c[_MISSES],
+                evictions=c[_EVICTIONS],
+                bytes=c[_BYTES],
+                entries=c[_ENTRIES],
+                max_bytes=self._max_bytes,
+            )
+
+    def clear(self) -> None:
+        with self._locked() as c:
+            shutil.rmtree(self._dir / 'entries', ignore_errors=True)
+            c[_BYTES] = 0
+            c[_ENTRIES] = 0
+
+    def _path(self, key: str) -> Path:
+        h = hashlib.sha1(key.encode()).hexdigest()
+        return self._dir / 'entries' / h[:2] / h
+
+    def _evict(self, c: list[int]) -> None:
+        # 他のプロセスとずれていても、ここで実際のファイルから数え直す
+        entries: list[tuple[int, int, str]] = []
+        total = 0
+        for sub in os.scandir(self._dir / 'entries'):
+            for e in os.scandir(sub.path):
+                if e.name.startswith('.'):
+                    continue
+                with suppress(FileNotFoundError):
+                    st = e.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, e.path))
+                    total += st.st_size
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self._low_water_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+            evicted += 1
+        c[_BYTES] = total
+        c[_ENTRIES] = len(entries) - evicted
+        c[_EVICTIONS] += evicted
+
+    @contextmanager
+    def _locked(self) -> Iterator[list[int]]:
+        with self._lock:
+            fd, mm = self._open_counters()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                c = list(_counters.unpack_from(mm))
+                yield c
+                _counters.pack_into(mm, 0, *c)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _open_counters(self) -> tuple[int, mmap.mmap]:
+        if self._pid != os.getpid():  # fork後は開き直す
+            self._dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self._dir / 'stats', os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < _counters.size:
+                os.ftruncate(fd, _counters.size)
+            self._stats_fd = fd
+            self._stats_mm = mmap.mmap(fd, _counters.size)
+            self._pid = os.getpid()
+        assert self._stats_mm is not None
+        return self._stats_fd, self._stats_mm
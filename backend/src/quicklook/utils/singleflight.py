@@ -0,0 +1,49 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int
+    executions: int
+
+    @property
+    def saved(self) -> int:
+        return self.calls - self.executions
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Coalesces concurrent calls for the same key into one execution.
+    Callers that arrive while a call for the key is in flight await the same result (or exception).
+    Nothing is cached after the call completes.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: dict[K, asyncio.Future[V]] = {}
+        self._calls = 0
+        self._executions = 0
+
+    async def do(self, key: K, f: Callable[[], Awaitable[V]]) -> V:
+        self._calls += 1
+        fut = self._inflight.get(key)
+        if fut is None:
+            self._executions += 1
+            fut = asyncio.ensure_future(f())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda fut: self._on_done(key, fut))
+        # 1つの呼び出し元がキャンセルされても他の呼び出し元のために実行は続ける
+        return await asyncio.shield(fut)
+
+    def _on_done(self, key: K, fut: asyncio.Future[V]) -> None:
+        if self._inflight.get(key) is fut:  # pragma: no branch
+            del self._inflight[key]
+        if not fut.cancelled():
+            fut.exception()  # 全ての呼び出し元がキャンセルされた場合の "exception was never retrieved" を防ぐ
+
+    def stats(self) -> SingleFlightStats:
+        return SingleFlightStats(calls=self._calls, executions=self._executions)
@@ -0,0 +1,21 @@
+from quicklook.coordinator.quicklookjob.ccdpartition import count_cross_generator_tiles, partition_ccds
+from quicklook.tileinfo import ccd_list
+
+
+def test_partition_ccds_covers_all_ccds():
+    names = [ccd.name for ccd in ccd_list()] + ['UNKNOWN']
+    for method in ['index', 'hilbert']:
+        parts = partition_ccds(names, 4, method=method)  # type: ignore[arg-type]
+        assert sorted(sum(parts, [])) == sorted(names)
+        assert max(map(len, parts)) - min(map(len, parts)) <= 1
+    assert partition_ccds(names, 4, method='hilbert')[-1][-1] == 'UNKNOWN'
+
+
+def test_hilbert_partition_reduces_cross_generator_tiles():
+    names = [ccd.name for ccd in ccd_list()]
+
+    def cross_tiles(method) -> int:
+        parts = partition_ccds(names, 6, method=method)
+        return count_cross_generator_tiles({name: g for g, part in enumerate(parts) for name in part})
+
+    assert cross_tiles('hilbert') < cross_tiles('index')
@@ -0,0 +1,38 @@
+from quicklook.coordinator.quicklookjob.ccdworkqueue import CcdWorkQueue, ccd_work_queue, open_ccd_work_queue
+from quicklook.types import GeneratorPod, Visit
+
+g1 = GeneratorPod(host='g1', port=9502)
+g2 = GeneratorPod(host='g2', port=9502)
+
+
+def test_take_own_ccds_first_then_steal():
+    ccd_generator_map: dict[str, GeneratorPod] = {}
+    q = CcdWorkQueue({g1: ['a1', 'a2'], g2: ['b1', 'b2', 'b3', 'b4']}, ccd_generator_map)
+    assert q.take(g1) == ['a1']
+    assert q.take(g1) == ['a2']
+    assert q.take(g2) == ['b1']
+    # g1の分がなくなったら一番残っているところの後ろから取る
+    assert q.take(g1, 2) == ['b4', 'b3']
+    assert q.take(g2) == ['b2']
+    assert q.take(g1) == []
+    assert q.take(g2) == []
+    assert ccd_generator_map == {'a1': g1, 'a2': g1, 'b1': g2, 'b2': g2, 'b3': g1, 'b4': g1}
+
+
+def test_requeue():
+    ccd_generator_map: dict[str, GeneratorPod] = {}
+    q = CcdWorkQueue({g1: ['a1', 'a2'], g2: ['b1']}, ccd_generator_map)
+    assert q.take(g1) == ['a1']
+    assert q.take(g2) == ['b1']
+    q.requeue(g1)
+    assert ccd_generator_map == {'b1': g2}
+    assert q.num_remaining == 2
+    assert q.take(g1, 2) == ['a1', 'a2']
+
+
+def test_open_ccd_work_queue():
+    visit = Visit.from_id('raw:workqueue')
+    q = CcdWorkQueue({g1: ['a1']}, {})
+    with open_ccd_work_queue(visit, q):
+        assert ccd_work_queue(visit) is q
+    assert ccd_work_queue(visit) is None
@@ -0,0 +1,126 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+import quicklook.coordinator.api  # noqa: F401  先に読み込まないとjob_dataflowが循環importになる
+from quicklook.config import config
+from quicklook.coordinator.quicklookjob import job_dataflow as job_dataflow_module
+from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
+from quicklook.coordinator.quicklookjob.job_dataflow import job_dataflow
+from quicklook.coordinator.quicklookjob.tasks import MergeTask, TransferTask
+from quicklook.select_primary_generator import NoOverlappingGenerators, select_primary_generator
+from quicklook.tileinfo import ccd_list
+from quicklook.types import BBox, CcdCoarseDone, CcdId, CcdMeta, GeneratorPod, ImageStat, MergeProgress, PackedTileId, Progress, TileId, TransferProgress, Visit
+
+g1 = GeneratorPod(host='g1', port=9502)
+g2 = GeneratorPod(host='g2', port=9502)
+visit = Visit.from_id('raw:dataflow')
+coarse_min_level = 4
+
+
+class FakeGenerators:
+    '''
+    Generators that report the CCDs one by one and answer the merge/transfer tasks immediately.
+    '''
+
+    def __init__(self, ccd_generator_map: dict[str, GeneratorPod]):
+        self.ccd_generator_map = ccd_generator_map
+        self.generating = False
+        self.coarse_done: set[str] = set()
+        self.done: set[str] = set()
+        self.merged: list[tuple[TileId, GeneratorPod, bool]] = []  # (tile, primary, generate中か)
+        self.transferred: list[tuple[PackedTileId, frozenset[TileId]]] = []  # (packed tile, その時点でmerge済みのタイル)
+
+    async def job_generate(self, job: QuicklookJob, sync_job, *, on_ccd_done, coarse_min_level, on_ccd_coarse_done):
+        self.generating = True
+        job.ccd_names = [*self.ccd_generator_map]
+        job.ccd_generator_map = self.ccd_generator_map
+        # 粗いlevelのタイルは先に作られる
+        for ccd_name in self.ccd_generator_map:
+            self.coarse_done.add(ccd_name)
+            on_ccd_coarse_done(CcdCoarseDone(ccd_id=CcdId(visit, ccd_name)))
+            await asyncio.sleep(0)
+        # 全てのCCDのタイルを作り終える前に粗いlevelは公開される
+        async with asyncio.timeout(10):
+            while job.published_min_level is None:
+                await asyncio.sleep(0.01)
+        for ccd_name in self.ccd_generator_map:
+            self.done.add(ccd_name)
+            on_ccd_done(CcdMeta(ccd_id=CcdId(visit, ccd_name), image_stat=ImageStat(median=0, mad=0, shape=(1, 1)), amps=[], bbox=BBox(0, 0, 0, 0)))
+            await asyncio.sleep(0)
+        self.generating = False
+
+    async def run_merge_task(self, task: MergeTask, on_progress):
+        assert task.tile_ids
+        for tile_id in task.tile_ids:
+            finished = self.done | (self.coarse_done if tile_id.level >= coarse_min_level else set())
+            unfinished = {name: g for name, g in self.ccd_generator_map.items() if name not in finished}
+            # タイルに重なるCCDは全て終わっている
+            with pytest.raises(NoOverlappingGenerators):
+                select_primary_generator(unfinished, tile_id)
+            self.merged.append((tile_id, task.generator, self.generating))
+        on_progress(MergeProgress(merge=Progress(count=len(task.tile_ids), total=len(task.tile_ids))))
+        await asyncio.sleep(0)
+
+    async def run_transfer_task(self, task: TransferTask, on_progress):
+        assert task.packed_ids
+        merged = frozenset(tile_id for tile_id, _, _ in self.merged)
+        for packed_id in task.packed_ids:
+            self.transferred.append((packed_id, merged))
+        on_progress(TransferProgress(transfer=Progress(count=len(task.packed_ids), total=len(task.packed_ids))))
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def generators(monkeypatch: pytest.MonkeyPatch):
+    names = [ccd.name for ccd in ccd_list()][:27]
+    fake = FakeGenerators({name: (g1 if k < len(names) // 2 else g2) for k, name in enumerate(names)})
+    monkeypatch.setattr(config, 'job_coarse_min_level', coarse_min_level)
+    monkeypatch.setattr(job_dataflow_module, 'job_generate', fake.job_generate)
+    monkeypatch.setattr(job_dataflow_module, 'run_merge_task', fake.run_merge_task)
+    monkeypatch.setattr(job_dataflow_module, 'run_transfer_task', fake.run_transfer_task)
+    return fake
+
+
+async def test_job_dataflow(generators: FakeGenerators):
+    job = QuicklookJob(visit=visit, phase=QuicklookJobPhase.QUEUED)
+    phases: list[QuicklookJobPhase] = []
+    published: list[int] = []
+
+    def sync_job(job: QuicklookJob):
+        if not phases or phases[-1] != job.phase:
+            phases.append(job.phase)
+        if job.published_min_level is not None and (not published or published[-1] != job.published_min_level):
+            published.append(job.published_min_level)
+
+    async def noop():
+        pass
+
+    await job_dataflow(job, sync_job, on_generate_done=noop, on_merge_done=noop)
+
+    # 各タイルは1回だけ、primary generatorでmergeされる
+    counts = Counter(tile_id for tile_id, _, _ in generators.merged)
+    assert counts and max(counts.values()) == 1
+    for tile_id, g, _ in generators.merged:
+        assert select_primary_generator(generators.ccd_generator_map, tile_id)[0] == g
+    # generateが終わる前からmergeが始まる
+    assert any(generating for _, _, generating in generators.merged)
+
+    # packed tileは1回だけ、そのタイルが全てmergeされた後で転送される
+    packs_of: dict[PackedTileId, set[TileId]] = {}
+    for tile_id in counts:
+        packs_of.setdefault(PackedTileId.from_unpacked(tile_id.level, tile_id.i, tile_id.j), set()).add(tile_id)
+    transferred = [packed_id for packed_id, _ in generators.transferred]
+    assert len(transferred) == len(set(transferred))
+    assert set(transferred) == set(packs_of)
+    for packed_id, merged in generators.transferred:
+        assert packs_of[packed_id] <= merged
+
+    # 公開されるlevelは粗いlevelから順に下がっていく
+    assert published[0] <= coarse_min_level
+    assert published == sorted(published, reverse=True)
+    assert published[-1] == job.published_min_level == 0
+
+    assert phases[-4:] == [QuicklookJobPhase.MERGE_RUNNING, QuicklookJobPhase.MERGE_DONE, QuicklookJobPhase.TRANSFER_RUNNING, QuicklookJobPhase.TRANSFER_DONE]
+    assert job.merge_progress is None and job.transfer_progress is None
@@ -0,0 +1,102 @@
+import aiohttp
+import pytest
+
+import quicklook.coordinator.api  # noqa: F401  先に読み込まないとjob_generateが循環importになる
+from quicklook.config import config
+from quicklook.coordinator.quicklookjob import job_generate
+from quicklook.coordinator.quicklookjob.job import QuicklookJob, QuicklookJobPhase
+from quicklook.types import BBox, CcdId, CcdMeta, GeneratorPod, ImageStat, Visit
+from quicklook.utils.message import encode_message
+
+g1 = GeneratorPod(host='g1', port=9502)
+visit = Visit.from_id('raw:retry')
+ccd_names = ['R22_S10', 'R22_S11']
+
+
+def ccd_meta(ccd_name: str) -> CcdMeta:
+    return CcdMeta(ccd_id=CcdId(visit, ccd_name), image_stat=ImageStat(median=0, mad=0, shape=(1, 1)), amps=[], bbox=BBox(0, 0, 0, 0))
+
+
+class FakeContent:
+    def __init__(self, messages: list, timeout: bool):
+        self._buf = b''.join(encode_message(msg) for msg in messages) + (b'' if timeout else encode_message(None))
+
+    async def readexactly(self, n: int) -> bytes:
+        if len(self._buf) == 0:
+            raise aiohttp.ServerTimeoutError()
+        chunk, self._buf = self._buf[:n], self._buf[n:]
+        return chunk
+
+
+class FakeResponse:
+    def __init__(self, content: FakeContent):
+        self.content = content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def attempts(monkeypatch: pytest.MonkeyPatch):
+    # 試行ごとの(送るメッセージ, 最後にタイムアウトするか)
+    attempts: list[tuple[list, bool]] = []
+    requests: list[dict] = []
+
+    class FakeSession:
+        def post(self, url: str, json, raise_for_status: bool, timeout):
+            requests.append(json)
+            return FakeResponse(FakeContent(*attempts.pop(0)))
+
+    class FakeDataSource:
+        def list_ccds(self, visit: Visit):
+            return ccd_names
+
+    class FakeSessionContext:
+        async def __aenter__(self):
+            return FakeSession()
+
+        async def __aexit__(self, *args):
+            pass
+
+    monkeypatch.setattr(config, 'generate_ccd_assignment', 'static')
+    monkeypatch.setattr(config, 'dev_ccd_limit', None)
+    monkeypatch.setattr(job_generate, 'get_generators', lambda: [g1])
+    monkeypatch.setattr(job_generate, 'get_datasource', lambda: FakeDataSource())
+    monkeypatch.setattr(job_generate, 'client_session', lambda: FakeSessionContext())
+    return attempts, requests
+
+
+async def test_retry_before_ccds_are_reported(attempts):
+    scripts, requests = attempts
+    scripts.extend([([], True), ([ccd_meta(name) for name in ccd_names], False)])
+    done: list[str] = []
+    job = QuicklookJob(visit=visit, phase=QuicklookJobPhase.QUEUED)
+    results = await job_generate._scatter_generate_job(job, lambda job: None, on_ccd_done=lambda meta: done.append(meta.ccd_id.ccd_name))
+    assert len(requests) == 2
+    assert sorted(done) == sorted(ccd_names)
+    assert sorted(meta.ccd_id.ccd_name for meta in results) == sorted(ccd_names)
+
+
+async def test_no_retry_after_ccds_are_reported(attempts):
+    scripts, requests = attempts
+    # タイルがmergeに回った後でやり直すと、generatorがtmp storageを作り直してしまう
+    scripts.extend([([ccd_meta(ccd_names[0])], True), ([ccd_meta(name) for name in ccd_names], False)])
+    done: list[str] = []
+    job = QuicklookJob(visit=visit, phase=QuicklookJobPhase.QUEUED)
+    with pytest.raises(RuntimeError):
+        await job_generate._scatter_generate_job(job, lambda job: None, on_ccd_done=lambda meta: done.append(meta.ccd_id.ccd_name))
+    assert len(requests) == 1
+    assert done == [ccd_names[0]]
+
+
+async def test_barrier_mode_retries_after_ccds_are_reported(attempts):
+    scripts, requests = attempts
+    # mergeはgenerateが全て終わってから始まるので、やり直してよい
+    scripts.extend([([ccd_meta(ccd_names[0])], True), ([ccd_meta(name) for name in ccd_names], False)])
+    job = QuicklookJob(visit=visit, phase=QuicklookJobPhase.QUEUED)
+    results = await job_generate._scatter_generate_job(job, lambda job: None)
+    assert len(requests) == 2
+    assert sorted(meta.ccd_id.ccd_name for meta in results) == sorted(ccd_names)
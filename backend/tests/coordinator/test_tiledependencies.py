@@ -0,0 +1,95 @@
+from quicklook.coordinator.quicklookjob.tiledependencies import Released, TileDependencies
+from quicklook.select_primary_generator import NoOverlappingGenerators, select_primary_generator
+from quicklook.tileinfo import ccd_list
+from quicklook.types import GeneratorPod, PackedTileId, TileId
+
+g1 = GeneratorPod(host='g1', port=9502)
+g2 = GeneratorPod(host='g2', port=9502)
+
+
+def make_ccd_generator_map() -> dict[str, GeneratorPod]:
+    names = [ccd.name for ccd in ccd_list()][:27]
+    return {name: (g1 if k < len(names) // 2 else g2) for k, name in enumerate(names)}
+
+
+def test_tiles_are_released_after_all_contributing_ccds():
+    ccd_generator_map = make_ccd_generator_map()
+    deps = TileDependencies(ccd_generator_map)
+    released: dict[TileId, GeneratorPod] = {}
+    done: set[str] = set()
+    for ccd_name in ccd_generator_map:
+        r = deps.ccd_done(ccd_name)
+        done.add(ccd_name)
+        for g, tile_ids in r.to_merge.items():
+            for tile_id in tile_ids:
+                assert tile_id not in released
+                released[tile_id] = g
+                # そのタイルに重なるCCDは全て終わっている
+                _, generators = select_primary_generator(ccd_generator_map, tile_id)
+                assert generators
+        assert r.to_transfer == {} or all(r.to_transfer.values())
+    assert deps.release_all_tiles().to_merge == {}
+    for tile_id, g in released.items():
+        assert select_primary_generator(ccd_generator_map, tile_id)[0] == g
+
+
+def test_packed_tiles_are_released_after_all_tiles_are_merged():
+    ccd_generator_map = make_ccd_generator_map()
+    deps = TileDependencies(ccd_generator_map)
+    to_merge: list[TileId] = []
+    to_transfer: list[PackedTileId] = []
+    for g_tiles in [deps.ccd_done(name) for name in ccd_generator_map]:
+        for tile_ids in g_tiles.to_merge.values():
+            to_merge.extend(tile_ids)
+        for packed_ids in g_tiles.to_transfer.values():
+            to_transfer.extend(packed_ids)
+    for tile_id in to_merge:
+        for packed_ids in deps.tiles_merged([tile_id]).values():
+            to_transfer.extend(packed_ids)
+    expected = {PackedTileId.from_unpacked(t.level, t.i, t.j) for t in to_merge}
+    assert sorted(to_transfer, key=lambda p: (p.level, p.i, p.j)) == sorted(expected, key=lambda p: (p.level, p.i, p.j))
+
+
+def test_unfinished_ccd_blocks_its_tiles():
+    ccd_generator_map = make_ccd_generator_map()
+    deps = TileDependencies(ccd_generator_map)
+    names = [*ccd_generator_map]
+    for name in names[1:]:
+        deps.ccd_done(name)
+    last = deps.release_all_tiles()
+    tile_ids = [t for ts in last.to_merge.values() for t in ts]
+    assert tile_ids
+    for tile_id in tile_ids:
+        try:
+            _, generators = select_primary_generator({names[0]: ccd_generator_map[names[0]]}, tile_id)
+        except NoOverlappingGenerators:  # marginで含めたタイル
+            continue
+        assert generators
+
+
+
+def test_coarse_levels_are_published_first():
+    ccd_generator_map = make_ccd_generator_map()
+    deps = TileDependencies(ccd_generator_map)
+    coarse_min_level = 4
+
+    def run(released: Released):
+        to_transfer = [p for ps in released.to_transfer.values() for p in ps]
+        for tile_ids in released.to_merge.values():
+            assert all(t.level >= coarse_min_level for t in tile_ids)
+            for packed_ids in deps.tiles_merged(tile_ids).values():
+                to_transfer.extend(packed_ids)
+        deps.packs_transferred(to_transfer)
+
+    for name in ccd_generator_map:
+        assert deps.published_min_level() is None
+        run(deps.ccd_done(name, min_level=coarse_min_level))
+    assert deps.published_min_level() == coarse_min_level
+
+    for name in ccd_generator_map:
+        released = deps.ccd_done(name)
+        assert all(t.level < coarse_min_level for ts in released.to_merge.values() for t in ts)
+        for tile_ids in released.to_merge.values():
+            for packed_ids in deps.tiles_merged(tile_ids).values():
+                deps.packs_transferred(packed_ids)
+    assert deps.published_min_level() == 0
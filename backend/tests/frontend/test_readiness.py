@@ -0,0 +1,106 @@
+import time
+
+from quicklook.coordinator.quicklookjob.job import QuicklookJobPhase, QuicklookJobReport
+from quicklook.frontend.api.readiness import ReadinessIndex
+from quicklook.types import Visit
+
+
+def report(visit: Visit, phase: QuicklookJobPhase) -> QuicklookJobReport:
+    return QuicklookJobReport(
+        visit=visit,
+        phase=phase,
+        created_at=time.time(),
+        generate_progress=None,
+        merge_progress=None,
+        transfer_progress=None,
+    )
+
+
+a = Visit.from_id('raw:1')
+b = Visit.from_id('raw:2')
+c = Visit.from_id('raw:3')
+
+
+def test_snapshot_and_events():
+    index = ReadinessIndex()
+    assert not index.loaded
+    index.apply_snapshot(index.begin_snapshot(), [a, b])
+    assert index.loaded
+    assert a in index and b in index and c not in index
+
+    index.apply_report(report(c, QuicklookJobPhase.READY))
+    assert c in index
+
+    # 再生成が始まったvisitのタイルはstorageから返さない
+    index.apply_report(report(a, QuicklookJobPhase.QUEUED))
+    assert a not in index
+
+    index.apply_report(report(b, QuicklookJobPhase.FAILED))
+    assert b not in index
+
+
+def test_events_during_snapshot_win():
+    index = ReadinessIndex()
+    epoch = index.begin_snapshot()
+    index.apply_report(report(a, QuicklookJobPhase.READY))  # DBにはまだ反映されていない
+    index.apply_report(report(b, QuicklookJobPhase.GENERATE_RUNNING))
+    index.apply_snapshot(epoch, [b, c])
+    assert a in index
+    assert b not in index
+    assert c in index
+
+
+def test_snapshot_removes_evicted_visits():
+    index = ReadinessIndex()
+    index.apply_snapshot(index.begin_snapshot(), [a, b])
+    index.apply_snapshot(index.begin_snapshot(), [b])
+    assert a not in index
+    assert b in index
+
+
+def test_visits_no_longer_ready():
+    # 戻り値はタイルのキャッシュを無効にするのに使う
+    index = ReadinessIndex()
+    assert index.apply_snapshot(index.begin_snapshot(), [a, b]) == set()
+    assert index.apply_report(report(a, QuicklookJobPhase.QUEUED))
+    assert not index.apply_report(report(a, QuicklookJobPhase.GENERATE_RUNNING))
+    assert not index.apply_report(report(c, QuicklookJobPhase.QUEUED))
+    assert index.apply_snapshot(index.begin_snapshot(), []) == {b}
+
+
+def test_concurrent_snapshots():
+    # 再接続と定期的な同期が重なった
+    index = ReadinessIndex()
+    index.apply_snapshot(index.begin_snapshot(), [a, b])
+    first = index.begin_snapshot()
+    index.apply_report(report(a, QuicklookJobPhase.QUEUED))
+    second = index.begin_snapshot()
+    index.apply_report(report(c, QuicklookJobPhase.READY))
+
+    # bはhousekeepで削除された
+    assert index.apply_snapshot(second, [c]) == {b}
+    assert a not in index and b not in index and c in index
+    # 後から始まったsnapshotが適用済みなので、古いsnapshotは無視される
+    assert index.apply_snapshot(first, [a, b]) == set()
+    assert a not in index and b not in index and c in index
+
+
+def test_snapshots_keep_their_own_events():
+    index = ReadinessIndex()
+    first = index.begin_snapshot()
+    second = index.begin_snapshot()
+    index.apply_report(report(a, QuicklookJobPhase.READY))
+    index.apply_snapshot(first, [])
+    index.apply_report(report(b, QuicklookJobPhase.READY))
+    # 先のsnapshotが適用されても、後のsnapshotの間に受け取ったイベントは残る
+    index.apply_snapshot(second, [c])
+    assert a in index and b in index and c in index
+
+
+def test_cancel_snapshot():
+    index = ReadinessIndex()
+    index.cancel_snapshot(index.begin_snapshot())
+    assert not index.loaded
+    index.apply_report(report(a, QuicklookJobPhase.READY))
+    index.apply_snapshot(index.begin_snapshot(), [b])
+    assert a not in index and b in index
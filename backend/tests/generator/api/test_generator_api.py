@@ -1,14 +1,22 @@
 import io
 from dataclasses import asdict
 
+import astropy.io.fits as pyfits
+import numpy
 import pytest
 from fastapi.testclient import TestClient
 
 from quicklook.config import config
 from quicklook.coordinator.quicklookjob.tasks import GenerateTask
 from quicklook.generator.api import GeneratorRuntimeSettings, app
-from quicklook.types import GeneratorPod, GenerateProgress, CcdMeta, Visit
+from quicklook.generator.api.tilegenerate import save_headers
+from quicklook.generator.generatorstorage import mergedtile_storage, tmptile_storage
+from quicklook.types import BBox, CcdId, GeneratorPod, GenerateProgress, CcdMeta, ImageStat, PreProcessedCcd, Tile, TileId, Visit
+from quicklook.utils import zstd
+from quicklook.utils.fits import parse_hdus
+from quicklook.utils.fitsheader import fitsheader_to_list
 from quicklook.utils.message import message_from_stream
+from quicklook.utils.numpyutils import ndarray2npybytes, npybytes2ndarray
 
 # pytestmark = pytest.mark.focus
 
@@ -42,3 +50,58 @@ def test_create_quicklook(client: TestClient):
         assert isinstance(msg, (GenerateProgress, CcdMeta))
 
     assert res.status_code == 200
+
+
+def test_get_tiles_bulk(client: TestClient):
+    visit = Visit.from_id('raw:bulktest')
+    tile = numpy.ones((config.tile_size, config.tile_size), dtype=numpy.float32)
+    for ccd_name in ['R30_S20', 'R30_S21']:
+        with tmptile_storage.writer(CcdId(visit, ccd_name)) as writer:
+            writer.put_tile(Tile(visit=visit, level=3, i=1, j=2, data=tile))
+    try:
+        res = client.post(f'/quicklooks/{visit.id}/tiles:bulk', json={'tile_ids': [(3, 1, 2)]})
+        assert res.status_code == 200
+        buf = io.BytesIO(res.content)
+        tile_id, arr = message_from_stream(buf)
+        assert tile_id == TileId(3, 1, 2)
+        numpy.testing.assert_array_equal(arr, tile * 2)
+        assert message_from_stream(buf) is None
+    finally:
+        tmptile_storage.delete(visit)
+
+
+def test_get_tile_from_merged_storage(client: TestClient):
+    # 1つのCCDだけが重なるタイルはgenerateの時点でmerged storageにある
+    visit = Visit.from_id('raw:fastpathtest')
+    tile = numpy.arange(config.tile_size**2, dtype=numpy.float32).reshape(config.tile_size, config.tile_size)
+    mergedtile_storage.put_compressed_tile_data(visit, 0, 3, 4, zstd.compress(ndarray2npybytes(tile)))
+    try:
+        res = client.get(f'/quicklooks/{visit.id}/tiles/0/3/4')
+        assert res.status_code == 200
+        numpy.testing.assert_array_equal(npybytes2ndarray(res.content), tile)
+    finally:
+        mergedtile_storage.delete(visit)
+
+
+def test_get_fits_header(client: TestClient, tmp_path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, 'fits_header_tmpdir', str(tmp_path))
+    visit = Visit.from_id('raw:headertest')
+    hdul = pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.ImageHDU(numpy.zeros((2, 3), dtype=numpy.float32), name='Segment10')])
+    hdul[0].header['OBSERVER'] = ("O'Hara", 'observer')
+    f = io.BytesIO()
+    hdul.writeto(f)
+    hdus = parse_hdus(f.getvalue())
+    pool = numpy.zeros((1, 1), dtype=numpy.float32)
+    ppccd = PreProcessedCcd(
+        ccd_id=CcdId(visit, 'R30_S20'),
+        bbox=BBox(miny=0, maxy=0, minx=0, maxx=0),
+        pool=pool,
+        stat=ImageStat(median=0, mad=0, shape=pool.shape),
+        amps=[],
+        raw_headers=[bytes(hdu.header) for hdu in hdus],
+    )
+    save_headers(ppccd)
+    res = client.get(f'/quicklooks/{visit.id}/fits_header/R30_S20')
+    assert res.status_code == 200
+    expected = fitsheader_to_list(pyfits.HDUList.fromstring(f.getvalue()))
+    assert res.json() == [[list(card) for card in header] for header in expected]
@@ -0,0 +1,75 @@
+import time
+from typing import Callable
+
+import pytest
+
+from quicklook.config import config
+from quicklook.generator.api.supervisor import Supervisor, activate_supervisor, run_task
+from quicklook.generator.workerpool import worker_pool
+
+
+def echo_runner(task: list[int], send: Callable[[int], None]) -> None:
+    for x in task:
+        send(x)
+
+
+def double(x: int) -> int:
+    return 2 * x
+
+
+def pool_runner(task: list[int], send: Callable[[int], None]) -> None:
+    with worker_pool(config.tile_merge_parallel) as pool:
+        send(sum(pool.imap_unordered(double, task)))
+
+
+def failing_runner(task: None, send: Callable[[int], None]) -> None:
+    raise RuntimeError('intentional error')
+
+
+def endless_runner(task: None, send: Callable[[int], None]) -> None:
+    while True:
+        send(0)
+        time.sleep(0.01)
+
+
+def receive_all(recv: Callable) -> list:
+    msgs = []
+    while (msg := recv()) is not None:
+        msgs.append(msg)
+    return msgs
+
+
+@pytest.fixture(scope='module')
+def supervisor():
+    with activate_supervisor() as supervisor:
+        yield supervisor
+
+
+def test_run_task(supervisor: Supervisor):
+    with run_task(echo_runner, [1, 2, 3]) as recv:
+        assert receive_all(recv) == [1, 2, 3]
+
+
+def test_run_task_with_warm_pool(supervisor: Supervisor):
+    for _ in range(2):
+        with run_task(pool_runner, [*range(10)]) as recv:
+            assert receive_all(recv) == [90]
+
+
+def test_run_task_error(supervisor: Supervisor):
+    with run_task(failing_runner, None) as recv:
+        [e] = receive_all(recv)
+    assert isinstance(e, RuntimeError)
+
+
+def test_cancel_task(supervisor: Supervisor):
+    with run_task(endless_runner, None) as recv:
+        assert recv() == 0
+    # キャンセルされた後も他のタスクは動く
+    with run_task(echo_runner, [1]) as recv:
+        assert receive_all(recv) == [1]
+
+
+def test_run_task_without_supervisor():
+    with run_task(echo_runner, [1, 2]) as recv:
+        assert receive_all(recv) == [1, 2]
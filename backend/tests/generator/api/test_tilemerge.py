@@ -0,0 +1,106 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+from quicklook.config import config
+from quicklook.generator.api import tilemerge
+from quicklook.types import GeneratorPod, TileId, Visit
+from quicklook.utils.message import encode_message
+
+visit = Visit.from_id('raw:gather')
+tile_ids = [TileId(5, k, 0) for k in range(100)]
+
+
+class FakeStream:
+    # peerのtiles:bulkのレスポンス。タイルはリクエストされた順に返す
+    def __init__(self, value: float, *, gate: threading.Event | None = None, fail_after: int | None = None):
+        self._messages = iter([])
+        self._value = value
+        self._gate = gate
+        self._fail_after = fail_after
+        self._buf = b''
+        self.produced = 0
+
+    def request(self, tile_ids: list[tuple[int, int, int]]) -> 'FakeStream':
+        self._messages = iter([*(TileId(*t) for t in tile_ids), None])
+        return self
+
+    def read(self, n: int) -> bytes:
+        if self._gate:
+            self._gate.wait()
+        if len(self._buf) == 0:
+            if self.produced == self._fail_after:
+                raise ConnectionError('peer failed')
+            tile_id = next(self._messages)
+            msg = None if tile_id is None else (tile_id, numpy.full((2, 2), self._value * tile_id.i, dtype=numpy.float32))
+            self._buf = encode_message(msg)
+            self.produced += 1
+        chunk, self._buf = self._buf[:n], self._buf[n:]
+        return chunk
+
+
+class FakeResponse:
+    def __init__(self, raw: FakeStream):
+        self.raw = raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def peers(monkeypatch: pytest.MonkeyPatch):
+    streams: dict[str, FakeStream] = {}
+
+    class FakeSession:
+        def post(self, url: str, json, stream: bool, timeout: float):
+            host = url.split('/')[2]
+            return FakeResponse(streams[host].request(json['tile_ids']))
+
+    monkeypatch.setattr(config, 'tile_merge_parallel', 2)
+    monkeypatch.setattr(tilemerge, 'http_session', lambda: FakeSession())
+    return streams
+
+
+def test_gather_tiles_bulk_slow_peer(peers: dict[str, FakeStream]):
+    a = GeneratorPod(host='a', port=1)
+    b = GeneratorPod(host='b', port=1)
+    gate = threading.Event()
+    peers['a:1'] = FakeStream(1)
+    peers['b:1'] = FakeStream(2, gate=gate)
+
+    results: list[tuple[TileId, numpy.ndarray | None]] = []
+    # リクエストの順番はgather_tiles_bulkが揃える
+    t = threading.Thread(target=lambda: results.extend(tilemerge.gather_tiles_bulk(visit, {a: tile_ids, b: tile_ids[::-1]})))
+    t.start()
+    time.sleep(0.3)
+    # 遅いpeerを待っている間、速いpeerからはqueueの分しか読まない
+    assert peers['a:1'].produced <= 4 * config.tile_merge_parallel + 2
+    gate.set()
+    t.join(timeout=10)
+    assert [tile_id for tile_id, _ in results] == tile_ids
+    for tile_id, arr in results:
+        assert arr is not None
+        numpy.testing.assert_array_equal(arr, numpy.full((2, 2), 3 * tile_id.i))
+
+
+def test_gather_tiles_bulk_failed_peer(peers: dict[str, FakeStream]):
+    a = GeneratorPod(host='a', port=1)
+    b = GeneratorPod(host='b', port=1)
+    c = GeneratorPod(host='c', port=1)
+    peers['a:1'] = FakeStream(1)
+    peers['b:1'] = FakeStream(2, fail_after=10)
+    peers['c:1'] = FakeStream(4, fail_after=0)
+    results = dict(tilemerge.gather_tiles_bulk(visit, {a: tile_ids, b: tile_ids, c: tile_ids[50:]}))
+    assert len(results) == 100
+    for tile_id, arr in results.items():
+        assert arr is not None
+        # 失敗したpeerの分は足されない
+        numpy.testing.assert_array_equal(arr, numpy.full((2, 2), (3 if tile_id.i < 10 else 1) * tile_id.i))
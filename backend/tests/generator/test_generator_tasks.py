@@ -1,12 +1,27 @@
+import contextlib
+import multiprocessing
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-import tempfile
 
+import numpy
 import pytest
 
-from quicklook.coordinator.quicklookjob.tasks import GeneratorPod, GenerateTask
+from quicklook.config import config
+from quicklook.coordinator.quicklookjob.tasks import GeneratorPod, GenerateTask, MergeTask
+from quicklook.datasource.dummy_datasource import DummyDataSource
 from quicklook.generator.api import tilegenerate
+from quicklook.generator.api.tilemerge import run_merge
+from quicklook.generator.api.supervisor import TaskCancelled
+from quicklook.generator.generatorstorage import mergedtile_storage, tmptile_storage
+from quicklook.generator.iteratetiles import iterate_tiles
 from quicklook.generator.progress import GeneratorProgressReporter, tqdm_progres_bar
-from quicklook.types import CcdId, GenerateProgress, Visit
+from quicklook.tileinfo import CCD_BBOX_MARGIN, TileInfo, ccds_by_name
+from quicklook.types import BBox, CcdId, GenerateProgress, ImageStat, PreProcessedCcd, Progress, Tile, Visit
+from quicklook.utils import zstd
+from quicklook.utils.numpyutils import npybytes2ndarray
 
 
 # @pytest.mark.focus
@@ -63,6 +78,26 @@ def test_progress():
     pickle.dumps(progress)
 
 
+def _report_progress(updator: GeneratorProgressReporter.InterProcessUpdator):
+    updator.preprocess_done()
+    updator.update_maketile_progress(Progress(count=3, total=4))
+    updator.coarse_done()
+
+
+def test_progress_reporter_shared_memory():
+    visit = Visit.from_id('raw:broccoli')
+    ccd_ids = [CcdId(visit, ccd_name) for ccd_name in ['R22_S00', 'R22_S01']]
+    updates: list[GenerateProgress] = []
+    coarse_done: list[CcdId] = []
+    task = GenerateTask(generator=GeneratorPod(host='localhost', port=8000), ccd_names=[c.ccd_name for c in ccd_ids], visit=visit)
+    with GeneratorProgressReporter(task, on_update=updates.append, on_coarse_done=coarse_done.append) as progress:
+        with multiprocessing.Pool(2) as pool:
+            pool.map(_report_progress, [progress.updator(ccd_id) for ccd_id in ccd_ids])
+    assert updates[-1].preprocess == Progress(count=2, total=2)
+    assert updates[-1].maketile.count / updates[-1].maketile.total == 3 / 4
+    assert sorted(coarse_done, key=lambda c: c.ccd_name) == ccd_ids
+
+
 def test_processccd(broccoli_fits_and_ccd_id: tuple[Path, str]):
     path, ccd = broccoli_fits_and_ccd_id
 
@@ -77,13 +112,213 @@ def test_processccd(broccoli_fits_and_ccd_id: tuple[Path, str]):
         ),
         on_update=on_update,
     ) as progress_reporter:
-        # to prevent the fixture from being deleted
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write(path.read_bytes())
-            tmp.flush()
-            args = tilegenerate.ProcessCcdArgs(
-                ccd_id=CcdId(visit=Visit.from_id('raw:broccoli'), ccd_name=ccd),
-                path=Path(tmp.name),
-                progress_updator=progress_reporter.updator,
-            )
-            tilegenerate.process_ccd(args)
+        ccd_id = CcdId(visit=Visit.from_id('raw:broccoli'), ccd_name=ccd)
+        fits = tilegenerate.SharedFitsBuffer.create(path.read_bytes())
+        args = tilegenerate.ProcessCcdArgs(
+            ccd_id=ccd_id,
+            fits=fits,
+            progress_updator=progress_reporter.updator(ccd_id),
+        )
+        tilegenerate.process_ccd(args)
+        # workerが読み終えたらunlinkされる
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=fits.name, track=False)
+
+
+def test_make_tiles_single_contributor_fast_path():
+    visit = Visit.from_id('raw:fastpath')
+    ccd_name = 'R22_S11'
+    bbox = ccds_by_name()[ccd_name].bbox
+    pool = numpy.random.default_rng(0).normal(size=(int(bbox.maxy - bbox.miny) + 1, int(bbox.maxx - bbox.minx) + 1)).astype(numpy.float32)
+    ppccd = PreProcessedCcd(ccd_id=CcdId(visit, ccd_name), bbox=bbox, pool=pool, stat=ImageStat(median=0, mad=1, shape=pool.shape), amps=[], raw_headers=[])
+
+    expected: dict[tuple[int, int, int], numpy.ndarray] = {}
+
+    def collect(tile: Tile, progress: Progress):
+        expected[tile.level, tile.i, tile.j] = numpy.array(tile.data)
+
+    iterate_tiles(ppccd, collect)
+    try:
+        tilegenerate.make_tiles(ppccd, update_progress=Progress.noop_progress)
+        merged = set(mergedtile_storage.iter_tiles(visit))
+        assert merged == {key for key in expected if TileInfo.of(*key, margin=CCD_BBOX_MARGIN).ccd_names == [ccd_name]}
+        assert len(merged) > 0
+        assert set(tmptile_storage.iter_tiles(visit)) == expected.keys() - merged
+        for key in merged:
+            arr = npybytes2ndarray(zstd.decompress(mergedtile_storage.get_compressed_tile_data(visit, *key)))
+            numpy.testing.assert_array_equal(arr, expected[key])
+    finally:
+        tmptile_storage.delete(visit)
+        mergedtile_storage.delete(visit)
+
+
+def test_make_tiles_fast_path_with_neighbour_outside_bbox():
+    # R02_S01の右端（x=33786）はタイルの境界（x=33792）の少し手前にあり、その先のタイルにはR02_S02だけが重なる
+    # R02_S01が同じgeneratorでbboxの外まで書き込んでも、R02_S02の分が消えない
+    visit = Visit.from_id('raw:fastpath-neighbour')
+    g = GeneratorPod(host='localhost', port=8000)
+    left, right = ccds_by_name()['R02_S01'].bbox, ccds_by_name()['R02_S02'].bbox
+    miny = right.miny
+    j = int(left.maxx) // config.tile_size + 1
+    assert 0 < j * config.tile_size - left.maxx <= CCD_BBOX_MARGIN
+    assert TileInfo.of(0, int(miny) // config.tile_size, j).ccd_names == ['R02_S02']
+    rng = numpy.random.default_rng(0)
+
+    def make_ccd(ccd_name: str, minx: float, maxx: float) -> PreProcessedCcd:
+        bbox = BBox(miny=miny, maxy=miny + 99, minx=minx, maxx=maxx)
+        pool = rng.normal(size=(100, int(maxx - minx) + 1)).astype(numpy.float32)
+        return PreProcessedCcd(ccd_id=CcdId(visit, ccd_name), bbox=bbox, pool=pool, stat=ImageStat(median=0, mad=1, shape=pool.shape), amps=[], raw_headers=[])
+
+    ccds = [make_ccd('R02_S01', left.maxx - 99, left.maxx + 8), make_ccd('R02_S02', right.minx, right.minx + 99)]
+    expected: dict[tuple[int, int, int], numpy.ndarray] = {}
+
+    def collect(tile: Tile, progress: Progress):
+        key = (tile.level, tile.i, tile.j)
+        expected[key] = expected[key] + tile.data if key in expected else numpy.array(tile.data)
+
+    for ppccd in ccds:
+        iterate_tiles(ppccd, collect)
+    try:
+        for ppccd in ccds:
+            tilegenerate.make_tiles(ppccd, update_progress=Progress.noop_progress)
+        run_merge(MergeTask(visit=visit, generator=g, ccd_generator_map={'R02_S01': g, 'R02_S02': g}), lambda msg: None)
+        assert set(mergedtile_storage.iter_tiles(visit)) == expected.keys()
+        for key, data in expected.items():
+            arr = npybytes2ndarray(zstd.decompress(mergedtile_storage.get_compressed_tile_data(visit, *key)))
+            numpy.testing.assert_array_equal(arr, data)
+    finally:
+        tmptile_storage.delete(visit)
+        mergedtile_storage.delete(visit)
+
+
+class CountingDataSource(DummyDataSource):
+    def __init__(self):
+        self.downloads: list[CcdId] = []
+
+    def get_data(self, ccd_id: CcdId) -> bytes:
+        self.downloads.append(ccd_id)
+        return f'{ccd_id.name}'.encode() * 100
+
+
+def test_get_data_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    ds = CountingDataSource()
+    ccd_id = CcdId(Visit.from_id('raw:cached'), 'R22_S11')
+
+    tilegenerate._raw_cache.cache_clear()
+    try:
+        # 既定ではキャッシュしない
+        tilegenerate.get_data_cached(ds, ccd_id)
+        tilegenerate.get_data_cached(ds, ccd_id)
+        assert len(ds.downloads) == 2
+
+        monkeypatch.setattr(config, 'raw_cache_dir', str(tmp_path))
+        monkeypatch.setattr(config, 'raw_cache_max_bytes', 1 << 20)
+        tilegenerate._raw_cache.cache_clear()
+        for _ in range(3):
+            assert tilegenerate.get_data_cached(ds, ccd_id) == f'{ccd_id.name}'.encode() * 100
+        assert len(ds.downloads) == 3
+
+        # 識別できないデータはキャッシュしない
+        monkeypatch.setattr(ds, 'get_data_id', lambda ccd_id: None)
+        tilegenerate.get_data_cached(ds, ccd_id)
+        assert len(ds.downloads) == 4
+    finally:
+        tilegenerate._raw_cache.cache_clear()
+
+
+class FailingDataSource(DummyDataSource):
+    def __init__(self, failing: set[str]):
+        self.failing = failing
+
+    def get_data(self, ccd_id: CcdId) -> bytes:
+        if ccd_id.ccd_name in self.failing:
+            raise RuntimeError(f'no data for {ccd_id.name}')
+        return f'{ccd_id.name}'.encode()
+
+
+class SerialPool:
+    def imap_unordered(self, func, iterable):
+        return map(func, iterable)
+
+
+def test_run_generate_download_failure(monkeypatch: pytest.MonkeyPatch):
+    ccd_names = [*'R22_S00 R22_S01 R22_S02 R22_S10 R22_S11 R22_S12 R22_S20 R22_S21'.split()]
+    failing = set(ccd_names[:6])
+    processed: list[str] = []
+
+    def process_ccd(args: tilegenerate.ProcessCcdArgs):
+        processed.append(args.ccd_id.ccd_name)
+        args.fits.unlink()
+        return args.ccd_id.ccd_name
+
+    # 処理中と先読みで2つ分しかないので、失敗したダウンロードの分を解放しないと止まってしまう
+    monkeypatch.setattr(config, 'tile_ccd_processing_parallel', 1)
+    monkeypatch.setattr(config, 'generate_pull_prefetch', 1)
+    monkeypatch.setattr(config, 'generate_download_parallel_max', 1)
+    monkeypatch.setattr(config, 'tile_accumulate_min_level', None)
+    monkeypatch.setattr(tilegenerate, 'get_datasource', lambda: FailingDataSource(failing))
+    monkeypatch.setattr(tilegenerate, 'worker_pool', lambda parallel: contextlib.nullcontext(SerialPool()))
+    monkeypatch.setattr(tilegenerate, 'process_ccd', process_ccd)
+
+    task = GenerateTask(
+        visit=Visit.from_id('raw:failing'),
+        ccd_names=ccd_names,
+        generator=GeneratorPod(host='localhost', port=8000),
+    )
+    sent = []
+    t = threading.Thread(target=tilegenerate.run_generate, args=(task, sent.append), daemon=True)
+    t.start()
+    t.join(timeout=30)
+    assert not t.is_alive()
+    assert sorted(processed) == sorted(set(ccd_names) - failing)
+    assert sorted(r for r in sent if isinstance(r, str)) == sorted(processed)
+
+
+def test_run_generate_cancel(monkeypatch: pytest.MonkeyPatch):
+    ccd_names = [*'R22_S00 R22_S01 R22_S02 R22_S10 R22_S11 R22_S12 R22_S20 R22_S21'.split()]
+    running: set[str] = set()
+    started: list[str] = []
+    skipped: list[str] = []
+
+    def process_ccd(args: tilegenerate.ProcessCcdArgs):
+        name = args.ccd_id.ccd_name
+        if args.progress_updator.cancelled():
+            skipped.append(name)
+            raise tilegenerate.CcdProcessingCancelled(name)
+        started.append(name)
+        running.add(name)
+        try:
+            for _ in range(50):
+                if args.progress_updator.cancelled():
+                    raise tilegenerate.CcdProcessingCancelled(name)
+                time.sleep(0.01)
+        finally:
+            running.discard(name)
+            args.fits.unlink()
+        return name
+
+    def send(msg):
+        if isinstance(msg, str):
+            raise TaskCancelled()
+
+    monkeypatch.setattr(config, 'tile_ccd_processing_parallel', 2)
+    monkeypatch.setattr(config, 'generate_pull_prefetch', 2)
+    monkeypatch.setattr(config, 'generate_download_parallel_max', 2)
+    monkeypatch.setattr(config, 'tile_accumulate_min_level', None)
+    monkeypatch.setattr(tilegenerate, 'get_datasource', lambda: FailingDataSource(set()))
+    monkeypatch.setattr(tilegenerate, 'process_ccd', process_ccd)
+
+    task = GenerateTask(
+        visit=Visit.from_id('raw:cancel'),
+        ccd_names=ccd_names,
+        generator=GeneratorPod(host='localhost', port=8000),
+    )
+    # supervisorのように他のタスクと共有されているpool
+    with ThreadPool(2) as pool:
+        monkeypatch.setattr(tilegenerate, 'worker_pool', lambda parallel: contextlib.nullcontext(pool))
+        with pytest.raises(TaskCancelled):
+            tilegenerate.run_generate(task, send)
+        # このタスクのCCDはもうpoolで動いていない
+        assert running == set()
+        assert len(started) + len(skipped) < len(ccd_names)
+        assert pool.apply(sum, ([1, 2],)) == 3
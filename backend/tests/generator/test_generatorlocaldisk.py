@@ -1,4 +1,6 @@
+import multiprocessing
 import shutil
+import time
 from pathlib import Path
 from typing import Generator
 
@@ -6,7 +8,7 @@ import numpy as np
 import pytest
 
 from quicklook.config import config
-from quicklook.generator.generatorstorage import tmptile_storage
+from quicklook.generator.generatorstorage import TileAccumulator, accumulator_slots, tmptile_storage
 from quicklook.types import CcdId, Tile, Visit
 
 
@@ -80,12 +82,12 @@ def test_iter_tiles(test_tmpdir: Path, sample_visit: Visit, sample_ccd_id: CcdId
         (1, 5, 6),
     ]
     
-    # Create tile files using TmpTile.put
-    for level, i, j in test_structures:
-        # Create a sample tile with the current level, i, j coordinates
-        tile = Tile(visit=sample_visit, level=level, i=i, j=j, data=np.zeros((10, 10), dtype=np.float32))
-        # Use TmpTile.put to save it
-        tmptile_storage.put_tile(sample_ccd_id, tile)
+    # Create tile files using the writer of the CCD
+    with tmptile_storage.writer(sample_ccd_id) as writer:
+        for level, i, j in test_structures:
+            # Create a sample tile with the current level, i, j coordinates
+            tile = Tile(visit=sample_visit, level=level, i=i, j=j, data=np.zeros((10, 10), dtype=np.float32))
+            writer.put_tile(tile)
     
     # Collect results from iter_tiles
     result_tiles = list(tmptile_storage.iter_tiles(sample_visit))
@@ -94,3 +96,88 @@ def test_iter_tiles(test_tmpdir: Path, sample_visit: Visit, sample_ccd_id: CcdId
     assert len(result_tiles) == len(test_structures)
     for expected in test_structures:
         assert expected in result_tiles
+
+
+def test_get_tile_npy(test_tmpdir: Path, sample_visit: Visit) -> None:
+    """Test that get_tile_npy sums the tiles of all the CCDs"""
+    for k, ccd_name in enumerate(['R00_SG0', 'R00_SG1']):
+        with tmptile_storage.writer(CcdId(visit=sample_visit, ccd_name=ccd_name)) as writer:
+            writer.put_tile(Tile(visit=sample_visit, level=0, i=0, j=0, data=np.full((10, 10), k + 1, dtype=np.float32)))
+            # 連続していないviewも書き出せる
+            writer.put_tile(Tile(visit=sample_visit, level=1, i=0, j=k, data=np.arange(400, dtype=np.float32).reshape(20, 20)[::2, ::2]))
+
+    np.testing.assert_array_equal(tmptile_storage.get_tile_npy(sample_visit, 0, 0, 0), np.full((10, 10), 3))
+    np.testing.assert_array_equal(tmptile_storage.get_tile_npy(sample_visit, 1, 0, 1), np.arange(400).reshape(20, 20)[::2, ::2])
+    assert tmptile_storage.has_tile(sample_visit, 1, 0, 0)
+    assert not tmptile_storage.has_tile(sample_visit, 1, 1, 0)
+
+
+def test_writer_flush(test_tmpdir: Path, sample_visit: Visit, sample_ccd_id: CcdId) -> None:
+    """Test that tiles become visible on flush and that a rewritten CCD replaces its tiles"""
+    with tmptile_storage.writer(sample_ccd_id) as writer:
+        writer.put_tile(Tile(visit=sample_visit, level=2, i=0, j=0, data=np.ones((10, 10), dtype=np.float32)))
+        assert list(tmptile_storage.iter_tiles(sample_visit)) == []
+        writer.flush()
+        assert list(tmptile_storage.iter_tiles(sample_visit)) == [(2, 0, 0)]
+        writer.put_tile(Tile(visit=sample_visit, level=0, i=0, j=0, data=np.ones((10, 10), dtype=np.float32)))
+    assert sorted(tmptile_storage.iter_tiles(sample_visit)) == [(0, 0, 0), (2, 0, 0)]
+
+    with tmptile_storage.writer(sample_ccd_id) as writer:
+        writer.put_tile(Tile(visit=sample_visit, level=0, i=0, j=0, data=np.full((10, 10), 5, dtype=np.float32)))
+    assert list(tmptile_storage.iter_tiles(sample_visit)) == [(0, 0, 0)]
+    np.testing.assert_array_equal(tmptile_storage.get_tile_npy(sample_visit, 0, 0, 0), np.full((10, 10), 5))
+
+
+def _add_to_accumulator(args: tuple[str, str, int, tuple[int, int, int]]) -> None:
+    tmpdir, accumulator, k, (level, i, j) = args
+    config.tile_tmpdir = tmpdir
+    visit = Visit(id="12345")
+    with tmptile_storage.writer(CcdId(visit=visit, ccd_name=f'CCD{k}'), accumulator) as writer:
+        writer.put_tile(Tile(visit=visit, level=level, i=i, j=j, data=np.full((config.tile_size, config.tile_size), k, dtype=np.float32)))
+
+
+def test_accumulator(test_tmpdir: Path, sample_visit: Visit, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that tiles of level >= tile_accumulate_min_level are summed into one slot by all the workers"""
+    monkeypatch.setattr(config, 'tile_accumulate_min_level', 4)
+    accumulator = tmptile_storage.reset(sample_visit)
+    assert accumulator is not None
+    key = accumulator_slots(4)[0][0]
+
+    with multiprocessing.Pool(4) as pool:
+        pool.map(_add_to_accumulator, [(str(test_tmpdir), accumulator, k, key) for k in range(1, 21)])
+    # level 4未満はCCDごとのファイルに書かれる
+    with tmptile_storage.writer(CcdId(visit=sample_visit, ccd_name='R00_SG0'), accumulator) as writer:
+        writer.put_tile(Tile(visit=sample_visit, level=0, i=0, j=0, data=np.ones((config.tile_size, config.tile_size), dtype=np.float32)))
+
+    assert sorted(tmptile_storage.iter_tiles(sample_visit)) == sorted([key, (0, 0, 0)])
+    assert tmptile_storage.has_tile(sample_visit, *key)
+    np.testing.assert_array_equal(tmptile_storage.get_tile_npy(sample_visit, *key), np.full((config.tile_size, config.tile_size), sum(range(1, 21))))
+
+    # 新しい世代では前の和は消える
+    tmptile_storage.reset(sample_visit)
+    assert list(tmptile_storage.iter_tiles(sample_visit)) == []
+
+
+def test_accumulator_is_unmapped(test_tmpdir: Path, sample_visit: Visit, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the readers unmap the accumulators of the old generations"""
+    monkeypatch.setattr(config, 'tile_accumulate_min_level', 4)
+    key = accumulator_slots(4)[0][0]
+
+    def generate() -> TileAccumulator:
+        accumulator = tmptile_storage.reset(sample_visit)
+        with tmptile_storage.writer(CcdId(visit=sample_visit, ccd_name='R00_SG0'), accumulator) as writer:
+            writer.put_tile(Tile(visit=sample_visit, level=key[0], i=key[1], j=key[2], data=np.ones((config.tile_size, config.tile_size), dtype=np.float32)))
+        assert tmptile_storage.has_tile(sample_visit, *key)
+        acc = tmptile_storage._accumulator(sample_visit)
+        assert acc is not None
+        return acc
+
+    acc = generate()
+    tmptile_storage.delete(sample_visit)
+    assert acc._mm.closed
+
+    acc = generate()
+    # 別のプロセスで新しい世代が作られた
+    (tmptile_storage.visit_dir(sample_visit) / f'accumulator.{time.time_ns()}.4.tiles').touch()
+    assert not tmptile_storage.has_tile(sample_visit, *key)
+    assert acc._mm.closed
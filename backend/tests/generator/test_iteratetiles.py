@@ -1,6 +1,9 @@
+import numpy
+import pytest
 import tqdm
+from quicklook.config import config
 from quicklook.generator.iteratetiles import iterate_tiles
-from quicklook.types import PreProcessedCcd, Progress, Tile
+from quicklook.types import BBox, CcdId, ImageStat, PreProcessedCcd, Progress, Tile, Visit
 
 
 def test_iterate_tiles(preprocessed_ccd: PreProcessedCcd):
@@ -13,3 +16,85 @@ def test_iterate_tiles(preprocessed_ccd: PreProcessedCcd):
             pbar.refresh()
 
         iterate_tiles(preprocessed_ccd, cb)
+
+
+def test_iterate_tiles_coarse_first(preprocessed_ccd: PreProcessedCcd):
+    def collect(**kwargs):
+        tiles: dict[tuple[int, int, int], Tile] = {}
+        events: list[int | str] = []
+
+        def cb(tile: Tile, progress: Progress):
+            tiles[tile.level, tile.i, tile.j] = tile
+            events.append(tile.level)
+
+        iterate_tiles(preprocessed_ccd, cb, on_coarse_done=lambda: events.append('coarse'), **kwargs)
+        return tiles, events
+
+    fine_first, _ = collect()
+    coarse_first, events = collect(coarse_min_level=4)
+
+    i = events.index('coarse')
+    assert all(isinstance(level, int) and level >= 4 for level in events[:i])
+    assert all(isinstance(level, int) and level < 4 for level in events[i + 1 :])
+    assert fine_first.keys() == coarse_first.keys()
+    for key, tile in fine_first.items():
+        numpy.testing.assert_array_equal(tile.data, coarse_first[key].data)
+
+
+def make_ccd(h: int, w: int, miny: int, minx: int, seed: int = 0) -> PreProcessedCcd:
+    pool = numpy.random.default_rng(seed).normal(1000, 10, (h, w)).astype(numpy.float32)
+    return PreProcessedCcd(
+        ccd_id=CcdId(Visit.from_id('raw:test'), 'R00_SG0'),
+        bbox=BBox(miny=miny, maxy=miny + h - 1, minx=minx, maxx=minx + w - 1),
+        pool=pool,
+        stat=ImageStat(median=1000, mad=10, shape=pool.shape),
+        amps=[],
+        raw_headers=[],
+    )
+
+
+def collect_tiles(ppccd: PreProcessedCcd):
+    tiles: dict[tuple[int, int, int], numpy.ndarray] = {}
+
+    def cb(tile: Tile, progress: Progress):
+        tiles[tile.level, tile.i, tile.j] = numpy.array(tile.data)
+
+    iterate_tiles(ppccd, cb)
+    return tiles
+
+
+def test_iterate_tiles_small(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(config, 'tile_size', 2)
+    monkeypatch.setattr(config, 'tile_max_level', 2)
+    # 奇数の位置にあるので、上のlevelでは外側を0で埋めて平均する
+    ppccd = make_ccd(3, 3, 1, 1)
+    ppccd.pool[:] = numpy.arange(1, 10).reshape(3, 3)
+    expected = {
+        (0, 0, 0): [[0, 0], [0, 1]],
+        (0, 0, 1): [[0, 0], [2, 3]],
+        (0, 1, 0): [[0, 4], [0, 7]],
+        (0, 1, 1): [[5, 6], [8, 9]],
+        (1, 0, 0): [[0.25, 1.25], [2.75, 7]],
+        (2, 0, 0): [[2.8125, 0], [0, 0]],
+    }
+    tiles = collect_tiles(ppccd)
+    assert tiles.keys() == expected.keys()
+    for key, data in expected.items():
+        numpy.testing.assert_array_equal(tiles[key], data, err_msg=f'{key}')
+
+
+def test_iterate_tiles_nan():
+    ppccd = make_ccd(512, 512, 0, 0)
+    ppccd.pool[100, 100] = numpy.nan
+    ppccd.pool[202:206, 302:306] = numpy.nan
+    tiles = collect_tiles(ppccd)
+
+    level1 = tiles[1, 0, 0]
+    block = ppccd.pool[100:102, 100:102]
+    assert level1[50, 50] == pytest.approx(numpy.nanmean(block))
+    # 全てNaNの2x2だけがNaNになり、上のlevelには伝わらない
+    assert numpy.isnan(level1[101:103, 151:153]).all()
+    assert numpy.isnan(level1).sum() == 4
+    for (level, _, _), data in tiles.items():
+        if level >= 2:
+            assert not numpy.isnan(data).any()
@@ -1,10 +1,17 @@
+import io
 import tempfile
 from pathlib import Path
 
+import astropy.io.fits as pyfits
+import numpy
+import pytest
+
 from quicklook.config import config
-from quicklook.generator.preprocess_ccd import preprocess_ccd
-from quicklook.types import CcdId, Visit
-from quicklook.utils.fits import preload_pyfits_compression_code
+from quicklook.generator.isr import bias_correction, parse_slice
+from quicklook.generator.preprocess_ccd import RAW_CARDS, RawFitsWcs, assemble_raw_amps, image_stat, preprocess_ccd
+from quicklook.tileinfo import ccds_by_name
+from quicklook.types import AmpMeta, BBox, CcdId, ImageStat, Visit
+from quicklook.utils.fits import FitsHdu, parse_hdus, preload_pyfits_compression_code
 from quicklook.utils.s3 import s3_download_object
 from quicklook.utils.timeit import timeit
 
@@ -31,4 +38,113 @@ def test_preprocess_ccd_calexp():
                 ppccd = preprocess_ccd(CcdId(visit, 'R01_S00'), Path(f.name))
 
 
+def make_raw_hdus(amps: list[tuple[numpy.ndarray, str, float, float, float]]) -> list[FitsHdu]:
+    # (data, DATASEC, PCの符号, CRVAL1, CRVAL2)のamp
+    hdus: list = [pyfits.PrimaryHDU()]
+    for data, datasec, s, crval1, crval2 in amps:
+        hdu = pyfits.ImageHDU(data.astype('>i4'))
+        hdu.header['DATASEC'] = datasec
+        for k, v in dict(PC1_1=s, PC1_2=0, PC2_1=0, PC2_2=s, CRVAL1=crval1, CRVAL2=crval2).items():
+            hdu.header[f'{k}E'] = float(v)
+        hdus.append(hdu)
+    f = io.BytesIO()
+    pyfits.HDUList(hdus).writeto(f)
+    return parse_hdus(f.getvalue(), RAW_CARDS)[1:]
+
+
+@pytest.mark.parametrize('pc', [(1, 0, 0, 1), (-1, 0, 0, 1), (1, 0, 0, -1), (-1, 0, 0, -1), (0, 1, 1, 0), (0, -1, 1, 0), (0, 1, -1, 0), (0, -1, -1, 0)])
+def test_unalign(pc: tuple[int, int, int, int]):
+    wcs = RawFitsWcs(*map(float, pc), CRVAL1=0, CRVAL2=0, DATASEC='[1:4,1:3]')
+    data = numpy.arange(12).reshape(3, 4)
+    aligned = wcs.align(data)
+    assert numpy.shares_memory(wcs.unalign(aligned), aligned)
+    numpy.testing.assert_array_equal(wcs.unalign(aligned), data)
+
+
+def test_bias_correction():
+    # 最後の列がoverscan、最後の行は列方向の補正に使われる
+    data = numpy.array(
+        [
+            [1, 2, 3, 10],
+            [4, 5, 6, 20],
+            [7, 8, 9, 30],
+        ],
+        dtype='>i4',
+    )
+    datasec = parse_slice('[1:3,1:2]')
+    expected = numpy.array(
+        [
+            [10.5, 10.5, 10.5],
+            [3.5, 3.5, 3.5],
+        ]
+    )
+    numpy.testing.assert_array_equal(bias_correction(data, datasec), expected)
+    out = numpy.zeros((3, 2), dtype=numpy.float32)
+    bias_correction(data, datasec, out=out.T[::-1])
+    numpy.testing.assert_array_equal(out.T[::-1], expected)
+
+
+def make_amp_data(a, b, c, d):
+    # 補正後のdata sectionが[[a, b], [c, d]]になるように、行ごとに異なるoverscanを足す
+    return numpy.array([[a, b, 0], [c, d, 0], [-c, -d, 0]]) + [[100], [200], [300]]
+
+
+def test_assemble_raw_amps():
+    ccd_name = 'R22_S11'
+    bbox = ccds_by_name()[ccd_name].bbox
+    x0, y0 = bbox.minx, bbox.miny
+    hdus = make_raw_hdus(
+        [
+            (make_amp_data(1, 2, 3, 4), '[1:2,1:2]', 1, x0 - 1, y0 - 1),
+            # 180度回転したamp
+            (make_amp_data(5, 6, 7, 8), '[1:2,1:2]', -1, x0 + 4, y0 + 2),
+        ]
+    )
+    assembly = assemble_raw_amps(hdus, ccd_name)
+    assert assembly.bbox == bbox
+    assert assembly.amp_metas == [
+        AmpMeta(amp_id=1, bbox=BBox(miny=y0, maxy=y0 + 1, minx=x0, maxx=x0 + 1)),
+        AmpMeta(amp_id=2, bbox=BBox(miny=y0, maxy=y0 + 1, minx=x0 + 2, maxx=x0 + 3)),
+    ]
+    expected = numpy.zeros_like(assembly.data)
+    expected[:2, :4] = [
+        [1, 2, 8, 7],
+        [3, 4, 6, 5],
+    ]
+    numpy.testing.assert_array_equal(assembly.data, expected)
+
+
+def make_sky(shape: tuple[int, int]):
+    rng = numpy.random.default_rng(0)
+    y, x = numpy.indices(shape, dtype=numpy.float32)
+    # 勾配のある背景と星
+    sky = 1000 + 0.01 * x + 0.02 * y + rng.normal(0, 30, shape).astype(numpy.float32)
+    sky[rng.integers(0, shape[0], 200), rng.integers(0, shape[1], 200)] += 50000
+    return sky
+
+
+def test_image_stat_sample():
+    # 4画素に1つを使う
+    sky = make_sky((1024, 1024))
+    exact = image_stat(sky, 'exact')
+    sample = image_stat(sky, 'sample')
+    assert sample.shape == exact.shape == sky.shape
+    # 誤差はdocstringの範囲に収まる
+    assert 0.495 < (sky < sample.median).mean() < 0.505
+    deviation = numpy.absolute(sky - exact.median)
+    assert 0.495 < (deviation < sample.mad).mean() < 0.505
+
+
+@pytest.mark.parametrize('method', ['exact', 'sample'])
+def test_image_stat_nan(method):
+    sky = make_sky((1000, 1000))
+    sky[:, :300] = numpy.nan
+    stat = image_stat(sky, method)
+    assert stat.median is not None and stat.mad is not None
+    assert abs(stat.median - numpy.nanmedian(sky)) < 2
+    assert abs(stat.mad - numpy.nanmedian(numpy.absolute(sky - numpy.nanmedian(sky)))) < 2
+    sky[:] = numpy.nan
+    assert image_stat(sky, method) == ImageStat(median=None, mad=None, shape=sky.shape)
+
+
 preload_pyfits_compression_code()
@@ -0,0 +1,33 @@
+import pytest
+
+from quicklook.storage.packedtile import InvalidPackedTile, decode_packed_tile_index, decode_packed_tiles, encode_packed_tiles, packed_tile_header_size
+
+
+def test_roundtrip():
+    tiles = [b'abc', None, b'', b'0123456789', None]
+    data = encode_packed_tiles(tiles)
+    assert decode_packed_tiles(data) == [b'abc', None, None, b'0123456789', None]
+
+
+def test_range_read():
+    tiles = [b'first', None, b'second', b'third']
+    data = encode_packed_tiles(tiles)
+    # headerだけで各タイルの位置がわかる
+    index = decode_packed_tile_index(data[: packed_tile_header_size(len(tiles))])
+    assert index.header_size == packed_tile_header_size(4)
+    for k, tile in enumerate(tiles):
+        r = index.range(k)
+        if tile is None:
+            assert r is None
+        else:
+            assert r is not None
+            offset, length = r
+            assert data[offset : offset + length] == tile
+
+
+def test_invalid():
+    with pytest.raises(InvalidPackedTile):
+        decode_packed_tile_index(b'XXXX\x01\x00\x00\x00')
+    data = encode_packed_tiles([b'a', b'b'])
+    with pytest.raises(InvalidPackedTile):
+        decode_packed_tile_index(data[:10])
@@ -0,0 +1,82 @@
+import pickle
+from pathlib import Path
+
+import pytest
+
+from quicklook import storage
+from quicklook.config import config
+from quicklook.storage.packedtile import encode_packed_tiles
+from quicklook.types import PackedTileId, Visit
+from quicklook.utils.s3 import NoSuchKey
+
+visit = Visit.from_id('raw:tilecache')
+
+
+@pytest.fixture
+def fake_s3(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    objects: dict[str, bytes] = {}
+    downloads: list[str] = []
+
+    def s3_download_object(settings, key: str, *, offset: int = 0, length: int = 0) -> bytes:
+        downloads.append(key)
+        if key not in objects:
+            raise NoSuchKey(f'No such key: {key}')
+        data = objects[key]
+        return data[offset : offset + length] if length else data[offset:]
+
+    monkeypatch.setattr(config, 'tile_cache_dir', str(tmp_path))
+    monkeypatch.setattr(storage, 's3_download_object', s3_download_object)
+
+    def clear():
+        storage._tile_cache.cache_clear()
+        storage._tile_cache_generations.cache_clear()
+        storage._get_packed_tile_index.cache_clear()
+        storage._get_legacy_packed_tile_array.cache_clear()
+
+    clear()
+    yield objects, downloads
+    clear()
+
+
+def put_tiles(objects: dict[str, bytes], tiles: dict[tuple[int, int], bytes]):
+    packed_id = PackedTileId.from_unpacked(2, 0, 0)
+    array: list[bytes | None] = [None] * (1 << config.tile_pack) ** 2
+    for (i, j), data in tiles.items():
+        array[packed_id.index(i, j)] = data
+    objects[storage._packed_tile_key(visit, packed_id)] = encode_packed_tiles(array)
+
+
+async def test_cached_tile(fake_s3):
+    objects, downloads = fake_s3
+    put_tiles(objects, {(0, 0): b'tile-0'})
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) == b'tile-0'
+    n = len(downloads)
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) == b'tile-0'
+    assert len(downloads) == n
+    assert (await storage.tile_cache_stats_async()).hits >= 1
+
+
+async def test_invalidate_visit_tile_cache(fake_s3):
+    objects, downloads = fake_s3
+    put_tiles(objects, {(0, 0): b'old'})
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) == b'old'
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 1, 1) is None  # 存在しないことがキャッシュされる
+
+    # 削除されて作り直された
+    put_tiles(objects, {(0, 0): b'new', (1, 1): b'new-1-1'})
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) == b'old'
+    await storage.invalidate_visit_tile_cache_async(visit)
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) == b'new'
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 1, 1) == b'new-1-1'
+
+
+async def test_legacy_pickled_packed_tile(fake_s3):
+    objects, downloads = fake_s3
+    packed_id = PackedTileId.from_unpacked(2, 0, 0)
+    array: list[bytes | None] = [None] * (1 << config.tile_pack) ** 2
+    array[packed_id.index(1, 1)] = b'legacy-1-1'
+    # 以前の形式（pickleしたlist）で保存されたvisitも読める
+    objects[f'quicklook/{visit.id}/packed-tile/2/0/0.npy.zstd.list.pickle'] = pickle.dumps(array)
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 1, 1) == b'legacy-1-1'
+    assert await storage.get_quicklook_tile_bytes_async(visit, 2, 0, 0) is None
+    assert storage.get_quicklook_tile_bytes(visit, 2, 1, 1) == b'legacy-1-1'
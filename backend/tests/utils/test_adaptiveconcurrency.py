@@ -0,0 +1,98 @@
+from contextlib import ExitStack
+
+import pytest
+
+from quicklook.utils.adaptiveconcurrency import AdaptiveConcurrency
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(
+    concurrency: AdaptiveConcurrency,
+    clock: FakeClock,
+    *,
+    n: int,
+    bandwidth,  # 同時に実行中の数 -> 全体の転送速度 (bytes/s)
+    size: int = 1_000_000,
+    limit_of=None,  # 実行中の上限。Noneならconcurrency.limit
+    dt: float = 0.001,
+):
+    '''
+    各操作が帯域を等分するとしてダウンロードを模擬する
+    '''
+    started = 0
+    active: list[list] = []  # [残りbytes, ExitStack]
+    while started < n or active:
+        limit = concurrency.limit if limit_of is None else limit_of()
+        while started < n and len(active) < limit:
+            stack = ExitStack()
+            m = stack.enter_context(concurrency.measure())
+            m.nbytes = size
+            active.append([size, stack])
+            started += 1
+        rate = bandwidth(len(active)) / len(active)
+        clock.now += dt
+        for op in active:
+            op[0] -= rate * dt
+        for op in [op for op in active if op[0] <= 0]:
+            active.remove(op)
+            op[1].close()
+
+
+def test_converges_to_saturation():
+    clock = FakeClock()
+    c = AdaptiveConcurrency(1, 16, clock=clock)
+    # 4並列までは並列数に比例して速くなる
+    simulate(c, clock, n=400, bandwidth=lambda k: min(k, 4) * 100e6)
+    assert 3 <= c.limit <= 6
+    assert c.decisions[0].reason == 'throughput up'
+    assert all(1 <= d.limit <= 16 for d in c.decisions)
+
+
+def test_bounds():
+    clock = FakeClock()
+    c = AdaptiveConcurrency(2, 3, clock=clock)
+    assert c.limit == 2
+    simulate(c, clock, n=200, bandwidth=lambda k: k * 100e6)
+    assert c.limit == 3
+
+
+def test_latency_guard():
+    clock = FakeClock()
+    c = AdaptiveConcurrency(1, 8, clock=clock)
+    simulate(c, clock, n=200, bandwidth=lambda k: k * 100e6)
+    assert c.limit == 8
+    # 上流が混雑して遅くなった
+    simulate(c, clock, n=200, bandwidth=lambda k: 10e6)
+    assert c.limit < 8
+    assert any(d.reason == 'latency' for d in c.decisions)
+
+
+def test_unsaturated_window_holds():
+    clock = FakeClock()
+    c = AdaptiveConcurrency(1, 8, clock=clock)
+    simulate(c, clock, n=50, bandwidth=lambda k: 100e6)
+    limit = c.limit
+    n_decisions = len(c.decisions)
+    # 消費側が詰まっていて1つずつしか実行されない
+    simulate(c, clock, n=50, bandwidth=lambda k: 100e6, limit_of=lambda: 1)
+    assert c.limit == limit
+    assert len(c.decisions) == n_decisions
+
+
+def test_failures_are_not_counted():
+    clock = FakeClock()
+    c = AdaptiveConcurrency(1, 8, clock=clock)
+    for _ in range(10):
+        with pytest.raises(RuntimeError):
+            with c.measure():
+                clock.now += 1
+                raise RuntimeError()
+    assert c.limit == 1
+    assert c.decisions == []
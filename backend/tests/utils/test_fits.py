@@ -1,12 +1,20 @@
+import io
+import logging
 import tempfile
+import time
 
 import astropy.io.fits as pyfits
+import numpy
+import pytest
 
 from quicklook.config import config
 from quicklook.types import Visit
-from quicklook.utils.fits import fits_partial_load
+from quicklook.utils.fits import fits_partial_load, parse_hdus
+from quicklook.utils.fitsheader import fitsheader_to_list, header_to_list, raw_headers_to_list
 from quicklook.utils.s3 import s3_download_object
 
+logger = logging.getLogger(__name__)
+
 
 def test_s3_partial_load():
     visit = Visit.from_id('calexp:192350')
@@ -22,3 +30,91 @@ def test_s3_partial_load():
         f.flush()
         with pyfits.open(f.name) as hdul:  # type: ignore
             hdul[1].data[-1]  # type: ignore
+
+
+def make_raw_like_fits(n_amps: int = 3, shape: tuple[int, int] = (20, 10)) -> bytes:
+    rng = numpy.random.default_rng(0)
+    primary = pyfits.PrimaryHDU()
+    primary.header['RAFTBAY'] = 'R22'
+    primary.header['CCDSLOT'] = 'S11'
+    primary.header['OBSERVER'] = "O'Hara"
+    hdus: list = [primary]
+    for k in range(n_amps):
+        hdu = pyfits.ImageHDU(rng.integers(0, 1 << 17, shape).astype('>i4'), name=f'Segment{k:02d}')
+        hdu.header['DATASEC'] = '[4:512,1:2000]'
+        hdu.header['PC1_1E'] = -1.0
+        hdu.header['CRVAL1E'] = 1.5e3
+        hdu.header['BLANKVAL'] = (None, 'undefined value')
+        for n in range(100):
+            hdu.header[f'DUMMY{n}'] = (n * 0.5, 'padding card')
+        hdus.append(hdu)
+    hdus.append(pyfits.ImageHDU(rng.normal(size=(30, 40)).astype('>f4'), name='FLOAT'))
+    hdus.append(pyfits.ImageHDU(numpy.arange(12, dtype='>i2').reshape(3, 4), name='SCALED', do_not_scale_image_data=True))
+    hdus[-1].header['BZERO'] = 32768
+    hdus[-1].header['BSCALE'] = 2
+    hdus.append(pyfits.BinTableHDU.from_columns([pyfits.Column(name='x', format='PJ()', array=[[1, 2, 3], [4]])], name='TABLE'))
+    f = io.BytesIO()
+    pyfits.HDUList(hdus).writeto(f)
+    return f.getvalue()
+
+
+def test_parse_hdus():
+    buf = make_raw_like_fits()
+    hdus = parse_hdus(buf, ['RAFTBAY', 'CCDSLOT', 'DATASEC', 'PC1_1E', 'CRVAL1E', 'OBSERVER', 'BLANKVAL'])
+    hdul = pyfits.HDUList.fromstring(buf)
+    assert [hdu.name for hdu in hdus] == [hdu.name for hdu in hdul]
+    assert hdus[0].cards['OBSERVER'] == "O'Hara"
+    assert hdus[0].data is None
+    assert hdus[1].cards['DATASEC'] == '[4:512,1:2000]'
+    assert hdus[1].cards['PC1_1E'] == -1.0
+    assert hdus[1].cards['CRVAL1E'] == 1.5e3
+    assert hdus[1].cards['BLANKVAL'] is None
+    assert 'DUMMY0' not in hdus[1].cards
+    for hdu, expected in zip(hdus, hdul):
+        if hdu.data is not None:
+            numpy.testing.assert_array_equal(hdu.data, expected.data)  # type: ignore
+    # 大きな画像はbufferのviewとして返される
+    assert hdus[1].data.base is not None and not hdus[1].data.flags.writeable  # type: ignore
+    assert hdus[-1].data is None
+    # astropyはdataを読むとheaderを書き換えるので、開き直して比べる
+    assert [header_to_list(hdu.astropy_header()) for hdu in hdus] == fitsheader_to_list(pyfits.HDUList.fromstring(buf))
+    # preprocessはヘッダーをバイト列のまま持ち、要求されたときにcardの一覧にする
+    assert raw_headers_to_list(b''.join(bytes(hdu.header) for hdu in hdus)) == fitsheader_to_list(pyfits.HDUList.fromstring(buf))
+
+
+def test_parse_hdus_broken():
+    buf = make_raw_like_fits(n_amps=1)
+    with pytest.raises(ValueError):
+        parse_hdus(b'x' * 2880 * 2)
+    with pytest.raises(ValueError):
+        parse_hdus(buf[:-2880])
+
+
+@pytest.mark.benchmark
+def test_parse_hdus_benchmark():
+    # rawのCCDと同じ大きさ
+    buf = make_raw_like_fits(n_amps=16, shape=(2048, 576))
+    keys = ['RAFTBAY', 'CCDSLOT', 'DATASEC', 'PC1_1E', 'CRVAL1E']
+
+    def astropy_open():
+        # 以前のpreprocessと同じく、全てのcardを解析してヘッダーを保存する形にする
+        hdul = pyfits.HDUList.fromstring(buf)
+        fitsheader_to_list(hdul)
+        for hdu in hdul[1:17]:
+            numpy.array(hdu.data, dtype=numpy.float32)  # type: ignore
+
+    def fast_open():
+        hdus = parse_hdus(buf, keys)
+        [bytes(hdu.header) for hdu in hdus]
+        for hdu in hdus[1:17]:
+            numpy.array(hdu.data, dtype=numpy.float32)
+
+    def bench(f):
+        t0 = time.perf_counter()
+        f()
+        return time.perf_counter() - t0
+
+    legacy = min(bench(astropy_open) for _ in range(3))
+    current = min(bench(fast_open) for _ in range(3))
+    logger.info(f'open raw-like fits: astropy={legacy:.3f}s parse_hdus={current:.3f}s ({legacy / current:.1f}x)')
+    assert current < legacy
@@ -0,0 +1,19 @@
+from quicklook.utils.http_request import activate_client_session, client_session, http_session
+
+
+async def test_client_session_is_shared_while_active():
+    async with activate_client_session():
+        async with client_session() as s1, client_session() as s2:
+            assert s1 is s2
+        assert not s1.closed
+    assert s1.closed
+
+
+async def test_client_session_without_activation():
+    async with client_session() as s1:
+        pass
+    assert s1.closed
+
+
+def test_http_session_is_reused():
+    assert http_session() is http_session()
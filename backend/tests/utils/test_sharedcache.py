@@ -0,0 +1,79 @@
+import multiprocessing as mp
+import os
+import time
+from pathlib import Path
+
+from quicklook.utils.sharedcache import SharedBytesCache
+
+
+def test_get_put(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=1024)
+    assert cache.get('a') is None
+    cache.put('a', b'hello')
+    assert cache.get('a') == b'hello'
+    cache.put('a', b'world!')
+    assert cache.get('a') == b'world!'
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions) == (2, 1, 0)
+    assert (stats.bytes, stats.entries) == (6, 1)
+
+
+def test_empty_value_is_a_hit(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=1024)
+    cache.put('a', b'')
+    assert cache.get('a') == b''
+
+
+def test_eviction_removes_least_recently_used(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=300, low_water=0.7)
+    for k in 'abc':
+        cache.put(k, k.encode() * 100)
+        time.sleep(0.01)
+    cache.get('a')  # 'b' が一番古くなる
+    time.sleep(0.01)
+    cache.put('d', b'd' * 100)
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+    assert cache.get('a') == b'a' * 100
+    assert cache.get('d') == b'd' * 100
+    stats = cache.stats()
+    assert stats.evictions == 2
+    assert stats.bytes == 200
+    assert stats.entries == 2
+
+
+def test_too_large_value_is_not_stored(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'x' * 11)
+    assert cache.get('a') is None
+    assert cache.stats().bytes == 0
+
+
+def test_clear(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=1024)
+    cache.put('a', b'hello')
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.stats().bytes == 0
+
+
+def _put_and_get(directory: str, n: int) -> None:
+    cache = SharedBytesCache(directory, max_bytes=1 << 20)
+    for k in range(n):
+        cache.put(f'{os.getpid()}-{k}', b'x' * 10)
+        assert cache.get(f'{os.getpid()}-{k}') == b'x' * 10
+
+
+def test_shared_between_processes(tmp_path: Path):
+    cache = SharedBytesCache(str(tmp_path), max_bytes=1 << 20)
+    cache.put('parent', b'p')
+    procs = [mp.get_context('spawn').Process(target=_put_and_get, args=(str(tmp_path), 20)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    stats = cache.stats()
+    assert stats.hits == 80
+    assert stats.entries == 81
+    assert stats.bytes == 1 + 80 * 10
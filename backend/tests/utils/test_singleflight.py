@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from quicklook.utils.singleflight import SingleFlight
+
+
+async def test_concurrent_calls_are_coalesced():
+    sf = SingleFlight[str, int]()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return 42
+
+    results = await asyncio.gather(*[sf.do('a', fetch) for _ in range(10)], sf.do('b', fetch))
+    assert results == [42] * 11
+    assert calls == 2
+    stats = sf.stats()
+    assert stats.calls == 11
+    assert stats.executions == 2
+    assert stats.saved == 9
+
+
+async def test_no_caching_after_completion():
+    sf = SingleFlight[str, int]()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        return calls
+
+    assert await sf.do('a', fetch) == 1
+    assert await sf.do('a', fetch) == 2
+
+
+async def test_exception_is_shared():
+    sf = SingleFlight[str, int]()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise KeyError('x')
+
+    results = await asyncio.gather(sf.do('a', fetch), sf.do('a', fetch), return_exceptions=True)
+    assert all(isinstance(r, KeyError) for r in results)
+    assert sf.stats().executions == 1
+
+
+async def test_cancelled_caller_does_not_cancel_others():
+    sf = SingleFlight[str, int]()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 1
+
+    t1 = asyncio.create_task(sf.do('a', fetch))
+    t2 = asyncio.create_task(sf.do('a', fetch))
+    await asyncio.sleep(0.01)
+    t1.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await t1
+    assert await t2 == 1
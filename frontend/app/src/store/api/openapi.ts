@@ -279,6 +279,7 @@ export type QuicklookStatus = {
   merge_progress: {
     [key: string]: MergeProgress;
   } | null;
+  published_min_level?: number | null;
 };
 export type Visit = {
   id: string;